@@ -0,0 +1,68 @@
+"""
+Benchmark of the crypto.analytics.backtest parameter sweep
+
+Builds --years of daily random-walk prices for --coins coins, listed at random dates over the first half of the
+history, and backtests a grid of --configs configurations across --processes workers:
+
+    python benchmarks/backtest.py --years 5 --coins 500 --configs 1000 --processes 8
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crypto.analytics.backtest import backtest, sweep  # noqa: E402
+
+GRID = {
+    'span': (7, 14, 30, 60, 90),
+    'top_n': (5, 10, 20, 50, 100),
+    'cap': (0.1, 0.25, 1.0),
+    'rebalance_every': (1, 7, 30),
+    'drift_threshold': (0.0, 0.02),
+    'rsi_period': (None, 14),
+    'fee_rate': (0.001, 0.0025),
+}
+
+
+def _history(coins, steps, seed=0):
+    rng = np.random.default_rng(seed)
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.03, (coins, steps)), axis=-1))
+    prices[np.arange(steps) < rng.integers(0, steps // 2, coins)[:, None]] = np.nan
+    market_cap = prices * rng.lognormal(10, 2, (coins, 1))
+
+    return prices, market_cap
+
+
+def _configs(n):
+    names = list(GRID)
+    return [dict(zip(names, values)) for values in itertools.islice(itertools.product(*GRID.values()), n)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--coins', type=int, default=500)
+    parser.add_argument('--configs', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=None, help='one per CPU by default')
+    args = parser.parse_args()
+
+    bench_prices, bench_market_cap = _history(args.coins, args.years * 365)
+    bench_configs = _configs(args.configs)
+
+    t = time.perf_counter()
+    backtest(bench_prices, bench_market_cap, bench_configs[0])
+    print('first backtest (with compilation) in {:.2f}s'.format(time.perf_counter() - t))
+
+    t = time.perf_counter()
+    results = sweep(bench_prices, bench_market_cap, bench_configs, args.processes)
+    elapsed = time.perf_counter() - t
+    print('{:,} configs over {} coins x {} days in {:.1f}s ({:.1f} configs/s)'.format(
+        len(results), args.coins, args.years * 365, elapsed, len(results) / elapsed))
+
+    best = max(results, key=lambda result: result['sharpe'])
+    print('best sharpe {:.2f}: {}'.format(best['sharpe'], {name: best[name] for name in GRID}))
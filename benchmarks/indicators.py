@@ -0,0 +1,204 @@
+"""
+Benchmark harness for crypto/analytics/indicators.py
+
+Times every kernel on synthetic random-walk prices across a grid of series lengths (single asset) and universe sizes
+(assets x time), alongside the np.gradient reference of time_series_diff and the pandas ewm/rolling reference
+implementations when pandas is installed. Every case runs in a fresh process so the peak memory (max RSS growth over
+the kernel call) is attributable to that case alone.
+
+Results are appended as JSON lines, one object per case, tagged with the git commit so runs can be compared:
+
+    python benchmarks/indicators.py --lengths 1e3 1e4 1e5 --assets 1 100 --output bench.jsonl
+    python benchmarks/indicators.py --compare old.jsonl new.jsonl
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LENGTHS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+ASSETS = (1, 10, 100, 1000, 5000)
+WINDOW = 30
+
+
+def _prices(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    return 100 * np.exp(np.cumsum(rng.normal(0, 1e-3, shape), axis=-1))
+
+
+def _cases(two_d):
+    """
+    :return: a dict of {(kernel, implementation): callable(open, close)} for 1-D series or (assets x time) matrices
+    """
+    from crypto.analytics import indicators as ind
+
+    if two_d:
+        cases = {
+            ('ewma', 'numba'): lambda o, c: ind._ewma_2d(c, ('span', WINDOW), 0, False),
+            ('ewma_infinite', 'numba'): lambda o, c: ind._ewma_2d(c, ('span', WINDOW), 0, True),
+            ('rolling', 'numba'): lambda o, c: ind._rolling_moments_2d(c, WINDOW),
+            ('rsi', 'numba'): lambda o, c: ind._rsi_2d(o, c, WINDOW),
+            ('bollinger_bands', 'numba'): lambda o, c: ind._bollinger_bands_2d(c, WINDOW),
+            ('time_series_diff', 'numba'): lambda o, c: ind.time_series_diff_2d(c),
+            ('time_series_diff', 'numpy'): lambda o, c: np.gradient(c, axis=1, edge_order=2),
+        }
+    else:
+        cases = {
+            ('ewma', 'numba'): lambda o, c: ind._ewma(c, ('span', WINDOW), 0, False),
+            ('ewma_infinite', 'numba'): lambda o, c: ind._ewma(c, ('span', WINDOW), 0, True),
+            ('rolling', 'numba'): lambda o, c: ind._rolling_moments(c, WINDOW),
+            ('rsi', 'numba'): lambda o, c: ind._rsi(o, c, WINDOW),
+            ('bollinger_bands', 'numba'): lambda o, c: ind._bollinger_bands(c, WINDOW),
+            ('time_series_diff', 'numba'): lambda o, c: ind.time_series_diff(c),
+            ('time_series_diff', 'numpy'): lambda o, c: np.gradient(c, edge_order=2),
+        }
+
+    try:
+        import pandas as pd
+    except ImportError:
+        return cases
+
+    # pandas works down the rows, so the matrices are handed over as (time x assets) frames
+    frame = (lambda a: pd.DataFrame(a.T)) if two_d else pd.Series
+    cases.update({
+        ('ewma', 'pandas'): lambda o, c: frame(c).ewm(span=WINDOW, adjust=True).mean(),
+        ('ewma_infinite', 'pandas'): lambda o, c: frame(c).ewm(span=WINDOW, adjust=False).mean(),
+        ('rolling', 'pandas'): lambda o, c: (frame(c).rolling(WINDOW).mean(), frame(c).rolling(WINDOW).std(ddof=0)),
+    })
+
+    return cases
+
+
+def _run_case(kernel, implementation, shape, repeat, queue):
+    from crypto.analytics.warmup import warmup
+
+    warmup()
+    _open = _prices(shape, seed=1)
+    _close = _prices(shape, seed=2)
+    func = _cases(len(shape) == 2)[(kernel, implementation)]
+
+    # One untimed call so lazily compiled specializations and the numba thread pool are not timed
+    small = tuple(min(dim, 64) for dim in shape)
+    func(_prices(small, seed=1), _prices(small, seed=2))
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(_open, _close)
+        timings.append(time.perf_counter() - t0)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    queue.put({'seconds': min(timings), 'peak_mem_bytes': (rss_after - rss_before) * scale})
+
+
+def run(lengths, assets, asset_length, repeat, kernels=None):
+    """
+    :param lengths: the single-asset series lengths to benchmark
+    :param assets: the universe sizes to benchmark, each over asset_length points
+    :param asset_length: the number of points per asset in the universe benchmarks
+    :param repeat: the number of timed calls per case, the fastest is reported
+    :param kernels: restrict the run to these kernel names
+    :return: a list of result dicts
+    """
+    ctx = mp.get_context('spawn')
+    commit = _git_commit()
+    shapes = [(int(n),) for n in lengths] + [(int(a), int(asset_length)) for a in assets]
+
+    results = []
+    for shape in shapes:
+        for kernel, implementation in _cases(len(shape) == 2):
+            if kernels and kernel not in kernels:
+                continue
+
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_run_case, args=(kernel, implementation, shape, repeat, queue))
+            proc.start()
+            proc.join()
+            if proc.exitcode != 0:
+                result = {'error': 'exit code {}'.format(proc.exitcode)}
+            else:
+                result = queue.get()
+
+            n_points = int(np.prod(shape))
+            result.update({
+                'commit': commit,
+                'kernel': kernel,
+                'implementation': implementation,
+                'n_assets': shape[0] if len(shape) == 2 else 1,
+                'n_points': n_points,
+                'throughput': n_points / result['seconds'] if 'seconds' in result else None,
+            })
+            results.append(result)
+            print(_format(result), flush=True)
+
+    return results
+
+
+def compare(old_path, new_path, threshold=0.1):
+    """
+    Prints the cases whose throughput changed by more than threshold between two result files
+
+    :return: the number of regressions
+    """
+    def load(path):
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        return {(r['kernel'], r['implementation'], r['n_assets'], r['n_points']): r for r in rows if r.get('throughput')}
+
+    old, new = load(old_path), load(new_path)
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        change = new[key]['throughput'] / old[key]['throughput'] - 1
+        if abs(change) > threshold:
+            regressions += change < 0
+            print('{:<18}{:<8}{:>6} assets{:>12} points  {:+.1%}'.format(*key, change))
+
+    return regressions
+
+
+def _format(result):
+    if 'error' in result:
+        return '{kernel:<18}{implementation:<8}{n_assets:>6} assets{n_points:>12} points  {error}'.format(**result)
+
+    return ('{kernel:<18}{implementation:<8}{n_assets:>6} assets{n_points:>12} points  {seconds:>10.5f}s  '
+            '{throughput:>14,.0f} pts/s  {peak_mem_bytes:>14,} B').format(**result)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lengths', nargs='*', type=float, default=LENGTHS)
+    parser.add_argument('--assets', nargs='*', type=float, default=ASSETS)
+    parser.add_argument('--asset-length', type=float, default=1e4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--kernels', nargs='*')
+    parser.add_argument('--output', default='bench_output.jsonl')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+
+    rows = run(args.lengths, args.assets, args.asset_length, args.repeat, args.kernels)
+    with open(args.output, 'a') as out:
+        for row in rows:
+            out.write(json.dumps(dict(row, machine=platform.platform(), python=platform.python_version())) + '\n')
@@ -0,0 +1,103 @@
+"""
+Benchmark of the crypto.db.query helpers with and without the (crypto_id, load_date) indexes
+
+Builds a SQLite market_data table of --coins x --points rows (10M by default) with a recursive CTE, times
+latest_per_coin, range_scan and as_of_join against the indexed table, then drops the indexes and times them again:
+
+    python benchmarks/queries.py --coins 1000 --points 10000 --path /tmp/bench_queries.db
+"""
+import argparse
+import datetime as dt
+import os
+import sys
+import time
+
+import sqlalchemy as db
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crypto.db.models import Base, CryptoRunningAverages, MarketData  # noqa: E402
+from crypto.db.query import as_of_join, latest_per_coin, range_scan  # noqa: E402
+
+START = dt.datetime(2016, 1, 1)
+
+
+def build(engine, coins, points):
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+    # One row per coin per minute, generated inside SQLite so building 10M rows takes seconds
+    with engine.begin() as conn:
+        conn.execute(db.text('''
+            INSERT INTO currency_information (id, symbol)
+            WITH RECURSIVE coin(id) AS (SELECT 1 UNION ALL SELECT id + 1 FROM coin WHERE id < :coins)
+            SELECT id, 'C' || id FROM coin
+        '''), {'coins': coins})
+        conn.execute(db.text('''
+            INSERT INTO market_data (crypto_id, load_date, market_cap, trade_price)
+            WITH RECURSIVE
+                coin(id) AS (SELECT 1 UNION ALL SELECT id + 1 FROM coin WHERE id < :coins),
+                tick(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM tick WHERE i < :points - 1)
+            SELECT coin.id, strftime('%Y-%m-%d %H:%M:%S.000000', :start, '+' || tick.i || ' minutes'),
+                   1000000 + tick.i, 1.0 + tick.i * 0.01
+            FROM tick, coin
+        '''), {'coins': coins, 'points': points, 'start': START.strftime('%Y-%m-%d %H:%M:%S')})
+        conn.execute(db.text('''
+            INSERT INTO running_averages (crypto_id, load_date, ewma_trade_price)
+            SELECT crypto_id, load_date, trade_price FROM market_data WHERE crypto_id <= 10
+        '''))
+
+
+def timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t0)
+
+    return min(timings)
+
+
+def run(engine, coins, points, repeat, baseline_repeat=1):
+    start = START + dt.timedelta(minutes=points // 2)
+    end = start + dt.timedelta(days=1)
+    cases = {
+        'latest_per_coin': lambda conn: latest_per_coin(conn, MarketData, ['trade_price', 'market_cap']),
+        'range_scan (1 day)': lambda conn: range_scan(conn, MarketData, coins // 2, ['trade_price'], start, end),
+        'as_of_join (1 day)': lambda conn: as_of_join(conn, MarketData, CryptoRunningAverages, 5, ['trade_price'],
+                                                       ['ewma_trade_price'], start, end),
+    }
+
+    results = {}
+    for indexed in (True, False):
+        if not indexed:
+            with engine.begin() as conn:
+                for table in (MarketData.__table__, CryptoRunningAverages.__table__):
+                    for index in table.indexes:
+                        index.drop(conn)
+
+        with engine.connect() as conn:
+            for name, case in cases.items():
+                results[(name, indexed)] = timed(lambda: case(conn), repeat if indexed else baseline_repeat)
+
+    print('{:<22}{:>14}{:>14}{:>10}'.format('query', 'indexed', 'full scan', 'speedup'))
+    for name in cases:
+        fast, slow = results[(name, True)], results[(name, False)]
+        print('{:<22}{:>13.4f}s{:>13.4f}s{:>9.0f}x'.format(name, fast, slow, slow / fast))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--coins', type=int, default=1000)
+    parser.add_argument('--points', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    # Without the indexes latest_per_coin scans the table once per coin, minutes at the default size
+    parser.add_argument('--baseline-repeat', type=int, default=1)
+    parser.add_argument('--path', default='bench_queries.db')
+    args = parser.parse_args()
+
+    bench_engine = db.create_engine('sqlite:///{}'.format(args.path))
+    t = time.perf_counter()
+    build(bench_engine, args.coins, args.points)
+    print('built {:,} rows in {:.1f}s'.format(args.coins * args.points, time.perf_counter() - t))
+    run(bench_engine, args.coins, args.points, args.repeat, args.baseline_repeat)
@@ -0,0 +1,246 @@
+"""
+Backtests of the index strategy over the market history, and parameter sweeps running them across a process pool.
+
+The history is pivoted into (assets x time) matrices of close prices and market caps read from the daily (or hourly)
+rollups of market_data. A backtest smooths the market caps with _ewma_2d, optionally leaves out the coins whose _rsi_2d
+is above a threshold, and rebalances every rebalance_every steps to the weights of index_weights through the same
+order_deltas rules as the live rebalancing: drift threshold, minimum trade and buys funded by sells and cash. The
+indicators are whole-matrix kernels and the holdings only change on rebalance dates, so the portfolio value between
+two rebalances is one matrix-vector product and the Python loop runs once per rebalance, never once per tick:
+
+    history = load_history(engine, dt.datetime(2019, 1, 1), dt.datetime(2024, 1, 1))
+    backtest(history['prices'], history['market_cap'], {'span': 30, 'top_n': 20, 'cap': 0.25})
+    # {'total_return': 1.93, 'cagr': 0.24, 'volatility': 0.61, 'sharpe': 0.65, 'max_drawdown': 0.74, ...}
+
+    results = sweep(history['prices'], history['market_cap'], grid(span=[7, 30, 90], top_n=[5, 10, 20]))
+
+The sweep copies the two matrices once into shared memory; the worker processes map them read-only instead of
+receiving a pickled copy per configuration, and each worker runs the numba kernels on a single thread so the pool
+does not oversubscribe the cores. The workers are spawned, so scripts calling sweep() need the usual
+if __name__ == '__main__' guard.
+"""
+import itertools
+import math
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from crypto.analytics.indicators import _ewma_2d, _rsi_2d
+from crypto.analytics.ranking import index_weights
+from crypto.db.rollup import RESOLUTIONS, _datetime64, _read
+from crypto.purchasing.rebalance import order_deltas
+
+DEFAULTS = {
+    'span': 30,  # span of the ewma of the market caps the coins are ranked by
+    'top_n': 10,
+    'cap': 1.0,
+    'floor': 0.0,
+    'rebalance_every': 7,  # steps of the history between two rebalances
+    'drift_threshold': 0.0,
+    'min_trade_usd': 0.0,
+    'fee_rate': 0.001,  # share of the traded notional paid as fees
+    'rsi_period': None,  # leave out the coins whose RSI over this period is above rsi_max, no filter when None
+    'rsi_max': 70.0,
+    'initial_cash': 10000.0,
+}
+
+PERIODS_PER_YEAR = {'1m': 365 * 24 * 60, '1h': 365 * 24, '1d': 365}
+
+
+def _ffill(matrix):
+    # Carries the last value of each row forward over NaN, so a coin missing a bar keeps its last price
+    index = np.where(np.isnan(matrix), 0, np.arange(matrix.shape[1]))
+    np.maximum.accumulate(index, axis=1, out=index)
+
+    return np.take_along_axis(matrix, index, axis=1)
+
+
+def load_history(engine, start, end, resolution='1d'):
+    """
+    :param engine: the SQLAlchemy engine
+    :param start: the first load_date of the history
+    :param end: the end of the history, exclusive
+    :param resolution: the rollup replayed, '1m', '1h' or '1d'
+    :return: a dict of the crypto_ids, the load_dates and the (assets x time) matrices of close prices and market
+        caps, forward-filled after each coin's first bar and NaN before it
+    """
+    model = next(level[1] for level in RESOLUTIONS if level[0] == resolution)
+    with engine.connect() as conn:
+        bars = _read(conn, model, _datetime64(start), _datetime64(end))
+
+    crypto_ids, asset_index = np.unique(bars['crypto_id'], return_inverse=True)
+    load_dates, time_index = np.unique(bars['load_date'], return_inverse=True)
+    history = {'crypto_id': crypto_ids, 'load_date': load_dates}
+    for column, name in (('close', 'prices'), ('market_cap', 'market_cap')):
+        matrix = np.full((crypto_ids.shape[0], load_dates.shape[0]), np.nan)
+        matrix[asset_index, time_index] = bars[column]
+        history[name] = _ffill(matrix)
+
+    return history
+
+
+def _rankable(market_cap, prices, config):
+    """
+    :return: the (assets x time) matrix the coins are ranked by at each step, NaN where a coin cannot be held
+    """
+    ranked = _ewma_2d(market_cap, ('span', float(config['span'])), 0, False)
+    if config['rsi_period']:
+        # The open of a bar is the close of the one before
+        _open = np.concatenate([prices[:, :1], prices[:, :-1]], axis=1)
+        rsi = _rsi_2d(_open, prices, int(config['rsi_period']))
+        ranked = np.where(rsi > config['rsi_max'], np.nan, ranked)
+
+    return np.where(np.isfinite(prices) & (prices > 0), ranked, np.nan)
+
+
+def _weights(ranked, config):
+    # The cap and floor are relaxed to what the coins available at the time can satisfy, e.g. early in the history
+    n = min(config['top_n'], np.count_nonzero(np.isfinite(ranked) & (ranked > 0)))
+    if n == 0:
+        return np.zeros(ranked.shape[0])
+    _, weights = index_weights(ranked, config['top_n'], max(config['cap'], 1.0 / n), min(config['floor'], 1.0 / n))
+
+    return weights
+
+
+def _metrics(equity, periods_per_year):
+    returns = equity[1:] / equity[:-1] - 1
+    std = returns.std() if returns.shape[0] else 0.0
+    years = equity.shape[0] / periods_per_year
+
+    return {
+        'total_return': float(equity[-1] / equity[0] - 1),
+        'cagr': float((equity[-1] / equity[0]) ** (1 / years) - 1) if equity[-1] > 0 else -1.0,
+        'volatility': float(std * math.sqrt(periods_per_year)),
+        'sharpe': float(returns.mean() / std * math.sqrt(periods_per_year)) if std > 0 else 0.0,
+        'max_drawdown': float((1 - equity / np.maximum.accumulate(equity)).max()),
+    }
+
+
+def backtest(prices, market_cap, config=None, periods_per_year=365, equity=False):
+    """
+    Replays the index strategy over the history
+
+    :param prices: the (assets x time) matrix of prices, NaN where a coin is not listed yet
+    :param market_cap: the (assets x time) matrix of market caps
+    :param config: a dict overriding DEFAULTS
+    :param periods_per_year: the steps of the history per year, to annualize the metrics, see PERIODS_PER_YEAR
+    :param equity: also return the portfolio value at every step under 'equity'
+    :return: a dict of the config, the total return, CAGR, annualized volatility, Sharpe ratio and maximum drawdown,
+        the number of rebalances and trades, the turnover (traded notional over the average portfolio value) and fees
+    """
+    config = dict(DEFAULTS, **(config or {}))
+    prices = np.asarray(prices, dtype=np.float64)
+    market_cap = np.asarray(market_cap, dtype=np.float64)
+    n_steps = prices.shape[1]
+
+    ranked = _rankable(market_cap, prices, config)
+    valued = np.nan_to_num(prices)
+    every = max(int(config['rebalance_every']), 1)
+
+    quantities = np.zeros(prices.shape[0])
+    cash = float(config['initial_cash'])
+    curve = np.empty(n_steps)
+    traded = fees = 0.0
+    trades = 0
+    for t in range(0, n_steps, every):
+        deltas, amounts = order_deltas(quantities[None], prices[:, t], _weights(ranked[:, t], config), [cash],
+                                       config['drift_threshold'], config['min_trade_usd'])
+        # The buys are scaled down so they and the fees stay within the cash and the proceeds of the sells
+        buys, sells = amounts[amounts > 0].sum(), -amounts[amounts < 0].sum()
+        if buys > 0:
+            rate = config['fee_rate']
+            scale = min(1.0, max(0.0, cash + sells * (1 - rate)) / (buys * (1 + rate)))
+            deltas = np.where(amounts > 0, deltas * scale, deltas)
+            amounts = np.where(amounts > 0, amounts * scale, amounts)
+        notional = np.abs(amounts).sum()
+        fee = notional * config['fee_rate']
+        quantities += deltas[0]
+        cash -= amounts.sum() + fee
+
+        traded += notional
+        fees += fee
+        trades += np.count_nonzero(amounts)
+        # The holdings are fixed until the next rebalance
+        curve[t:t + every] = quantities @ valued[:, t:t + every] + cash
+
+    result = dict(config)
+    result.update(_metrics(curve, periods_per_year))
+    result.update(rebalances=-(-n_steps // every), trades=int(trades), turnover=float(traded / curve.mean()),
+                  fees=float(fees))
+    if equity:
+        result['equity'] = curve
+
+    return result
+
+
+def grid(**params):
+    """
+    :param params: the values of each parameter of DEFAULTS to try, e.g. span=[7, 30], top_n=[5, 10]
+    :return: the list of configs of every combination
+    """
+    names = list(params)
+    return [dict(zip(names, values)) for values in itertools.product(*params.values())]
+
+
+# The shared matrices and settings as attached by each worker of the pool, and the blocks kept open under them
+_shared = {}
+_blocks = []
+
+
+def _share(matrix):
+    block = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+    np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=block.buf)[:] = matrix
+
+    return block
+
+
+def _attach(specs, periods_per_year):
+    import numba
+
+    numba.set_num_threads(1)
+    for name, (block_name, shape) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        matrix = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+        matrix.flags.writeable = False
+        _blocks.append(block)
+        _shared[name] = matrix
+    _shared['periods_per_year'] = periods_per_year
+
+
+def _run(config):
+    return backtest(_shared['prices'], _shared['market_cap'], config, _shared['periods_per_year'])
+
+
+def sweep(prices, market_cap, configs, processes=None, periods_per_year=365, chunksize=None):
+    """
+    Backtests every config across a pool of processes sharing the price and market cap matrices
+
+    :param prices: see backtest
+    :param market_cap: see backtest
+    :param configs: the list of configs, see grid
+    :param processes: the number of worker processes, one per CPU when None
+    :param periods_per_year: see backtest
+    :param chunksize: the configs sent to a worker at once, about 4 chunks per worker when None
+    :return: the list of backtest results without the equity curves, in the order of configs
+    """
+    processes = processes or mp.cpu_count()
+    chunksize = chunksize or max(1, len(configs) // (4 * processes))
+
+    matrices = {'prices': np.ascontiguousarray(prices, dtype=np.float64),
+                'market_cap': np.ascontiguousarray(market_cap, dtype=np.float64)}
+    blocks = {name: _share(matrix) for name, matrix in matrices.items()}
+    try:
+        specs = {name: (blocks[name].name, matrix.shape) for name, matrix in matrices.items()}
+        # Spawned rather than forked: the TBB threading layer of the numba kernels is not fork-safe once started
+        context = mp.get_context('spawn')
+        with context.Pool(processes, initializer=_attach, initargs=(specs, periods_per_year)) as pool:
+            results = pool.map(_run, configs, chunksize)
+    finally:
+        # Only the parent unlinks the blocks, once every worker is gone
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+    return results
@@ -0,0 +1,165 @@
+"""
+Out-of-core evaluation of the indicator kernels. A coin's history is streamed through in fixed-size blocks and the
+state each kernel needs (the EWMA accumulator, the rolling window, the gradient overlap) is carried across block
+boundaries, so the concatenated output is identical to the in-memory kernel run over the whole series.
+
+Every function is a generator, so results can be written back as they are produced:
+
+    for block in chunked_ewma(iter_blocks(np.load('prices.npy', mmap_mode='r'), 1_000_000), ('span', 30)):
+        out_file.write(block.tobytes())
+"""
+import numpy as np
+from numba import jit
+from numba import float64, int64, boolean
+
+from crypto.analytics.indicators import _alpha, _as_float, _ewma_step, _rolling_moments_carry
+from crypto.analytics.warmup import register
+
+
+def iter_blocks(arr, block_size: int):
+    """
+    :param arr: a 1-D array; a np.memmap is read one block at a time
+    :param block_size: the number of observations per block
+    :return: a generator of consecutive blocks of arr
+    """
+    for start in range(0, arr.shape[0], block_size):
+        yield arr[start:start + block_size]
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _ewma_carry(arr_in, alpha, num, den, seen, min_n, infinite, out):
+    """
+    The body of _ewma with its accumulator passed in and out
+
+    :param seen: the number of observations before this block
+    :return: the updated (num, den)
+    """
+    for i in range(arr_in.shape[0]):
+        if seen + i == 0:
+            num = float(arr_in[0])
+            den = 1.0
+        else:
+            num, den = _ewma_step(arr_in[i], alpha, num, den, infinite)
+        out[i] = num / den
+
+        if seen + i < min_n - 1:
+            out[i] = np.nan
+
+    return num, den
+
+
+def chunked_ewma(blocks, window: tuple, min_n=0, infinite=False):
+    """
+    :param blocks: an iterable of consecutive blocks of the series
+    :param window: see _ewma
+    :param min_n: see _ewma
+    :param infinite: see _ewma
+    :return: a generator of the EWMA, one output block per input block
+    """
+    alpha = _alpha(window)
+    num, den, seen = 0.0, 1.0, 0
+    for block in blocks:
+        block = _as_float(block)
+        out = np.empty(block.shape[0], dtype=np.float64)
+        num, den = _ewma_carry(block, alpha, num, den, seen, min_n, infinite, out)
+        seen += block.shape[0]
+
+        yield out
+
+
+def chunked_rolling_moments(blocks, n: int):
+    """
+    :param blocks: an iterable of consecutive blocks of the series
+    :param n: see _rolling_moments
+    :return: a generator of (mean, std), one output block per input block
+    """
+    state = np.zeros(5, dtype=np.float64)
+    prev = np.empty(0, dtype=np.float64)
+    for block in blocks:
+        block = _as_float(block)
+        mean = np.empty(block.shape[0], dtype=np.float64)
+        std = np.empty(block.shape[0], dtype=np.float64)
+        _rolling_moments_carry(block, n, prev, state, mean, std)
+
+        # Only the last n observations can still leave the window
+        if block.shape[0] >= n:
+            prev = block[-n:].astype(np.float64)
+        else:
+            prev = np.concatenate((prev, block))[-n:].astype(np.float64)
+
+        yield mean, std
+
+
+class _GradientStream:
+    """
+    np.gradient(edge_order=2) over a stream. The derivative at a point needs its right-hand neighbour, so every
+    block of output lags the input by one point, which is emitted once the next block (or the end) arrives.
+    """
+
+    def __init__(self):
+        self.window = np.empty(0, dtype=np.float64)
+        self.offset = 0
+        self.total = 0
+        self.emitted = 0
+
+    def push(self, block):
+        w = np.concatenate((self.window, block))
+        self.total += block.shape[0]
+
+        out = []
+        if self.emitted == 0 and self.total >= 3:
+            out.append(np.array([-1.5 * w[0] + 2.0 * w[1] + -0.5 * w[2]]))
+            self.emitted = 1
+
+        if self.emitted > 0 and self.total - 1 > self.emitted:
+            lo = self.emitted - self.offset
+            hi = self.total - 1 - self.offset
+            out.append((w[lo + 1:hi + 1] - w[lo - 1:hi - 1]) / 2.0)
+            self.emitted = self.total - 1
+
+        # Keeping the two-point overlap the interior and the trailing edge formula need
+        keep = max(self.emitted - 2, 0)
+        self.window = w[keep - self.offset:]
+        self.offset = keep
+
+        return np.concatenate(out) if out else np.empty(0, dtype=np.float64)
+
+    def finish(self):
+        if self.total < 3:
+            raise ValueError('Shape of array too small to calculate a numerical gradient, at least 3 elements are '
+                             'required.')
+
+        w = self.window
+        self.emitted = self.total
+        return np.array([0.5 * w[-3] + -2.0 * w[-2] + 1.5 * w[-1]])
+
+
+def chunked_time_series_diff(blocks, derivative_type='1st'):
+    """
+    :param blocks: an iterable of consecutive blocks of the series
+    :param derivative_type: see time_series_diff
+    :return: a generator of the derivative. The output blocks trail the input by one point (two for the 2nd
+        derivative) and the remainder is produced once the input is exhausted
+    """
+    if derivative_type == '1st':
+        streams = [_GradientStream()]
+    elif derivative_type == '2nd':
+        streams = [_GradientStream(), _GradientStream()]
+    else:
+        return
+
+    for block in blocks:
+        out = _as_float(block).astype(np.float64, copy=False)
+        for stream in streams:
+            out = stream.push(out)
+        if out.shape[0]:
+            yield out
+
+    # Flushing the held back points through the rest of the chain
+    out = streams[0].finish()
+    for stream in streams[1:]:
+        out = np.concatenate((stream.push(out), stream.finish()))
+    yield out
+
+
+register(_ewma_carry, (float64[::1], float64, float64, float64, int64, int64, boolean, float64[::1]))
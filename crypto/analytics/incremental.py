@@ -0,0 +1,156 @@
+import numpy as np
+
+from crypto.analytics.indicators import _alpha, _ewma_step
+from crypto.db.models import IndicatorState
+
+
+class EWMAState:
+    """
+    The carry state of _ewma for a single series. Feeding the observations one at a time through update() gives
+    exactly the same values as running _ewma over the full history.
+    """
+
+    indicator = 'ewma'
+
+    def __init__(self, window: tuple, min_n=0, infinite=False, n_obs=0, last_value=np.nan, weight_sum=0.0):
+        """
+        :param window: ('span', value), ('com', value) or ('alpha', value) -- see _ewma
+        :param min_n: the number of observations required before a value is reported
+        :param infinite: see _ewma
+        :param n_obs: the number of observations folded into the state so far
+        :param last_value: the weighted sum of the observations (the last EWMA value when infinite=True)
+        :param weight_sum: the sum of the weights, unused when infinite=True
+        """
+        self.window = window
+        self.min_n = min_n
+        self.infinite = infinite
+        self.alpha = _alpha(window)
+
+        self.n_obs = n_obs
+        self.last_value = last_value
+        self.weight_sum = weight_sum
+
+    @property
+    def value(self):
+        if self.n_obs == 0 or self.n_obs < self.min_n:
+            return np.nan
+
+        return self.last_value / self.weight_sum
+
+    def update(self, x):
+        """
+        :param x: the new observation
+        :return: the EWMA including the new observation
+        """
+        if self.n_obs == 0:
+            self.last_value, self.weight_sum = float(x), 1.0
+        else:
+            self.last_value, self.weight_sum = _ewma_step(x, self.alpha, self.last_value, self.weight_sum,
+                                                          self.infinite)
+        self.n_obs += 1
+
+        return self.value
+
+    def to_model(self, crypto_id, field, load_date=None, row=None):
+        """
+        :param crypto_id: the currency_information id the state belongs to
+        :param field: the MarketData column the EWMA runs over, e.g. 'market_cap'
+        :param load_date: the load_date of the last observation folded into the state
+        :param row: an existing IndicatorState row to update in place, a new one is created otherwise
+        :return: the IndicatorState row
+        """
+        if row is None:
+            row = IndicatorState(crypto_id=crypto_id, field=field, indicator=self.indicator)
+
+        row.load_date = load_date
+        row.window_type = self.window[0]
+        row.window_value = self.window[1]
+        row.infinite = self.infinite
+        row.min_n = self.min_n
+        row.n_obs = self.n_obs
+        row.last_value = self.last_value
+        row.weight_sum = self.weight_sum
+
+        return row
+
+    @classmethod
+    def from_model(cls, row):
+        return cls((row.window_type, row.window_value), row.min_n, row.infinite, row.n_obs, row.last_value,
+                   row.weight_sum)
+
+
+class RSIState:
+    """
+    The carry state of _rsi for a single series: the running averages of the up and down moves.
+    """
+
+    indicator = 'rsi'
+
+    def __init__(self, n: int, n_obs=0, up_avg=np.nan, down_avg=np.nan):
+        """
+        :param n: the period of interest for the Relative Strength Index
+        :param n_obs: the number of observations folded into the state so far
+        :param up_avg: the running average of the "Up" moves
+        :param down_avg: the running average of the "Down" moves
+        """
+        self.n = n
+        self.up = EWMAState(('com', n - 1), n, True, n_obs, up_avg, 1.0)
+        self.down = EWMAState(('com', n - 1), n, True, n_obs, down_avg, 1.0)
+
+    @property
+    def n_obs(self):
+        return self.up.n_obs
+
+    @property
+    def value(self):
+        # Numpy scalars so a zero "Down" average gives an infinite RS the same way the array kernel does
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rs = np.absolute(np.float64(self.up.value) / np.float64(self.down.value))
+            return float(100 * (1 - (1 / (1 + rs))))
+
+    def update(self, _open, _close):
+        """
+        :param _open: the opening price of the new period
+        :param _close: the closing price of the new period
+        :return: the RSI including the new period
+        """
+        delta = _close - _open
+        self.up.update(delta if delta > 0 else 0 * delta)
+        self.down.update(delta if delta < 0 else 0 * delta)
+
+        return self.value
+
+    def to_model(self, crypto_id, field, load_date=None, row=None):
+        if row is None:
+            row = IndicatorState(crypto_id=crypto_id, field=field, indicator=self.indicator)
+
+        row.load_date = load_date
+        row.window_type = 'n'
+        row.window_value = self.n
+        row.infinite = True
+        row.min_n = self.n
+        row.n_obs = self.n_obs
+        row.up_avg = self.up.last_value
+        row.down_avg = self.down.last_value
+
+        return row
+
+    @classmethod
+    def from_model(cls, row):
+        return cls(int(row.window_value), row.n_obs, row.up_avg, row.down_avg)
+
+
+def load_states(session, crypto_id):
+    """
+    :param session: an open SQLAlchemy session
+    :param crypto_id: the currency_information id to load the states of
+    :return: a dict of {(field, indicator, window): (state, row)} for every persisted state of the coin
+    """
+    states = {}
+    for row in session.query(IndicatorState).filter(IndicatorState.crypto_id == crypto_id):
+        state_cls = RSIState if row.indicator == RSIState.indicator else EWMAState
+        state = state_cls.from_model(row)
+        window = state.n if row.indicator == RSIState.indicator else state.window
+        states[(row.field, row.indicator, window)] = (state, row)
+
+    return states
@@ -1,27 +1,140 @@
 import numpy as np
-from numba import jit
-from numba import float64
+from numba import jit, prange
+from numba import float64, int64, boolean, types
+from numba.extending import overload
 
+from crypto.analytics.warmup import register
 
-def time_series_diff(data, derivative_type='1st'):
+
+class Workspace:
+    """
+    Output and scratch buffers that are allocated once and reused across indicator calls, so refreshing a whole
+    universe keeps a single working set alive instead of a fresh set of intermediates per call.
+
+    Pass dtype=np.float32 to opt into single precision storage; the kernels still accumulate in double precision and
+    only round when writing to the buffer.
+
+    Usage:
+        workspace = Workspace(np.float32)
+        for coin_prices in universe:
+            ewma = _ewma(coin_prices, ('span', 30), 0, False, workspace.get('ewma', coin_prices.shape))
+    """
+
+    def __init__(self, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self._buffers = {}
+
+    def get(self, name, shape):
+        """
+        :param name: the name of the buffer, one per concurrently needed output
+        :param shape: the shape the buffer needs to have, an int or a sequence of them
+        :return: the buffer, reallocated only when the shape changes
+        """
+        # Normalized so a list or numpy ints give the same key as the equivalent tuple of ints
+        shape = tuple(int(dim) for dim in np.atleast_1d(shape).tolist())
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=self.dtype)
+            self._buffers[name] = buffer
+
+        return buffer
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+def _buffer(out, shape):
+    """
+    :return: out, or a new float64 array of the given shape when out is None
+    """
+    return np.empty(shape, dtype=np.float64) if out is None else out
+
+
+@overload(_buffer)
+def _buffer_jit(out, shape):
+    # Resolved at compile time, so a caller supplied buffer keeps its own dtype (e.g. float32)
+    if out is None or isinstance(out, (types.NoneType, types.Omitted)):
+        return lambda out, shape: np.empty(shape, dtype=np.float64)
+
+    return lambda out, shape: out
+
+
+def _as_float(data):
+    arr = np.asarray(data)
+    if arr.dtype != np.float32:
+        arr = arr.astype(np.float64, copy=False)
+
+    return arr
+
+
+def time_series_diff(data, derivative_type='1st', out=None, work=None):
     """
         :param data: This is the dataset the user wants to determine the acceleration of.
             May be either a pandas series or a numpy.ndarray
         :param derivative_type: specifies the level of the derivative to be taken, either 1st or 2nd
+        :param out: optional preallocated output buffer, same length as data
+        :param work: optional preallocated scratch buffer for the 1st derivative when derivative_type is 2nd
         :return: The 1st or 2nd derivative of the time-series data
         """
+    arr = _as_float(data)
+    if arr.shape[0] < 3:
+        raise ValueError('Shape of array too small to calculate a numerical gradient, at least 3 elements are '
+                         'required.')
+
+    if out is None:
+        out = np.empty(arr.shape, dtype=arr.dtype)
+
     if derivative_type == '1st':
-        derivative = np.gradient(data, edge_order=2)
+        _gradient(arr, out)
     elif derivative_type == '2nd':
-        derivative = np.gradient(np.gradient(data, edge_order=2), edge_order=2)
+        if work is None:
+            work = np.empty(arr.shape, dtype=out.dtype)
+        _gradient(_gradient(arr, work), out)
     else:
         return
 
-    return derivative
+    return out
 
 
-@jit(nopython=True, nogil=True)
-def _ewma(arr_in, window: tuple, min_n=0,  infinite=False):
+@jit(nopython=True, nogil=True, cache=True)
+def _alpha(window: tuple):
+    """
+    :param window: ('span', value), ('com', value) or ('alpha', value) -- see _ewma
+    :return: the smoothing factor α
+    """
+    # Accounting for a center-of-mass adjustment so this can calculate RSI as well
+    if window[0] == 'span':
+        return 2 / float(window[1] + 1)
+    elif window[0] == 'com':
+        return 1 / float(window[1] + 1)
+    elif window[0] == 'alpha':
+        return float(window[1])
+
+    raise ValueError('Window not properly specified. Valid entries are span, com or alpha.')
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _ewma_step(x, alpha, num, den, infinite=False):
+    """
+    Carries the EWMA forward by one observation. Both the full-history kernel and the incremental updaters in
+    crypto.analytics.incremental go through this function so they produce identical results.
+
+    :param x: the new observation
+    :param alpha: the smoothing factor
+    :param num: the weighted sum of the observations so far (the last value when infinite=True)
+    :param den: the sum of the weights so far (always 1 when infinite=True)
+    :param infinite: see _ewma
+    :return: the updated (num, den); the EWMA is num / den
+    """
+    if infinite:
+        return x * alpha + num * (1 - alpha), 1.0
+
+    return x + num * (1 - alpha), 1 + den * (1 - alpha)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _ewma(arr_in, window: tuple, min_n=0, infinite=False, out=None):
     """
 
     :param arr_in: the input array -- must be a numpy array
@@ -29,41 +142,32 @@ def _ewma(arr_in, window: tuple, min_n=0,  infinite=False):
         com (center of mass) α=1/(1+com), for  com≥0
         or alpha (Specify smoothing factor α directly,  0<α≤1).
         valid entries are ('span', value), ('com', value), or ('alpha', value)
+    :param min_n: the number of observations required before a value is reported, earlier values are NaN
     :param infinite:
-            if False:
+            if True:
                 (i)  y[0] = x[0]; and
                 (ii) y[t] = a*x[t] + (1-a)*y[t-1] for t>0.
-            if True:
+            if False:
                 y[t] = (x[t] + (1-a)*x[t-1] + (1-a)^2*x[t-2] + ... + (1-a)^n*x[t-n]) /
                     (1 + (1-a) + (1-a)^2 + ... + (1-a)^n).
+    :param out: optional preallocated output buffer, same length as arr_in. A float32 buffer stores the result in
+        single precision
     :return:
         ewma: the exponential weighted moving average of the dataset
     """
     n = arr_in.shape[0]
-    ewma = np.empty(n, dtype=float64)
-
-    # Accounting for a center-of-mass adjustment so this can calculate RSI as well
-    if window[0] == 'span':
-        alpha = 2 / float(window[1] + 1)
-    elif window[0] == 'com':
-        alpha = 1 / float(window[1] + 1)
-    elif window[0] == 'alpha':
-        alpha = window[1]
-    else:
-        raise ValueError('Window not properly specified. It was set as {}.'.format(window))
+    ewma = _buffer(out, n)
+    if n == 0:
+        return ewma
 
-    ewma_old = arr_in[0]
-    ewma[0] = ewma_old
-    if not infinite:
-        w = 1
-        for i in range(0, n):
-            w += (1 - alpha) ** i
-            ewma_old = ewma_old * (1 - alpha) + arr_in[i]
-            ewma[i] = ewma_old / w
+    alpha = _alpha(window)
 
-    else:
-        for i in range(1, n):
-            ewma[i] = arr_in[i] * alpha + ewma[i - 1] * (1 - alpha)
+    num = float(arr_in[0])
+    den = 1.0
+    ewma[0] = num
+    for i in range(1, n):
+        num, den = _ewma_step(arr_in[i], alpha, num, den, infinite)
+        ewma[i] = num / den
 
     if min_n > 0:
         ewma[0:(min_n - 1)] = np.nan
@@ -71,30 +175,141 @@ def _ewma(arr_in, window: tuple, min_n=0,  infinite=False):
     return ewma
 
 
-@jit(nopython=True, nogil=True)
-def _rolling(arr, n, rolling_type='mean'):
+@jit(nopython=True, nogil=True, cache=True)
+def _window_moments(arr, prev, i, n):
+    """
+    :return: the count, mean and M2 of the non-missing values of the window of n observations ending at arr[i],
+        computed in two passes, the observations before arr[0] being taken from prev
     """
+    n_prev = prev.shape[0]
+    count = 0
+    total = 0.0
+    for j in range(i - n + 1, i + 1):
+        x = arr[j] if j >= 0 else prev[n_prev + j]
+        if not np.isnan(x):
+            count += 1
+            total += x
+    if count == 0:
+        return 0, 0.0, 0.0
+
+    avg = total / count
+    m2 = 0.0
+    for j in range(i - n + 1, i + 1):
+        x = arr[j] if j >= 0 else prev[n_prev + j]
+        if not np.isnan(x):
+            m2 += (x - avg) * (x - avg)
+
+    return count, avg, m2
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _rolling_moments_carry(arr, n, prev, state, mean, std):
+    """
+    The body of _rolling_moments with its accumulator passed in and out, so a series can be fed through it in
+    consecutive blocks (see crypto.analytics.chunked) with the same result as a single call.
+
+    :param arr: the next block of the input
+    :param n: the window of interest for the mean and the standard deviation
+    :param prev: the last (up to n) observations before this block, needed to drop them from the window
+    :param state: float64[5] of (count, n_nan, mean, M2, observations seen), updated in place
+    :param mean: output buffer for the rolling mean, same length as arr
+    :param std: output buffer for the rolling std, same length as arr
+    """
+    size = arr.shape[0]
+    n_prev = prev.shape[0]
+
+    count = int(state[0])
+    n_nan = int(state[1])
+    avg = state[2]
+    m2 = state[3]
+    seen = int(state[4])
+    for i in range(size):
+        x = arr[i]
+        if np.isnan(x):
+            n_nan += 1
+        else:
+            count += 1
+            d = x - avg
+            avg += d / count
+            m2 += d * (x - avg)
+
+        # Dropping the observation that just fell out of the window
+        if seen + i >= n:
+            y = arr[i - n] if i >= n else prev[n_prev + i - n]
+            if np.isnan(y):
+                n_nan -= 1
+            else:
+                count -= 1
+                if count == 0:
+                    avg = 0.0
+                    m2 = 0.0
+                else:
+                    d = y - avg
+                    avg -= d / count
+                    m2 -= d * (y - avg)
+                    if count == 1:
+                        m2 = 0.0
+
+        # The add/remove updates accumulate rounding error, far more so on values with a large offset, so the
+        # window is recomputed exactly once every n observations, which keeps the cost O(1) per observation
+        if seen + i >= n - 1 and (seen + i + 1) % n == 0:
+            count, avg, m2 = _window_moments(arr, prev, i, n)
+
+        # A window containing a missing value is treated as missing, same as the warm-up period
+        if seen + i < n - 1 or n_nan > 0:
+            mean[i] = np.nan
+            std[i] = np.nan
+        else:
+            mean[i] = avg
+            std[i] = np.sqrt(max(m2, 0.0) / count)
+
+    state[0] = count
+    state[1] = n_nan
+    state[2] = avg
+    state[3] = m2
+    state[4] = seen + size
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _rolling_moments(arr, n):
+    """
+    Rolling mean and standard deviation. The window is slid across the series with a Welford-style add/remove update
+    and recomputed exactly every n observations to shed the rounding error, so the cost is O(len(arr)) regardless of
+    the window size.
 
     :param arr: The input array
-    :param n: The window of interest for either the mean or the standard deviation
-    :param rolling_type: boolean to determine if the user wants to calculate the rolling mean or std devation
+    :param n: The window of interest for the mean and the standard deviation
     :return:
+        mean: the rolling mean, NaN until the window has filled
+        std: the rolling (population) standard deviation, NaN until the window has filled
     """
-    out = np.empty(n, dtype=float64)
-    out[0:n - 1] = np.nan
+    size = arr.shape[0]
+    mean = np.empty(size, dtype=float64)
+    std = np.empty(size, dtype=float64)
+    _rolling_moments_carry(arr, n, np.empty(0, dtype=float64), np.zeros(5, dtype=float64), mean, std)
 
-    for i in range(n, arr.shape[0] - 1):
-        if rolling_type == 'rolling_type':
-            out[i] = np.mean(arr[i - n: i])
+    return mean, std
 
-        elif rolling_type == 'std':
-            out[i] = np.std(arr[i - n: i])
 
-    return out
+@jit(nopython=True, nogil=True, cache=True)
+def _rolling(arr, n, rolling_type='mean'):
+    """
 
+    :param arr: The input array
+    :param n: The window of interest for either the mean or the standard deviation
+    :param rolling_type: either 'mean' or 'std' to determine if the user wants to calculate the rolling mean or
+        std deviation
+    :return:
+    """
+    mean, std = _rolling_moments(arr, n)
+    if rolling_type == 'std':
+        return std
 
-@jit(nopython=True, nogil=True)
-def _rsi(_open, _close, n: int):
+    return mean
+
+
+@jit(nopython=True, nogil=True, cache=True, error_model='numpy')
+def _rsi(_open, _close, n: int, out=None):
     """
     Recall that the equation for RSI is: RSI = 100 * (1 - 1/(1 + RS))
     WHERE RS = (Average of "Up" signals in last "N" trades)/(Average of "Down" Signals in last "N" trades)
@@ -109,32 +324,228 @@ def _rsi(_open, _close, n: int):
     Parameters
     ----------
     n : This is the period of interest for the Relative Strength Index
+    out : optional preallocated output buffer, same length as _open. A float32 buffer stores the result in single
+        precision
     Returns
     -------
     RSI_out : This is the Calculated RSI based on the equations provided
 
     """
-    # Extracting all the initial data we need to do our calculations
-    delta = (_close - _open)
+    size = _open.shape[0]
+    rsi_out = _buffer(out, size)
 
-    up_chg = 0 * delta
-    down_chg = 0 * delta
-    up_chg[delta > 0] = delta[delta > 0]
-    down_chg[delta < 0] = delta[delta < 0]
+    # The up/down split and both averages are carried as scalars, so no intermediate series are allocated
+    alpha = _alpha(('com', n - 1))
+    up_chg_avg = 0.0
+    down_chg_avg = 0.0
+    for i in range(size):
+        delta = _close[i] - _open[i]
+        up_chg = delta if delta > 0 else 0 * delta
+        down_chg = delta if delta < 0 else 0 * delta
 
-    up_chg_avg = _ewma(up_chg, n - 1, com=True, min_n=n, infinite=True)
-    down_chg_avg = _ewma(down_chg, n - 1, com=True, min_n=n, infinite=True)
+        if i == 0:
+            up_chg_avg = float(up_chg)
+            down_chg_avg = float(down_chg)
+        else:
+            up_chg_avg = _ewma_step(up_chg, alpha, up_chg_avg, 1.0, True)[0]
+            down_chg_avg = _ewma_step(down_chg, alpha, down_chg_avg, 1.0, True)[0]
 
-    rs = np.absolute(up_chg_avg / down_chg_avg)
+        if i < n - 1:
+            rsi_out[i] = np.nan
+        else:
+            rs = abs(up_chg_avg / down_chg_avg)
+            rsi_out[i] = 100 * (1 - (1 / (1 + rs)))
 
-    return 100 * (1 - (1 / (1 + rs)))
+    return rsi_out
 
 
 def _bollinger_bands(data, n: int):
+    mean, std = _rolling_moments(np.asarray(data, dtype=np.float64), n)
+    bollinger_band = {
+
+        'Upper': mean + 2 * std,
+        'Lower': mean - 2 * std,
+    }
+
+    return bollinger_band
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Batched (assets x time) variants. Each row of the input matrix is one asset and the rows are computed in parallel.
+# Rows may start with NaNs (coins listed after the start of the matrix); every row is warmed up from its own first
+# valid observation, so a row gives the same values as the 1-D kernel run over that coin's history alone.
+# ----------------------------------------------------------------------------------------------------------------------
+
+@jit(nopython=True, nogil=True, cache=True)
+def _first_valid(arr):
+    """
+    :param arr: a 1-D array
+    :return: the index of the first non-NaN value, or the length of the array if there is none
+    """
+    for i in range(arr.shape[0]):
+        if not np.isnan(arr[i]):
+            return i
+
+    return arr.shape[0]
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _gradient(arr, out=None):
+    """
+    np.gradient(arr, edge_order=2) for unit spacing, compiled so it can be called from the parallel kernels
+
+    :param arr: a 1-D array with at least 3 values
+    :param out: optional preallocated output buffer, same length as arr
+    :return: the 1st derivative of arr
+    """
+    n = arr.shape[0]
+    derivative = _buffer(out, n)
+    for i in range(1, n - 1):
+        derivative[i] = (arr[i + 1] - arr[i - 1]) / 2.0
+
+    derivative[0] = -1.5 * arr[0] + 2.0 * arr[1] + -0.5 * arr[2]
+    derivative[n - 1] = 0.5 * arr[n - 3] + -2.0 * arr[n - 2] + 1.5 * arr[n - 1]
+
+    return derivative
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _time_series_diff_2d(data, order, out, work):
+    n_assets, n = data.shape
+    for j in prange(n_assets):
+        start = _first_valid(data[j])
+        if n - start < 3:
+            out[j] = np.nan
+            continue
+
+        out[j, :start] = np.nan
+        if order == 2:
+            _gradient(_gradient(data[j, start:], work[j, start:]), out[j, start:])
+        else:
+            _gradient(data[j, start:], out[j, start:])
+
+    return out
+
+
+def time_series_diff_2d(data, derivative_type='1st', out=None, work=None):
+    """
+        :param data: (assets x time) matrix the user wants to determine the acceleration of
+        :param derivative_type: specifies the level of the derivative to be taken, either 1st or 2nd
+        :param out: optional preallocated output buffer, same shape as data
+        :param work: optional preallocated scratch buffer, same shape as data, used when derivative_type is 2nd
+        :return: The 1st or 2nd derivative of every row of the time-series data
+        """
+    if derivative_type == '1st':
+        order = 1
+    elif derivative_type == '2nd':
+        order = 2
+    else:
+        return
+
+    arr = _as_float(data)
+    if out is None:
+        out = np.empty(arr.shape, dtype=arr.dtype)
+    if work is None:
+        # Only read when taking the 2nd derivative
+        work = np.empty(arr.shape if order == 2 else (arr.shape[0], 0), dtype=out.dtype)
+
+    return _time_series_diff_2d(arr, order, out, work)
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _ewma_2d(arr_in, window: tuple, min_n=0, infinite=False, out=None):
+    """
+    :param arr_in: (assets x time) matrix
+    :param window: see _ewma
+    :param min_n: see _ewma, counted from each asset's first valid observation
+    :param infinite: see _ewma
+    :param out: optional preallocated output buffer, same shape as arr_in
+    :return: the exponential weighted moving average of every row
+    """
+    n_assets, n = arr_in.shape
+    ewma = _buffer(out, (n_assets, n))
+    for j in prange(n_assets):
+        start = _first_valid(arr_in[j])
+        ewma[j, :start] = np.nan
+        if start < n:
+            _ewma(arr_in[j, start:], window, min_n, infinite, ewma[j, start:])
+
+    return ewma
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _rsi_2d(_open, _close, n: int, out=None):
+    """
+    :param _open: (assets x time) matrix of opening prices
+    :param _close: (assets x time) matrix of closing prices
+    :param n: see _rsi
+    :param out: optional preallocated output buffer, same shape as _open
+    :return: the RSI of every row
+    """
+    n_assets, size = _open.shape
+    rsi = _buffer(out, (n_assets, size))
+    for j in prange(n_assets):
+        start = max(_first_valid(_open[j]), _first_valid(_close[j]))
+        rsi[j, :start] = np.nan
+        if start < size:
+            _rsi(_open[j, start:], _close[j, start:], n, rsi[j, start:])
+
+    return rsi
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _rolling_moments_2d(arr, n):
+    """
+    :param arr: (assets x time) matrix
+    :param n: see _rolling_moments
+    :return: the rolling mean and std of every row
+    """
+    n_assets, size = arr.shape
+    mean = np.empty((n_assets, size), dtype=float64)
+    std = np.empty((n_assets, size), dtype=float64)
+    for j in prange(n_assets):
+        mean[j], std[j] = _rolling_moments(arr[j], n)
+
+    return mean, std
+
+
+def _bollinger_bands_2d(data, n: int):
+    mean, std = _rolling_moments_2d(np.asarray(data, dtype=np.float64), n)
     bollinger_band = {
 
-        'Upper': _rolling(data, n, 'mean') + 2 * _rolling(data, n, 'std'),
-        'Lower': _rolling(data, n, 'mean') - 2 * _rolling(data, n, 'std'),
+        'Upper': mean + 2 * std,
+        'Lower': mean - 2 * std,
     }
 
     return bollinger_band
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Typed signatures of the Python-facing calls, compiled up front by crypto.analytics.warmup.warmup()
+# ----------------------------------------------------------------------------------------------------------------------
+_ARR_1D = (float64[::1], types.float32[::1])
+_ARR_2D = (float64[:, ::1], types.float32[:, ::1])
+_WINDOWS = (types.Tuple((types.unicode_type, int64)), types.Tuple((types.unicode_type, float64)))
+_NO_OUT = types.Omitted(None)
+
+for _window in _WINDOWS:
+    register(_alpha, (_window,))
+    for _arr, _kernel in ((_ARR_1D[0], _ewma), (_ARR_2D[0], _ewma_2d)):
+        register(_kernel,
+                 (_arr, _window, int64, boolean, _NO_OUT),
+                 (_arr, _window, int64, types.Omitted(False), _NO_OUT),
+                 (_arr, _window, types.Omitted(0), types.Omitted(False), _NO_OUT))
+    for _arr, _kernel in zip(_ARR_1D + _ARR_2D, (_ewma, _ewma, _ewma_2d, _ewma_2d)):
+        register(_kernel, (_arr, _window, int64, boolean, _arr))
+
+register(_ewma_step, (float64, float64, float64, float64, boolean))
+register(_rolling_moments, (_ARR_1D[0], int64))
+register(_rolling_moments_carry, (_ARR_1D[0], int64, _ARR_1D[0], _ARR_1D[0], _ARR_1D[0], _ARR_1D[0]))
+register(_rolling, (_ARR_1D[0], int64, types.unicode_type), (_ARR_1D[0], int64, types.Omitted('mean')))
+register(_rolling_moments_2d, (_ARR_2D[0], int64))
+for _arr in _ARR_1D:
+    register(_rsi, (_arr, _arr, int64, _NO_OUT), (_arr, _arr, int64, _arr))
+    register(_gradient, (_arr, _arr))
+for _arr in _ARR_2D:
+    register(_rsi_2d, (_arr, _arr, int64, _NO_OUT), (_arr, _arr, int64, _arr))
+    register(_time_series_diff_2d, (_arr, int64, _arr, _arr))
@@ -0,0 +1,132 @@
+import numpy as np
+
+from crypto.analytics.indicators import (_ewma, _ewma_2d, _rolling_moments, _rolling_moments_2d, time_series_diff,
+                                         time_series_diff_2d)
+
+
+class IndicatorPipeline:
+    """
+    Computes a declared set of indicators over a group of series, evaluating every shared intermediate (deltas,
+    rolling moments, EWMAs by window) once and reusing it for the rest of the run.
+
+    Usage:
+        pipeline = IndicatorPipeline({'open': _open, 'close': _close, 'market_cap': market_cap})
+        results = pipeline.compute([
+            ('ewma', 'market_cap', ('span', 30)),
+            ('volatility', 'market_cap', ('span', 30)),
+            ('rsi', 'open', 'close', 14),
+            ('bollinger_bands', 'close', 20),
+        ])
+        pipeline.stats  # {'requested': 9, 'evaluated': 8, 'saved': 1}, the EWMA is shared with the volatility
+
+    Every series may be either a 1-D array or an (assets x time) matrix; matrices go through the batched kernels.
+    """
+
+    def __init__(self, series: dict):
+        """
+        :param series: a dict of {name: array} of the inputs the indicators are declared against
+        """
+        self.series = {name: np.asarray(arr, dtype=np.float64) for name, arr in series.items()}
+        self._cache = {}
+        self.requested = 0
+        self.evaluated = 0
+
+    @property
+    def stats(self):
+        """
+        :return: the number of kernel evaluations requested, the number actually run and the number saved by the
+            cache
+        """
+        return {'requested': self.requested, 'evaluated': self.evaluated, 'saved': self.requested - self.evaluated}
+
+    def _node(self, key, kernel, *args):
+        self.requested += 1
+        if key not in self._cache:
+            self.evaluated += 1
+            self._cache[key] = kernel(*args)
+
+        return self._cache[key]
+
+    # Intermediates ----------------------------------------------------------------------------------------------------
+    def delta(self, _open, _close):
+        return self._node(('delta', _open, _close), np.subtract, self.series[_close], self.series[_open])
+
+    def up_down(self, _open, _close):
+        """
+        :return: the "Up" and "Down" moves of the delta between _open and _close, as split by _rsi
+        """
+        def kernel(delta):
+            return np.where(delta > 0, delta, 0 * delta), np.where(delta < 0, delta, 0 * delta)
+
+        return self._node(('up_down', _open, _close), kernel, self.delta(_open, _close))
+
+    def square(self, field):
+        return self._node(('square', field), np.square, self.series[field])
+
+    def ewma(self, field, window: tuple, min_n=0, infinite=False):
+        """
+        :param field: the name of the series, or a (name, array) pair for a derived series
+        :return: see _ewma
+        """
+        name, arr = field if isinstance(field, tuple) else (field, self.series[field])
+        kernel = _ewma_2d if arr.ndim == 2 else _ewma
+        return self._node(('ewma', name, window, min_n, infinite), kernel, arr, window, min_n, infinite)
+
+    def rolling_moments(self, field, n: int):
+        arr = self.series[field]
+        kernel = _rolling_moments_2d if arr.ndim == 2 else _rolling_moments
+        return self._node(('rolling_moments', field, n), kernel, arr, n)
+
+    # Indicators -------------------------------------------------------------------------------------------------------
+    def rsi(self, _open, _close, n: int):
+        """
+        :return: see _rsi
+        """
+        up_chg, down_chg = self.up_down(_open, _close)
+        up_chg_avg = self.ewma((('up', _open, _close), up_chg), ('com', n - 1), n, True)
+        down_chg_avg = self.ewma((('down', _open, _close), down_chg), ('com', n - 1), n, True)
+
+        rs = np.absolute(up_chg_avg / down_chg_avg)
+
+        return 100 * (1 - (1 / (1 + rs)))
+
+    def volatility(self, field, window: tuple):
+        """
+        The exponentially weighted standard deviation, sqrt(EWMA(x^2) - EWMA(x)^2)
+
+        :return: the EWMA volatility of the series
+        """
+        mean = self.ewma(field, window)
+        mean_sq = self.ewma((('square', field), self.square(field)), window)
+
+        return np.sqrt(np.maximum(mean_sq - mean ** 2, 0))
+
+    def bollinger_bands(self, field, n: int):
+        mean, std = self.rolling_moments(field, n)
+        bollinger_band = {
+
+            'Upper': mean + 2 * std,
+            'Lower': mean - 2 * std,
+        }
+
+        return bollinger_band
+
+    def diff(self, field, derivative_type='1st'):
+        arr = self.series[field]
+        kernel = time_series_diff_2d if arr.ndim == 2 else time_series_diff
+        return self._node(('diff', field, derivative_type), kernel, arr, derivative_type)
+
+    def compute(self, indicators):
+        """
+        :param indicators: an iterable of indicator declarations, each a tuple of the method name followed by its
+            arguments, e.g. ('ewma', 'market_cap', ('span', 30)) or ('rsi', 'open', 'close', 14)
+        :return: a dict of {declaration: result}
+        """
+        results = {}
+        for declaration in indicators:
+            name, args = declaration[0], declaration[1:]
+            if name not in ('ewma', 'rolling_moments', 'rsi', 'volatility', 'bollinger_bands', 'diff', 'delta'):
+                raise ValueError('Unknown indicator {}.'.format(name))
+            results[declaration] = getattr(self, name)(*args)
+
+        return results
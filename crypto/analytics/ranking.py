@@ -0,0 +1,129 @@
+"""
+Index ranking: the top-N coins by ewma_market_cap, weighted by market cap within caps and floors, written to
+index_ranking.
+
+Everything runs on whole-universe arrays: the latest running averages come out of crypto.db.query as arrays, the
+selection is one argsort and the cap/floor redistribution is solved for the fixed point of the redistribution passes
+with one sort and a searchsorted over the breakpoints, so it costs a few vector operations whatever the universe
+size and however many coins hit their cap:
+
+    weights = index_weights(ewma_market_cap, top_n=20, cap=0.25, floor=0.01)
+    rank_index(engine, top_n=20, cap=0.25)  # {'rows': 20, 'load_date': ..., 'seconds': 0.004}
+"""
+import time
+
+import numpy as np
+
+from crypto.db.models import CryptoRunningAverages, IndexRanking
+from crypto.db.query import latest_per_coin
+from crypto.db.upsert import upsert
+
+
+def _capped(base, cap, floor):
+    """
+    Redistributes the weight over the cap and under the floor: every coin gets clip(s * base, floor, cap), with the
+    scale s that makes the weights sum to 1. The excess of the capped coins thereby goes to the others in proportion to
+    their base weights, as repeated redistribution passes would converge to, and so does the shortfall of the floored
+    ones.
+
+    :param base: the uncapped weights, summing to 1
+    :return: the weights
+    """
+    n = base.shape[0]
+    if n * floor > 1 + 1e-12 or n * cap < 1 - 1e-12:
+        raise ValueError('{} coins cannot be weighted within [{}, {}].'.format(n, floor, cap))
+    if floor >= cap:
+        return np.full(n, 1.0 / n)
+
+    # The total weight is piecewise linear and non-decreasing in s, with a breakpoint wherever a coin reaches its cap
+    # or leaves its floor, and the coins capped and floored at s are a suffix and a prefix of the ascending weights
+    ascending = np.sort(base)
+    cumulative = np.r_[0.0, np.cumsum(ascending)]
+
+    def split(scale):
+        n_floored = np.searchsorted(ascending, floor / scale, side='right') if floor > 0 else np.zeros_like(scale,
+                                                                                                         dtype=int)
+        n_uncapped = np.searchsorted(ascending, cap / scale, side='left')
+        return n_floored, n_uncapped
+
+    breakpoints = np.unique(np.r_[cap / ascending, floor / ascending if floor > 0 else []])
+    n_floored, n_uncapped = split(breakpoints)
+    total = (cap * (n - n_uncapped) + floor * n_floored +
+             breakpoints * (cumulative[n_uncapped] - cumulative[n_floored]))
+
+    # Between the breakpoint before the crossing of 1 and the one after, the capped and floored coins are fixed
+    j = min(np.searchsorted(total, 1.0), breakpoints.shape[0] - 1)
+    lo = breakpoints[j - 1] if j > 0 else 0.0
+    n_floored, n_uncapped = split(np.array([(lo + breakpoints[j]) / 2]))
+    free = cumulative[n_uncapped[0]] - cumulative[n_floored[0]]
+    if free > 0:
+        scale = (1 - cap * (n - n_uncapped[0]) - floor * n_floored[0]) / free
+    else:
+        scale = breakpoints[j]
+
+    return np.clip(base * scale, floor, cap)
+
+
+def index_weights(market_cap, top_n, cap=1.0, floor=0.0):
+    """
+    :param market_cap: the market cap of every coin of the universe, NaN or <= 0 for coins that cannot be held
+    :param top_n: the number of coins in the index
+    :param cap: the maximum weight of a coin, the excess being redistributed to the others
+    :param floor: the minimum weight of a coin, taken from the others
+    :return: the ranking (1 = largest, 0 = out of the index) and the weight of every coin, aligned with market_cap
+    """
+    market_cap = np.asarray(market_cap, dtype=np.float64)
+    ranking = np.zeros(market_cap.shape[0], dtype=np.int64)
+    weights = np.zeros(market_cap.shape[0], dtype=np.float64)
+
+    eligible = np.flatnonzero(np.isfinite(market_cap) & (market_cap > 0))
+    # Ties are broken by position, i.e. by crypto_id for arrays from crypto.db.query
+    selected = eligible[np.argsort(-market_cap[eligible], kind='stable')[:top_n]]
+    if selected.shape[0] == 0:
+        return ranking, weights
+
+    base = market_cap[selected] / market_cap[selected].sum()
+    ranking[selected] = np.arange(1, selected.shape[0] + 1)
+    weights[selected] = _capped(base, cap, floor)
+
+    return ranking, weights
+
+
+def rank_index(engine, top_n=10, cap=1.0, floor=0.0, as_of=None, max_age=None):
+    """
+    Ranks the latest running averages of the universe and writes the index to index_ranking, replacing any index
+    already ranked at the same load_date, in one transaction
+
+    :param engine: the SQLAlchemy engine
+    :param top_n: see index_weights
+    :param cap: see index_weights
+    :param floor: see index_weights
+    :param as_of: rank as of this time, the latest running averages when None
+    :param max_age: leave out coins whose latest running average is older than this timedelta before the newest one
+    :return: a dict with the number of rows written, the load_date of the ranking and the elapsed seconds
+    """
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        latest = latest_per_coin(conn, CryptoRunningAverages, ['ewma_market_cap'], as_of=as_of)
+        if latest['crypto_id'].shape[0] == 0:
+            return {'rows': 0, 'load_date': None, 'seconds': time.perf_counter() - start}
+
+        # The ranking is stamped with the newest snapshot it was computed from
+        load_date = latest['load_date'].max()
+        market_cap = latest['ewma_market_cap']
+        if max_age is not None:
+            market_cap = np.where(latest['load_date'] >= load_date - np.timedelta64(max_age), market_cap, np.nan)
+
+        ranking, weights = index_weights(market_cap, top_n, cap, floor)
+        selected = np.flatnonzero(ranking)
+        rows = [{'crypto_id': crypto_id, 'load_date': load_date.item(), 'index_ranking': rank,
+                 'index_percentage': weight}
+                for crypto_id, rank, weight in zip(latest['crypto_id'][selected].tolist(),
+                                                   ranking[selected].tolist(), weights[selected].tolist())]
+        # A re-ranking of the same load_date, e.g. with another top_n, replaces the whole index rather than only the
+        # coins still in it
+        table = IndexRanking.__table__
+        conn.execute(table.delete().where(table.c.load_date == load_date.item()))
+        upsert(conn, table, rows)
+
+    return {'rows': len(rows), 'load_date': load_date.item(), 'seconds': time.perf_counter() - start}
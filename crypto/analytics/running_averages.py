@@ -0,0 +1,210 @@
+"""
+Keeps running_averages up to date with market_data.
+
+Each coin carries one persisted EWMA state per field in indicator_state, so an update only reads the market_data rows
+after the state's load_date, runs them through the _ewma kernel from where the state left off and writes one
+running_averages row per new snapshot. rebuild_running_averages() throws the states of some coins away and replays
+their whole history, e.g. after a backfill wrote rows behind the states.
+
+    update_running_averages(engine)                       # every ingest tick
+    rebuild_running_averages(engine, crypto_ids=[1, 2])   # after a backfill of coins 1 and 2
+"""
+import numpy as np
+import sqlalchemy as db
+
+from crypto.analytics.chunked import _ewma_carry
+from crypto.analytics.incremental import EWMAState
+from crypto.db.models import CryptoRunningAverages, IndicatorState, MarketData
+from crypto.db.query import rows_since
+from crypto.db.upsert import upsert
+
+# running_averages column -> the market_data column it averages
+FIELDS = {
+    'ewma_market_cap': 'market_cap',
+    'ewma_market_cap_percentage': 'market_cap_percentage',
+    'ewma_trade_price': 'trade_price',
+    'ewma_ranking': 'ranking',
+}
+# The state of EWMA(trade_price^2), which with ewma_trade_price gives ewma_volatility
+SQUARED_PRICE = 'trade_price^2'
+
+DEFAULT_WINDOW = ('span', 30)
+
+
+def _state_filter(window, min_n, infinite):
+    table = IndicatorState.__table__
+    return ((table.c.indicator == EWMAState.indicator) & (table.c.window_type == window[0]) &
+            (table.c.window_value == float(window[1])) & (table.c.min_n == min_n) & (table.c.infinite == infinite) &
+            table.c.field.in_(list(FIELDS.values()) + [SQUARED_PRICE]))
+
+
+def _load_states(conn, window, min_n, infinite, crypto_ids=None):
+    """
+    :return: a dict of {crypto_id: {field: (EWMAState, state row id, load_date)}}
+    """
+    table = IndicatorState.__table__
+    stmt = db.select(table).where(_state_filter(window, min_n, infinite))
+    if crypto_ids is not None:
+        stmt = stmt.where(table.c.crypto_id.in_([int(_id) for _id in crypto_ids]))
+
+    states = {}
+    for row in conn.execute(stmt):
+        if row.last_value is None:
+            # A NaN state (NULL in the database) was poisoned by a NULL observation before those were skipped. It
+            # restarts from the next observation; rebuild_running_averages() recovers its history
+            state = EWMAState(window, min_n, infinite)
+        else:
+            state = EWMAState(window, min_n, infinite, row.n_obs, row.last_value, row.weight_sum)
+        states.setdefault(row.crypto_id, {})[row.field] = (state, row.id, row.load_date)
+
+    return states
+
+
+def _watermark(coin_states):
+    # Every field of a coin is advanced together, so they share the load_date of the last row folded in
+    dates = [load_date for _, _, load_date in coin_states.values()]
+    return min(dates) if dates else None
+
+
+def _fold(state, values):
+    """
+    Runs values through _ewma from where state left off. A missing (NULL) observation leaves the state as it is and
+    repeats the last EWMA, NaN until the first observation.
+
+    :return: the EWMA at each value
+    """
+    observed = ~np.isnan(values)
+    before = state.value
+    folded = np.empty(int(observed.sum()), dtype=np.float64)
+    if folded.shape[0]:
+        state.last_value, state.weight_sum = _ewma_carry(values[observed], state.alpha, float(state.last_value),
+                                                         float(state.weight_sum), state.n_obs, state.min_n,
+                                                         state.infinite, folded)
+        state.n_obs += folded.shape[0]
+
+    # Each value takes the EWMA of the last observation at or before it
+    last = np.cumsum(observed) - 1
+    return np.where(last >= 0, np.r_[folded, np.nan][last], before)
+
+
+def _state_row(state, crypto_id, field, load_date):
+    return {
+        'crypto_id': crypto_id,
+        'load_date': load_date,
+        'field': field,
+        'indicator': state.indicator,
+        'window_type': state.window[0],
+        'window_value': float(state.window[1]),
+        'infinite': state.infinite,
+        'min_n': state.min_n,
+        'n_obs': state.n_obs,
+        'last_value': state.last_value,
+        'weight_sum': state.weight_sum,
+    }
+
+
+def _update(conn, window, min_n, infinite, crypto_ids=None):
+    states = _load_states(conn, window, min_n, infinite, crypto_ids)
+
+    # A coin with no state yet needs its whole history
+    requested = states.keys() if crypto_ids is None else crypto_ids
+    watermarks = [_watermark(states[_id]) if _id in states else None for _id in requested]
+    since = min(watermarks) if watermarks and None not in watermarks else None
+
+    arrays = rows_since(conn, MarketData, list(FIELDS.values()), since, crypto_ids)
+    ids = arrays['crypto_id']
+    bounds = np.flatnonzero(np.diff(ids)) + 1
+
+    averages, state_rows, new_states = [], [], []
+    for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, ids.shape[0]]):
+        if lo == hi:
+            continue
+        crypto_id = int(ids[lo])
+        coin_states = states.get(crypto_id, {})
+
+        # The shared lower bound may reach behind this coin's own watermark
+        dates = arrays['load_date'][lo:hi]
+        watermark = _watermark(coin_states)
+        start = lo + (np.searchsorted(dates, np.datetime64(watermark, 'us'), side='right') if watermark else 0)
+        if start == hi:
+            continue
+
+        series = [(field, arrays[field][start:hi]) for field in FIELDS.values()]
+        series.append((SQUARED_PRICE, arrays['trade_price'][start:hi] ** 2))
+        load_date = arrays['load_date'][hi - 1].item()
+
+        averaged = {}
+        for field, values in series:
+            state, state_id, _ = coin_states.get(field, (EWMAState(window, min_n, infinite), None, None))
+            averaged[field] = _fold(state, values)
+
+            row = _state_row(state, crypto_id, field, load_date)
+            if state_id is None:
+                new_states.append(row)
+            else:
+                state_rows.append(dict(row, _id=state_id))
+
+        columns = {'crypto_id': np.full(hi - start, crypto_id), 'load_date': arrays['load_date'][start:hi]}
+        columns.update({column: averaged[field] for column, field in FIELDS.items()})
+        columns['ewma_volatility'] = np.sqrt(np.maximum(averaged[SQUARED_PRICE] - columns['ewma_trade_price'] ** 2, 0))
+        columns['ewma_ranking'] = np.round(columns['ewma_ranking'])
+        averages.extend(_rows(columns))
+
+    upsert(conn, CryptoRunningAverages.__table__, averages)
+    table = IndicatorState.__table__
+    if state_rows:
+        conn.execute(table.update().where(table.c.id == db.bindparam('_id')), state_rows)
+    if new_states:
+        conn.execute(table.insert(), new_states)
+
+    return {'coins': len(set(row['crypto_id'] for row in averages)), 'rows': len(averages)}
+
+
+def _rows(columns):
+    names = list(columns)
+    values = [columns[name].tolist() for name in names]
+    return [{name: None if value != value else value for name, value in zip(names, row)} for row in zip(*values)]
+
+
+def update_running_averages(engine, crypto_ids=None, window=DEFAULT_WINDOW, min_n=0, infinite=False):
+    """
+    Folds the market_data rows newer than each coin's state into running_averages, in one transaction
+
+    :param engine: the SQLAlchemy engine
+    :param crypto_ids: only update these coins; all coins with a state, plus any new coin loaded after the oldest state,
+        when None
+    :param window: see _ewma
+    :param min_n: see _ewma
+    :param infinite: see _ewma
+    :return: a dict with the number of coins and running_averages rows written
+    """
+    with engine.begin() as conn:
+        return _update(conn, window, min_n, infinite, crypto_ids)
+
+
+def rebuild_running_averages(engine, crypto_ids, window=DEFAULT_WINDOW, min_n=0, infinite=False, batch_coins=100):
+    """
+    Recomputes running_averages over the full history of some coins, a batch of coins per transaction
+
+    :param engine: the SQLAlchemy engine
+    :param crypto_ids: the coins to rebuild
+    :param window: see _ewma
+    :param min_n: see _ewma
+    :param infinite: see _ewma
+    :param batch_coins: the number of coins whose history is held in memory at once
+    :return: a dict with the number of coins and running_averages rows written
+    """
+    crypto_ids = sorted(int(_id) for _id in crypto_ids)
+    totals = {'coins': 0, 'rows': 0}
+    for i in range(0, len(crypto_ids), batch_coins):
+        batch = crypto_ids[i:i + batch_coins]
+        with engine.begin() as conn:
+            conn.execute(IndicatorState.__table__.delete().where(
+                _state_filter(window, min_n, infinite) & IndicatorState.__table__.c.crypto_id.in_(batch)))
+            conn.execute(CryptoRunningAverages.__table__.delete().where(
+                CryptoRunningAverages.__table__.c.crypto_id.in_(batch)))
+
+            for key, n in _update(conn, window, min_n, infinite, batch).items():
+                totals[key] += n
+
+    return totals
@@ -0,0 +1,162 @@
+import numpy as np
+from numba import jit, prange
+from numba import float64, int64, boolean, types
+
+from crypto.analytics.indicators import _alpha, _as_float, _buffer, _ewma_step, _first_valid
+from crypto.analytics.warmup import register
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _ewma_sweep(arr_in, alphas, min_n=0, infinite=False, out=None):
+    """
+    Evaluates _ewma at several smoothing factors in a single traversal of the input
+
+    :param arr_in: the input array
+    :param alphas: the smoothing factors, one per output row
+    :param min_n: see _ewma
+    :param infinite: see _ewma
+    :param out: optional preallocated (len(alphas) x len(arr_in)) output buffer
+    :return: (len(alphas) x len(arr_in)) matrix, row k is _ewma at alphas[k]
+    """
+    n = arr_in.shape[0]
+    n_alphas = alphas.shape[0]
+    ewma = _buffer(out, (n_alphas, n))
+    if n == 0:
+        return ewma
+
+    num = np.empty(n_alphas, dtype=float64)
+    den = np.empty(n_alphas, dtype=float64)
+    for k in range(n_alphas):
+        num[k] = float(arr_in[0])
+        den[k] = 1.0
+        ewma[k, 0] = num[k]
+
+    for i in range(1, n):
+        x = arr_in[i]
+        for k in range(n_alphas):
+            num[k], den[k] = _ewma_step(x, alphas[k], num[k], den[k], infinite)
+            ewma[k, i] = num[k] / den[k]
+
+    if min_n > 0:
+        ewma[:, 0:(min_n - 1)] = np.nan
+
+    return ewma
+
+
+@jit(nopython=True, nogil=True, cache=True, error_model='numpy')
+def _rsi_sweep(_open, _close, ns, out=None):
+    """
+    Evaluates _rsi at several periods in a single traversal of the input
+
+    :param _open: the opening prices
+    :param _close: the closing prices
+    :param ns: the periods of interest, one per output row
+    :param out: optional preallocated (len(ns) x len(_open)) output buffer
+    :return: (len(ns) x len(_open)) matrix, row k is _rsi at ns[k]
+    """
+    size = _open.shape[0]
+    n_periods = ns.shape[0]
+    rsi_out = _buffer(out, (n_periods, size))
+
+    alphas = np.empty(n_periods, dtype=float64)
+    for k in range(n_periods):
+        alphas[k] = _alpha(('com', ns[k] - 1))
+    up_chg_avg = np.zeros(n_periods, dtype=float64)
+    down_chg_avg = np.zeros(n_periods, dtype=float64)
+
+    for i in range(size):
+        delta = _close[i] - _open[i]
+        up_chg = delta if delta > 0 else 0 * delta
+        down_chg = delta if delta < 0 else 0 * delta
+
+        for k in range(n_periods):
+            if i == 0:
+                up_chg_avg[k] = up_chg
+                down_chg_avg[k] = down_chg
+            else:
+                up_chg_avg[k] = _ewma_step(up_chg, alphas[k], up_chg_avg[k], 1.0, True)[0]
+                down_chg_avg[k] = _ewma_step(down_chg, alphas[k], down_chg_avg[k], 1.0, True)[0]
+
+            if i < ns[k] - 1:
+                rsi_out[k, i] = np.nan
+            else:
+                rs = abs(up_chg_avg[k] / down_chg_avg[k])
+                rsi_out[k, i] = 100 * (1 - (1 / (1 + rs)))
+
+    return rsi_out
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _ewma_sweep_2d(arr_in, alphas, min_n, infinite, out):
+    n_assets, n = arr_in.shape
+    for j in prange(n_assets):
+        start = _first_valid(arr_in[j])
+        out[j, :, :start] = np.nan
+        if start < n:
+            _ewma_sweep(arr_in[j, start:], alphas, min_n, infinite, out[j, :, start:])
+
+    return out
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def _rsi_sweep_2d(_open, _close, ns, out):
+    n_assets, size = _open.shape
+    for j in prange(n_assets):
+        start = max(_first_valid(_open[j]), _first_valid(_close[j]))
+        out[j, :, :start] = np.nan
+        if start < size:
+            _rsi_sweep(_open[j, start:], _close[j, start:], ns, out[j, :, start:])
+
+    return out
+
+
+def ewma_sweep(data, windows, window_type='span', min_n=0, infinite=False, out=None):
+    """
+    :param data: a 1-D series, or an (assets x time) matrix
+    :param windows: the spans, coms or alphas to evaluate, e.g. (7, 14, 30, 90, 200)
+    :param window_type: 'span', 'com' or 'alpha' -- see _ewma
+    :param min_n: see _ewma, counted from each asset's first valid observation for a matrix
+    :param infinite: see _ewma
+    :param out: optional preallocated output buffer, (windows x time) or (assets x windows x time)
+    :return: the EWMA of the data at every window, (windows x time) or (assets x windows x time)
+    """
+    arr = _as_float(data)
+    alphas = np.array([_alpha((window_type, float(window))) for window in windows], dtype=np.float64)
+    if arr.ndim == 1:
+        return _ewma_sweep(arr, alphas, min_n, infinite, out)
+
+    if out is None:
+        out = np.empty((arr.shape[0], alphas.shape[0], arr.shape[1]), dtype=np.float64)
+    return _ewma_sweep_2d(arr, alphas, min_n, infinite, out)
+
+
+def rsi_sweep(_open, _close, periods, out=None):
+    """
+    :param _open: the opening prices, a 1-D series or an (assets x time) matrix
+    :param _close: the closing prices, same shape as _open
+    :param periods: the RSI periods to evaluate, e.g. (7, 14, 30)
+    :param out: optional preallocated output buffer, (periods x time) or (assets x periods x time)
+    :return: the RSI at every period, (periods x time) or (assets x periods x time)
+    """
+    _open, _close = _as_float(_open), _as_float(_close)
+    ns = np.asarray(periods, dtype=np.int64)
+    if _open.ndim == 1:
+        return _rsi_sweep(_open, _close, ns, out)
+
+    if out is None:
+        out = np.empty((_open.shape[0], ns.shape[0], _open.shape[1]), dtype=np.float64)
+    return _rsi_sweep_2d(_open, _close, ns, out)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Typed signatures of the Python-facing calls, compiled up front by crypto.analytics.warmup.warmup()
+# ----------------------------------------------------------------------------------------------------------------------
+for _arr, _out, _out_3d in ((float64[::1], float64[:, ::1], float64[:, :, ::1]),
+                            (types.float32[::1], types.float32[:, ::1], types.float32[:, :, ::1])):
+    register(_ewma_sweep, (_arr, float64[::1], int64, boolean, _out))
+    register(_rsi_sweep, (_arr, _arr, int64[::1], _out))
+    register(_ewma_sweep_2d, (_out, float64[::1], int64, boolean, _out_3d))
+    register(_rsi_sweep_2d, (_out, _out, int64[::1], _out_3d))
+
+register(_ewma_sweep, (float64[::1], float64[::1], int64, boolean, types.none))
+register(_rsi_sweep, (float64[::1], float64[::1], int64[::1], types.none))
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from numpy.lib.stride_tricks import sliding_window_view
+
+from crypto.analytics.chunked import chunked_rolling_moments
+from crypto.analytics.indicators import Workspace, _bollinger_bands, _rolling_moments
+
+WINDOWS = (1, 2, 5, 20, 64)
+
+
+def _series(length, offset, seed=0):
+    # A random walk with leading and interior NaNs
+    rng = np.random.default_rng(seed)
+    series = np.cumsum(rng.normal(0, 1, length)) + offset
+    series[:7] = np.nan
+    series[rng.choice(np.arange(7, length), length // 50, replace=False)] = np.nan
+    return series
+
+
+def _reference(series, n):
+    # Population mean and standard deviation of every full window, NaN for a window holding a NaN
+    mean, std = np.full(series.shape[0], np.nan), np.full(series.shape[0], np.nan)
+    windows = sliding_window_view(series, n)
+    mean[n - 1:] = windows.mean(axis=1)
+    std[n - 1:] = windows.std(axis=1)
+    return mean, std
+
+
+@pytest.mark.parametrize('n', WINDOWS)
+@pytest.mark.parametrize('offset', [0.0, 1e4, 1e9])
+def test_rolling_moments_match_sliding_window(n, offset):
+    series = _series(20000, offset)
+    mean, std = _rolling_moments(series, n)
+    expected_mean, expected_std = _reference(series, n)
+
+    np.testing.assert_array_equal(np.isnan(mean), np.isnan(expected_mean))
+    np.testing.assert_array_equal(np.isnan(std), np.isnan(expected_std))
+    # The rounding of the values themselves bounds what any method can recover, relative to their magnitude
+    scale = np.nanmax(np.abs(series))
+    np.testing.assert_allclose(mean, expected_mean, rtol=1e-12, atol=1e-13 * scale, equal_nan=True)
+    np.testing.assert_allclose(std, expected_std, rtol=1e-9, atol=1e-11 * scale, equal_nan=True)
+
+
+@pytest.mark.parametrize('n', WINDOWS)
+def test_bollinger_bands_match_sliding_window(n):
+    series = _series(5000, 1e4, seed=1)
+    bands = _bollinger_bands(series, n)
+    mean, std = _reference(series, n)
+
+    np.testing.assert_allclose(bands['Upper'], mean + 2 * std, rtol=1e-12, equal_nan=True)
+    np.testing.assert_allclose(bands['Lower'], mean - 2 * std, rtol=1e-12, equal_nan=True)
+
+
+def test_long_series_does_not_drift():
+    series = np.cumsum(np.random.default_rng(2).normal(0, 1, 2000000)) + 1e9
+    n = 50
+    _, std = _rolling_moments(series, n)
+    tail = series[-1000 - n + 1:]
+
+    np.testing.assert_allclose(std[-1000:], sliding_window_view(tail, n).std(axis=1), rtol=1e-5)
+
+
+def test_chunked_matches_single_call():
+    series = _series(10000, 1e9, seed=3)
+    mean, std = _rolling_moments(series, 20)
+    chunks = list(chunked_rolling_moments(np.array_split(series, 13), 20))
+
+    np.testing.assert_array_equal(np.concatenate([chunk[0] for chunk in chunks]), mean)
+    np.testing.assert_array_equal(np.concatenate([chunk[1] for chunk in chunks]), std)
+
+
+@pytest.mark.parametrize('shape', [[3, 4], (3, 4), np.array([3, 4]), (np.int64(3), 4)])
+def test_workspace_reuses_the_buffer_whatever_the_shape_type(shape):
+    workspace = Workspace()
+    buffer = workspace.get('x', (3, 4))
+
+    assert workspace.get('x', shape) is buffer
+    assert workspace.get('y', 5) is workspace.get('y', [5])
+    assert workspace.get('x', [4, 3]).shape == (4, 3)
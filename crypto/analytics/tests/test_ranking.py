@@ -0,0 +1,48 @@
+import datetime as dt
+
+import numpy as np
+import pytest
+
+from crypto.analytics.ranking import index_weights, rank_index
+from crypto.db.database import dispose, get_engine
+from crypto.db.models import CryptoCurrencies, CryptoRunningAverages
+from crypto.db.upsert import upsert
+from crypto.purchasing.rebalance import targets
+
+LOAD_DATE = dt.datetime(2024, 1, 1)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    url = 'sqlite:///{}'.format(tmp_path / 'crypto_index.db')
+    engine = get_engine(url)
+    with engine.begin() as conn:
+        conn.execute(CryptoCurrencies.__table__.insert(), [{'symbol': 'C{}'.format(i)} for i in range(5)])
+        upsert(conn, CryptoRunningAverages.__table__, [
+            {'crypto_id': i + 1, 'load_date': LOAD_DATE, 'ewma_market_cap': cap}
+            for i, cap in enumerate([500.0, 400.0, 300.0, 200.0, 100.0])])
+    yield engine
+    dispose(url)
+
+
+def test_index_weights_respect_the_cap_and_floor():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        market_cap = rng.lognormal(0, 3, 50)
+        market_cap[rng.random(50) < 0.1] = np.nan
+        ranking, weights = index_weights(market_cap, 20, cap=0.1, floor=0.02)
+
+        assert np.count_nonzero(ranking) == 20
+        assert weights.sum() == pytest.approx(1.0)
+        assert weights[ranking > 0].max() <= 0.1 + 1e-12
+        assert weights[ranking > 0].min() >= 0.02 - 1e-12
+
+
+def test_reranking_a_load_date_replaces_the_index(engine):
+    rank_index(engine, top_n=3)
+    rank_index(engine, top_n=2)
+
+    with engine.connect() as conn:
+        crypto_ids, weights = targets(conn)
+    assert crypto_ids.tolist() == [1, 2]
+    assert weights.sum() == pytest.approx(1.0)
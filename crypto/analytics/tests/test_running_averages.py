@@ -0,0 +1,66 @@
+import datetime as dt
+
+import numpy as np
+import pytest
+import sqlalchemy as db
+
+from crypto.analytics.indicators import _ewma
+from crypto.analytics.running_averages import rebuild_running_averages, update_running_averages
+from crypto.db.database import dispose, get_engine
+from crypto.db.loader import MarketDataLoader
+
+START = dt.datetime(2024, 1, 1)
+PERCENTAGES = [None, 1.0, None, 2.0, None, None, 4.0, 3.0, None, 5.0]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    url = 'sqlite:///{}'.format(tmp_path / 'crypto_index.db')
+    yield get_engine(url)
+    dispose(url)
+
+
+def _quote(i, percentage):
+    return {'symbol': 'BTC', 'name': 'Bitcoin', 'load_date': START + dt.timedelta(minutes=i), 'trade_price': 100.0 + i,
+            'market_cap': 1000 + i, 'market_cap_percentage': percentage, 'ranking': 1}
+
+
+def _averages(engine):
+    with engine.connect() as conn:
+        rows = conn.execute(db.text('SELECT ewma_market_cap_percentage, ewma_trade_price FROM running_averages '
+                                    'ORDER BY load_date')).all()
+    return np.array([np.nan if value is None else value for value, _ in rows]), np.array([value for _, value in rows])
+
+
+def _expected():
+    # The EWMA of the observations so far at every tick, NaN before the first one
+    expected = []
+    for i in range(len(PERCENTAGES)):
+        observed = np.array([value for value in PERCENTAGES[:i + 1] if value is not None])
+        expected.append(_ewma(observed, ('span', 30.0))[-1] if observed.shape[0] else np.nan)
+    return np.array(expected)
+
+
+def test_null_observations_are_skipped_tick_by_tick(engine):
+    loader = MarketDataLoader(engine, rollups=False)
+    for i, percentage in enumerate(PERCENTAGES):
+        loader.load([_quote(i, percentage)])
+        update_running_averages(engine)
+
+    percentage, price = _averages(engine)
+    np.testing.assert_allclose(percentage, _expected(), rtol=1e-12)
+    np.testing.assert_allclose(price, _ewma(100.0 + np.arange(len(PERCENTAGES)), ('span', 30.0)), rtol=1e-12)
+
+
+def test_rebuild_matches_the_incremental_update(engine):
+    loader = MarketDataLoader(engine, rollups=False)
+    loader.load([_quote(i, percentage) for i, percentage in enumerate(PERCENTAGES[:4])])
+    update_running_averages(engine)
+    for i in range(4, len(PERCENTAGES)):
+        loader.load([_quote(i, PERCENTAGES[i])])
+        update_running_averages(engine)
+    incremental = _averages(engine)
+
+    rebuild_running_averages(engine, [1])
+    for rebuilt, expected in zip(_averages(engine), incremental):
+        np.testing.assert_allclose(rebuilt, expected, rtol=1e-12)
@@ -0,0 +1,56 @@
+import time
+
+# {dispatcher: [signature, ...]} -- populated by the modules defining the kernels through register()
+_REGISTRY = {}
+
+# The modules whose kernels are registered, imported by warmup() so the registry is complete
+KERNEL_MODULES = ('crypto.analytics.indicators', 'crypto.analytics.sweep', 'crypto.analytics.chunked')
+
+
+def register(dispatcher, *signatures):
+    """
+    Declares the typed signatures a numba kernel is called with so warmup() can compile them ahead of the first call.
+    The kernels are compiled with cache=True, so after the first process on a machine the compile step becomes a
+    load from the on-disk cache.
+
+    :param dispatcher: the numba dispatcher returned by @jit
+    :param signatures: argument type tuples, use numba.types.Omitted(default) for arguments callers leave out
+    """
+    _REGISTRY.setdefault(dispatcher, []).extend(signatures)
+
+
+def warmup(verbose=False):
+    """
+    Compiles (or loads from the cache) every registered kernel signature. Call it once in the startup phase of a
+    worker so no request pays for JIT compilation.
+
+    :param verbose: print the time spent on each kernel
+    :return: a dict of {kernel name: seconds}, plus the total under 'total'
+    """
+    import importlib
+
+    start = time.perf_counter()
+    for module in KERNEL_MODULES:
+        importlib.import_module(module)
+
+    timings = {}
+    for dispatcher, signatures in _REGISTRY.items():
+        t0 = time.perf_counter()
+        for signature in signatures:
+            dispatcher.compile(signature)
+        timings[dispatcher.py_func.__name__] = time.perf_counter() - t0
+
+        if verbose:
+            print('{:<24}{:>8.3f}s'.format(dispatcher.py_func.__name__, timings[dispatcher.py_func.__name__]))
+
+    timings['total'] = time.perf_counter() - start
+    if verbose:
+        print('{:<24}{:>8.3f}s'.format('total', timings['total']))
+
+    return timings
+
+
+if __name__ == '__main__':
+    # Going through the package module so the registry is the one the kernel modules register into
+    from crypto.analytics.warmup import warmup as _warmup
+    _warmup(verbose=True)
@@ -0,0 +1,306 @@
+"""
+Checkpointed, parallel backfill of market_data history.
+
+The (symbols x date range) space is split into units of symbols_per_unit coins over days_per_unit days. A pool of
+workers fetches units concurrently from the source while a single writer streams each fetched unit into the bulk
+MarketDataLoader, one transaction per unit, and appends the unit to a checkpoint log once it is committed. An
+interrupted backfill rerun with the same checkpoint skips the committed units; a unit that was written but not yet
+checkpointed is simply upserted again. Once every unit is in, the rollups of the range, the running_averages of the
+coins that received rows and their files in a ColumnarStore, when given, are rebuilt, since the backfilled rows land
+behind their incremental state:
+
+    backfill = Backfill(client, CRYPTO_SYMBOLS, dt.datetime(2018, 1, 1), dt.datetime(2021, 1, 1), 'backfill.jsonl')
+    asyncio.run(backfill.run())  # {'units': 8060, 'skipped': 0, 'failed': 0, 'rows': ..., 'rows_per_second': ...}
+
+    python -m crypto.backfill --start 2018-01-01 --end 2021-01-01 --checkpoint backfill.jsonl --workers 8
+    python -m crypto.backfill --start 2018-01-01 --end 2018-02-01 --checkpoint /tmp/rehearsal.jsonl --synthetic
+
+The source is anything with an async fetch_history(symbols, start, end), e.g. CoinMarketCapClient or the local
+SyntheticQuotes, which needs neither the API nor credits.
+"""
+import argparse
+import asyncio
+import datetime as dt
+import hashlib
+import json
+import logging
+import os
+import time
+import zlib
+
+import numpy as np
+
+from crypto.analytics.running_averages import rebuild_running_averages
+from crypto.db.database import get_engine
+from crypto.db.loader import MarketDataLoader, _stats
+from crypto.db.rollup import rebuild_rollups
+
+logger = logging.getLogger(__name__)
+
+
+class SyntheticQuotes:
+    """
+    Local quotes source producing deterministic prices for any symbol and time, for tests and rehearsals of a backfill
+    """
+
+    def __init__(self, interval=dt.timedelta(minutes=5), latency=0.0):
+        """
+        :param interval: the spacing of the points
+        :param latency: the seconds each call sleeps, to mimic the API
+        """
+        self.interval = interval
+        self.latency = latency
+        self.calls = 0
+
+    async def fetch_history(self, symbols, start, end):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        step = np.timedelta64(int(self.interval.total_seconds() * 1e6), 'us')
+        first = np.datetime64(start, 'us')
+        # Aligned on the interval so every unit boundary falls on the same grid
+        first += (-(first - np.datetime64(0, 'us'))) % step
+        times = np.arange(first, np.datetime64(end, 'us') + np.timedelta64(1, 'us'), step)
+        hours = (times - np.datetime64(0, 'us')) / np.timedelta64(3600, 's')
+        load_dates = times.tolist()
+
+        quotes = []
+        for symbol in symbols:
+            seed = zlib.crc32(symbol.encode())
+            base = 1 + seed % 10000
+            prices = (base * (1 + 0.2 * np.sin(hours / (24 + seed % 97) + seed % 7))).tolist()
+            quotes.extend({
+                'symbol': symbol,
+                'name': symbol,
+                'load_date': load_date,
+                'market_cap': int(price * 1e6),
+                'market_cap_percentage': None,
+                'trade_price': price,
+                'ranking': None,
+            } for load_date, price in zip(load_dates, prices))
+
+        return quotes
+
+
+class Checkpoint:
+    """
+    Append-only log of the committed units, one JSON line each, so recording a unit costs one small fsynced write
+    however many units came before it
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The torn last line of an interrupted write, its unit is redone
+                        continue
+                    self.done[entry['unit']] = entry
+
+    def record(self, unit, rows, symbols):
+        entry = {'unit': unit, 'rows': rows, 'symbols': sorted(symbols)}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.done[unit] = entry
+
+    def symbols(self):
+        """
+        :return: every symbol that received rows in a committed unit
+        """
+        return sorted({symbol for entry in self.done.values() for symbol in entry['symbols']})
+
+
+def plan(symbols, start, end, days_per_unit=7, symbols_per_unit=100):
+    """
+    :return: the list of units, (key, symbols, start, end) with end exclusive, oldest range first
+    """
+    symbols = list(dict.fromkeys(symbol.strip().upper() for symbol in symbols if symbol.strip()))
+    chunks = [symbols[i:i + symbols_per_unit] for i in range(0, len(symbols), symbols_per_unit)]
+
+    units = []
+    unit_start = start
+    while unit_start < end:
+        unit_end = min(unit_start + dt.timedelta(days=days_per_unit), end)
+        for chunk in chunks:
+            # Keyed on the unit's content, so changing the plan never mistakes one unit for another
+            key = hashlib.sha1('{}|{}|{}'.format(unit_start.isoformat(), unit_end.isoformat(),
+                                                 ','.join(chunk)).encode()).hexdigest()
+            units.append((key, chunk, unit_start, unit_end))
+        unit_start = unit_end
+
+    return units
+
+
+class Backfill:
+    """
+    Fills market_data over a date range from a history source, see the module docstring
+    """
+
+    def __init__(self, source, symbols, start, end, checkpoint, engine=None, partitioned=False, days_per_unit=7,
+                 symbols_per_unit=100, workers=8, max_pending=16, batch_size=10000, fetch_kwargs=None, store=None):
+        """
+        :param source: anything with an async fetch_history(symbols, start, end) returning quotes
+        :param symbols: the symbols backfilled
+        :param start: the first load_date backfilled
+        :param end: the end of the range, exclusive
+        :param checkpoint: the path of the checkpoint log
+        :param engine: the SQLAlchemy engine, defaults to crypto.db.database.get_engine()
+        :param partitioned: write into the monthly partitions of crypto.db.partition
+        :param days_per_unit: the days of history of one unit
+        :param symbols_per_unit: the symbols of one unit
+        :param workers: the number of units fetched concurrently
+        :param max_pending: the number of fetched units waiting for the writer before the workers hold off
+        :param batch_size: the number of rows per executemany call
+        :param fetch_kwargs: extra keyword arguments of source.fetch_history, e.g. {'interval': '1h'}
+        :param store: a ColumnarStore of market_data resynced for the coins backfilled, none when None
+        """
+        self.source = source
+        self.start = start
+        self.end = end
+        self.units = plan(symbols, start, end, days_per_unit, symbols_per_unit)
+        self.checkpoint = Checkpoint(checkpoint)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.fetch_kwargs = fetch_kwargs or {}
+        self.store = store
+
+        # The rollups are rebuilt once at the end rather than recomputed per out-of-order unit
+        self.loader = MarketDataLoader(engine if engine is not None else get_engine(), batch_size=batch_size,
+                                       rollups=False, partitioned=partitioned)
+
+    async def run(self, rebuild=True):
+        """
+        :param rebuild: rebuild the rollups and running_averages once every unit is in
+        :return: a dict of the units done, skipped (committed by an earlier run) and failed, the rows written and the
+            write rate, see MarketDataLoader.load
+        """
+        start = time.perf_counter()
+        todo = [unit for unit in self.units if unit[0] not in self.checkpoint.done]
+        pending = asyncio.Queue(self.max_pending)
+        next_unit = iter(todo)
+        failed = []
+
+        async def worker():
+            for unit in next_unit:
+                key, symbols, unit_start, unit_end = unit
+                try:
+                    quotes = await self.source.fetch_history(symbols, unit_start, unit_end, **self.fetch_kwargs)
+                except Exception:
+                    logger.exception('Unit %s of %s to %s failed, it is retried on the next run', key, unit_start,
+                                     unit_end)
+                    failed.append(key)
+                    continue
+                await pending.put((unit, quotes))
+
+        async def writer():
+            rows = 0
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return rows
+                rows += await asyncio.to_thread(self._load, *item)
+
+        async def fetching():
+            await asyncio.gather(*[worker() for _ in range(min(self.workers, len(todo)) or 1)])
+            await pending.put(None)
+
+        # A failing writer must not leave the workers blocked on a full queue, nor the other way around
+        tasks = [asyncio.ensure_future(fetching()), asyncio.ensure_future(writer())]
+        try:
+            _, rows = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        stats = _stats(rows, time.perf_counter() - start)
+        stats.update(units=len(todo) - len(failed), skipped=len(self.units) - len(todo), failed=len(failed))
+
+        if rebuild and not failed:
+            stats.update(self.rebuild())
+
+        return stats
+
+    def _load(self, unit, quotes):
+        key, symbols, unit_start, unit_end = unit
+        # Sources may return the points on the range bounds twice, keep each unit to [start, end)
+        quotes = [quote for quote in quotes if quote.get('load_date') is not None and
+                  unit_start <= quote['load_date'] < unit_end]
+
+        rows = self.loader.load(quotes)['rows']
+        self.checkpoint.record(key, rows, {quote['symbol'] for quote in quotes})
+
+        return rows
+
+    def rebuild(self):
+        """
+        Rebuilds the rollups over the backfilled range, and the running_averages and store files of the coins that
+        received rows
+
+        :return: a dict of the rollup bars, running_averages rows and store rows written
+        """
+        engine = self.loader.engine
+        with engine.begin() as conn:
+            self.loader.symbols.load(conn)
+            ids = self.loader.symbols.resolve(conn, [{'symbol': symbol} for symbol in self.checkpoint.symbols()])
+        crypto_ids = [ids[symbol] for symbol in self.checkpoint.symbols()]
+
+        stats = {
+            'rollups': rebuild_rollups(engine, self.start, self.end - dt.timedelta(microseconds=1)),
+            'running_averages': rebuild_running_averages(engine, crypto_ids) if crypto_ids else {'coins': 0, 'rows': 0},
+        }
+        if self.store is not None:
+            with engine.connect() as conn:
+                stats['store'] = self.store.resync(conn, crypto_ids)
+
+        return stats
+
+
+def _date(value):
+    return dt.datetime.strptime(value, '%Y-%m-%d')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Backfills market_data from the CoinMarketCap history.')
+    parser.add_argument('--start', type=_date, required=True, help='the first day, YYYY-MM-DD')
+    parser.add_argument('--end', type=_date, required=True, help='the day after the last one, YYYY-MM-DD')
+    parser.add_argument('--checkpoint', required=True, help='the checkpoint log, reuse it to resume')
+    parser.add_argument('--workers', type=int, default=8, help='the number of units fetched concurrently')
+    parser.add_argument('--days-per-unit', type=int, default=7)
+    parser.add_argument('--symbols-per-unit', type=int, default=100)
+    parser.add_argument('--interval', default='5m', help='the spacing of the history points')
+    parser.add_argument('--partitioned', action='store_true', help='write into the monthly market_data partitions')
+    parser.add_argument('--synthetic', action='store_true', help='use SyntheticQuotes instead of the API')
+    parser.add_argument('--store', help='the directory of a columnar store of market_data to resync')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    from crypto.config import COINMARKETCAP_PRIVATE_KEY, CRYPTO_SYMBOLS
+    from crypto.db.store import ColumnarStore
+
+    async def run():
+        options = dict(partitioned=args.partitioned, days_per_unit=args.days_per_unit,
+                       symbols_per_unit=args.symbols_per_unit, workers=args.workers,
+                       store=ColumnarStore(args.store, 'market_data') if args.store else None)
+        if args.synthetic:
+            return await Backfill(SyntheticQuotes(), CRYPTO_SYMBOLS, args.start, args.end, args.checkpoint,
+                                  **options).run()
+
+        from crypto.coinmarketcap.client import CoinMarketCapClient
+
+        async with CoinMarketCapClient(COINMARKETCAP_PRIVATE_KEY, max_concurrency=args.workers) as client:
+            options['symbols_per_unit'] = min(args.symbols_per_unit, client.batch_size)
+            return await Backfill(client, CRYPTO_SYMBOLS, args.start, args.end, args.checkpoint,
+                                  fetch_kwargs={'interval': args.interval}, **options).run()
+
+    logger.info('Backfill finished: %s', asyncio.run(run()))
+
+
+if __name__ == '__main__':
+    main()
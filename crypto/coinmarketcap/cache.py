@@ -0,0 +1,208 @@
+"""
+Shared quote cache in front of a CoinMarketCapClient.
+
+Quotes are cached per symbol for ttl seconds, with the least recently used symbols evicted past max_size. Concurrent
+requests for symbols already being fetched wait on that fetch instead of starting their own, and the symbols nobody has
+in flight are fetched together in one upstream call. Within stale_ttl seconds past their ttl, quotes are served as they
+are while a background fetch revalidates them:
+
+    async with CoinMarketCapClient(COINMARKETCAP_PRIVATE_KEY) as client:
+        quotes = QuoteCache(client, ttl=30, stale_ttl=120)
+        await asyncio.gather(quotes.fetch_quotes(CRYPTO_SYMBOLS), quotes.fetch_quotes(['BTC', 'ETH']))  # one call
+        quotes.stats  # {'hits': 0, 'stale_hits': 0, 'misses': 100, 'coalesced': 2, 'upstream_calls': 1, ...}
+
+QuoteCache has the fetch_quotes() of the client, so the ingest scheduler, the dashboards and the purchasing module can
+all share one instance. It belongs to the event loop it is first used on.
+"""
+import asyncio
+import collections
+import time
+
+
+class QuoteCache:
+    """
+    TTL + LRU cache of quotes by symbol, with in-flight request coalescing and stale-while-revalidate
+    """
+
+    def __init__(self, client, ttl=60.0, stale_ttl=0.0, max_size=10000, clock=time.monotonic):
+        """
+        :param client: a CoinMarketCapClient, or anything with an async fetch_quotes(symbols)
+        :param ttl: the seconds a quote is served from the cache
+        :param stale_ttl: the seconds past ttl a quote is still served while it is refetched in the background, 0 to
+            always wait for fresh quotes
+        :param max_size: the number of symbols kept
+        :param clock: the time source, in seconds
+        """
+        self.client = client
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self.clock = clock
+
+        # symbol -> (fetched_at, quotes of the symbol), least recently used first
+        self._entries = collections.OrderedDict()
+        # symbol -> the Future of the upstream call fetching it
+        self._inflight = {}
+        self._tasks = set()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+        self.upstream_symbols = 0
+        self.evictions = 0
+        self.errors = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @property
+    def stats(self):
+        """
+        :return: the request counters, hit_rate being the share of symbols served without waiting on upstream
+        """
+        requested = self.hits + self.stale_hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'upstream_calls': self.upstream_calls,
+            'upstream_symbols': self.upstream_symbols,
+            'evictions': self.evictions,
+            'errors': self.errors,
+            'size': len(self._entries),
+            'hit_rate': (self.hits + self.stale_hits) / requested if requested else 0.0,
+        }
+
+    def invalidate(self, symbols=None):
+        """
+        Drops the cached quotes of the symbols, of every symbol when None
+        """
+        if symbols is None:
+            self._entries.clear()
+            return
+
+        for symbol in _normalize(symbols):
+            self._entries.pop(symbol, None)
+
+    async def fetch_quotes(self, symbols):
+        """
+        :param symbols: a list of symbols, or a comma separated string of them
+        :return: the quotes of the symbols, see parse_quotes; symbols unknown to CoinMarketCap have none
+        """
+        now = self.clock()
+        cached, waiting, missing, stale = {}, {}, [], []
+        for symbol in _normalize(symbols):
+            entry = self._entries.get(symbol)
+            age = now - entry[0] if entry is not None else None
+
+            if age is not None and age < self.ttl:
+                self.hits += 1
+            elif age is not None and age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                stale.append(symbol)
+            elif symbol in self._inflight:
+                self.coalesced += 1
+                waiting[symbol] = self._inflight[symbol]
+                continue
+            else:
+                self.misses += 1
+                missing.append(symbol)
+                continue
+
+            self._entries.move_to_end(symbol)
+            cached[symbol] = entry[1]
+
+        revalidate = [symbol for symbol in stale if symbol not in self._inflight]
+        if revalidate:
+            self._start(revalidate)
+
+        if missing:
+            fetch = self._start(missing)
+            waiting.update({symbol: self._inflight[symbol] for symbol in missing})
+            # Shielded so a caller giving up does not cancel the call other requests are waiting on
+            await asyncio.shield(fetch)
+
+        # Shielded too: cancelling one waiter must not cancel the Future the fetch and the other waiters share
+        for symbol, future in waiting.items():
+            cached[symbol] = await asyncio.shield(future)
+
+        return [quote for symbol in cached for quote in cached[symbol]]
+
+    def _start(self, symbols):
+        """
+        Starts one upstream call for the symbols, registering the Futures concurrent requests for them wait on
+
+        :return: the Task of the call
+        """
+        loop = asyncio.get_running_loop()
+        futures = {symbol: loop.create_future() for symbol in symbols}
+        self._inflight.update(futures)
+
+        task = asyncio.ensure_future(self._fetch(symbols, futures))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+        return task
+
+    async def _fetch(self, symbols, futures):
+        self.upstream_calls += 1
+        self.upstream_symbols += len(symbols)
+        try:
+            quotes = await self.client.fetch_quotes(symbols)
+        except BaseException as e:
+            self.errors += 1
+            for future in futures.values():
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+                    # Marks the exception as retrieved when nobody but a background revalidation was waiting
+                    future.add_done_callback(lambda f: f.exception())
+            raise
+        else:
+            by_symbol = {symbol: [] for symbol in symbols}
+            for quote in quotes:
+                by_symbol.setdefault(quote['symbol'].upper(), []).append(quote)
+
+            fetched_at = self.clock()
+            for symbol, symbol_quotes in by_symbol.items():
+                self._entries[symbol] = (fetched_at, symbol_quotes)
+                self._entries.move_to_end(symbol)
+                if symbol in futures and not futures[symbol].done():
+                    futures[symbol].set_result(symbol_quotes)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        finally:
+            # Whatever happened, the symbols are no longer in flight, unless a newer call took them over
+            for symbol, future in futures.items():
+                if self._inflight.get(symbol) is future:
+                    del self._inflight[symbol]
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        # A failed revalidation leaves the stale quotes in place; it is counted in errors
+        if not task.cancelled():
+            task.exception()
+
+
+def _normalize(symbols):
+    if isinstance(symbols, str):
+        symbols = symbols.split(',')
+
+    return list(dict.fromkeys(symbol.strip().upper() for symbol in symbols if symbol.strip()))
@@ -0,0 +1,325 @@
+import asyncio
+import email.utils
+import math
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+
+QUOTES_URL = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest'
+HISTORICAL_URL = 'https://pro-api.coinmarketcap.com/v2/cryptocurrency/quotes/historical'
+
+# CoinMarketCap bills one credit per 100 symbols of a quotes request, and per 100 data points of a historical one
+SYMBOLS_PER_CREDIT = 100
+POINTS_PER_CREDIT = 100
+
+INTERVAL_SECONDS = {'5m': 300, '10m': 600, '15m': 900, '30m': 1800, '45m': 2700, '1h': 3600, '2h': 7200, '3h': 10800,
+                    '4h': 14400, '6h': 21600, '12h': 43200, '24h': 86400, '1d': 86400, 'daily': 86400,
+                    'hourly': 3600, '7d': 604800, 'weekly': 604800}
+
+
+class CoinMarketCapError(Exception):
+    """
+    Raised when CoinMarketCap rejects a request in a way retrying will not fix (bad key, bad symbol, out of credits)
+    """
+
+
+class CreditBudget:
+    """
+    Token bucket over the API credits, so the client never spends more than credits_per_minute however many batches
+    are in flight
+    """
+
+    def __init__(self, credits_per_minute: float, burst: float = None):
+        """
+        :param credits_per_minute: the sustained credit rate allowed by the plan
+        :param burst: the number of credits that may be spent at once, defaults to one minute's worth
+        """
+        self.rate = credits_per_minute / 60.0
+        self.capacity = burst if burst is not None else credits_per_minute
+        self.tokens = self.capacity
+        self.spent = 0
+        self._updated = time.monotonic()
+        self._lock = None
+
+    async def acquire(self, cost: float):
+        """
+        Waits until cost credits are available and spends them
+        """
+        if cost > self.capacity:
+            raise ValueError('A batch costing {} credits can never fit a budget of {}.'.format(cost, self.capacity))
+
+        # Created on first use so it belongs to the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    self.spent += cost
+                    return
+
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+
+
+class CoinMarketCapClient:
+    """
+    Concurrent, rate limited client for the CoinMarketCap quotes endpoint. The symbols are split into API-sized
+    batches that are requested concurrently over pooled keep-alive sessions, one per worker thread since a
+    requests.Session is not thread-safe, and the parsed quotes are streamed back as each batch arrives.
+
+    Usage:
+        async with CoinMarketCapClient(COINMARKETCAP_PRIVATE_KEY) as client:
+            async for quote in client.stream_quotes(CRYPTO_SYMBOLS):
+                ...
+    """
+
+    def __init__(self, private_key: str, url=QUOTES_URL, batch_size=100, max_concurrency=4, credits_per_minute=30,
+                 max_retries=5, backoff=0.5, timeout=10):
+        """
+        :param private_key: the CoinMarketCap API key
+        :param url: the quotes endpoint, overridable for testing against a local server
+        :param batch_size: the number of symbols per request
+        :param max_concurrency: the number of requests in flight at once
+        :param credits_per_minute: the credit budget, see CreditBudget
+        :param max_retries: the number of retries of a batch on throttling, server errors and connection failures
+        :param backoff: the base of the exponential backoff between retries, in seconds
+        :param timeout: the per request timeout, in seconds
+        """
+        self.url = url
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.budget = CreditBudget(credits_per_minute)
+        self._semaphore = None
+
+        self.headers = {
+            'Accepts': 'application/json',
+            'X-CMC_PRO_API_KEY': private_key,
+        }
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._sessions_lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+
+    @property
+    def session(self):
+        """
+        :return: the keep-alive session of the calling thread, created on its first request
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.headers)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.append(session)
+
+        return session
+
+    def _request(self, url, params):
+        # Runs in a worker thread, on that thread's own session
+        return self.session.get(url, params=params, timeout=self.timeout)
+
+    def batches(self, symbols):
+        """
+        :param symbols: a list of symbols, or a comma separated string of them
+        :return: the de-duplicated symbols split into lists of at most batch_size
+        """
+        if isinstance(symbols, str):
+            symbols = symbols.split(',')
+        symbols = list(dict.fromkeys(symbol.strip().upper() for symbol in symbols if symbol.strip()))
+
+        return [symbols[i:i + self.batch_size] for i in range(0, len(symbols), self.batch_size)]
+
+    async def fetch_batch(self, batch):
+        """
+        :param batch: a list of symbols
+        :return: the parsed quotes of the batch, see parse_quotes
+        """
+        payload = await self._get(self.url, {'symbol': ','.join(batch)},
+                                  math.ceil(len(batch) / SYMBOLS_PER_CREDIT))
+
+        return parse_quotes(payload)
+
+    async def fetch_history(self, symbols, start, end, interval='5m', url=HISTORICAL_URL):
+        """
+        :param symbols: a list of at most batch_size symbols
+        :param start: the first timestamp of the range
+        :param end: the last timestamp of the range
+        :param interval: the spacing of the points, e.g. '5m', '1h' or 'daily'
+        :param url: the historical quotes endpoint, overridable for testing against a local server
+        :return: the parsed quotes of every point in the range, see parse_history
+        """
+        seconds = INTERVAL_SECONDS.get(interval, 86400)
+        points = len(symbols) * (int((end - start).total_seconds() // seconds) + 1)
+        # Charged up front from the expected number of points, capped so a large range is throttled, not refused
+        cost = min(math.ceil(points / POINTS_PER_CREDIT), self.budget.capacity)
+
+        payload = await self._get(url, {'symbol': ','.join(symbols), 'time_start': start.isoformat(),
+                                        'time_end': end.isoformat(), 'interval': interval}, cost)
+
+        return parse_history(payload)
+
+    async def _get(self, url, params, cost):
+        """
+        :return: the decoded JSON body of a GET request, retried on throttling, server errors and connection failures
+        """
+        await self.budget.acquire(cost)
+
+        # Created on first use so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                delay = self.backoff * 2 ** attempt
+                try:
+                    response = await asyncio.to_thread(self._request, url, params)
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt == self.max_retries:
+                        raise
+                else:
+                    if response.status_code == 429 or response.status_code >= 500:
+                        if attempt == self.max_retries:
+                            response.raise_for_status()
+                        delay = max(delay, _retry_after(response.headers.get('Retry-After')) or 0.0)
+                    elif response.status_code != 200:
+                        raise CoinMarketCapError('{}: {}'.format(response.status_code, _error_message(response)))
+                    else:
+                        return response.json()
+
+                await asyncio.sleep(delay)
+
+    async def stream_quotes(self, symbols):
+        """
+        :param symbols: a list of symbols, or a comma separated string of them
+        :return: an async generator of parsed quotes, yielded as soon as the batch holding them arrives
+        """
+        tasks = [asyncio.ensure_future(self.fetch_batch(batch)) for batch in self.batches(symbols)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                for quote in await task:
+                    yield quote
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def fetch_quotes(self, symbols):
+        """
+        :return: the parsed quotes of every symbol, once all batches have arrived
+        """
+        return [quote async for quote in self.stream_quotes(symbols)]
+
+
+def parse_quotes(payload, convert='USD'):
+    """
+    :param payload: the decoded JSON body of a quotes/latest response
+    :param convert: the quote currency
+    :return: a list of dicts keyed like the MarketData columns, plus the symbol and name of the coin
+    """
+    data = payload.get('data') or {}
+
+    quotes = []
+    for entries in data.values():
+        # v1 maps each symbol to one object, v2 to a list of every coin sharing the symbol
+        for entry in entries if isinstance(entries, list) else [entries]:
+            quote = entry['quote'][convert]
+            quotes.append({
+                'symbol': entry['symbol'],
+                'name': entry.get('name'),
+                'load_date': _parse_date(quote.get('last_updated') or entry.get('last_updated')),
+                'market_cap': quote.get('market_cap'),
+                'market_cap_percentage': quote.get('market_cap_dominance'),
+                'trade_price': quote.get('price'),
+                'ranking': entry.get('cmc_rank'),
+            })
+
+    return quotes
+
+
+def parse_history(payload, convert='USD'):
+    """
+    :param payload: the decoded JSON body of a quotes/historical response
+    :param convert: the quote currency
+    :return: a list of dicts keyed like the MarketData columns, plus the symbol and name of the coin, one per point
+    """
+    data = payload.get('data') or {}
+    # A single coin may come back unwrapped
+    if 'quotes' in data:
+        data = {data.get('symbol'): data}
+
+    quotes = []
+    for entries in data.values():
+        for entry in entries if isinstance(entries, list) else [entries]:
+            for point in entry.get('quotes') or []:
+                quote = point['quote'][convert]
+                quotes.append({
+                    'symbol': entry['symbol'],
+                    'name': entry.get('name'),
+                    'load_date': _parse_date(quote.get('timestamp') or point.get('timestamp')),
+                    'market_cap': quote.get('market_cap'),
+                    'market_cap_percentage': quote.get('market_cap_dominance'),
+                    'trade_price': quote.get('price'),
+                    'ranking': quote.get('cmc_rank'),
+                })
+
+    return quotes
+
+
+def _parse_date(value):
+    if value is None:
+        return None
+
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def _retry_after(value):
+    """
+    :param value: a Retry-After header, in seconds or as an HTTP-date
+    :return: the seconds to wait, None when the header is missing or neither form parses
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def _error_message(response):
+    try:
+        return response.json()['status']['error_message']
+    except (ValueError, KeyError, TypeError):
+        return response.text
@@ -0,0 +1,59 @@
+import asyncio
+
+from crypto.coinmarketcap.cache import QuoteCache
+
+
+class _GatedClient:
+    """
+    Quotes client whose calls wait for release to be set, so requests can pile up on an in-flight fetch
+    """
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.calls = []
+
+    async def fetch_quotes(self, symbols):
+        self.calls.append(list(symbols))
+        await self.release.wait()
+        return [{'symbol': symbol, 'trade_price': 1.0} for symbol in symbols]
+
+
+def test_cancelled_coalesced_waiter_leaves_the_fetch_alone():
+    async def run():
+        client = _GatedClient()
+        async with QuoteCache(client, ttl=60) as cache:
+            fetching = asyncio.ensure_future(cache.fetch_quotes(['ETH']))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(cache.fetch_quotes(['ETH']))
+            await asyncio.sleep(0)
+            assert cache.coalesced == 1
+
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            client.release.set()
+            assert [quote['symbol'] for quote in await asyncio.wait_for(fetching, 1)] == ['ETH']
+            assert not cache._inflight
+
+            # A fresh request for the symbol goes upstream again and resolves
+            cache.invalidate(['ETH'])
+            quotes = await asyncio.wait_for(cache.fetch_quotes(['ETH']), 1)
+            assert [quote['symbol'] for quote in quotes] == ['ETH']
+            assert client.calls == [['ETH'], ['ETH']]
+
+    asyncio.run(run())
+
+
+def test_failed_fetch_clears_the_symbols_in_flight():
+    class _FailingClient:
+        async def fetch_quotes(self, symbols):
+            raise ConnectionError('upstream down')
+
+    async def run():
+        async with QuoteCache(_FailingClient()) as cache:
+            results = await asyncio.gather(cache.fetch_quotes(['BTC']), cache.fetch_quotes(['BTC']),
+                                           return_exceptions=True)
+            assert all(isinstance(result, ConnectionError) for result in results)
+            assert not cache._inflight
+            assert cache.errors == 1
+
+    asyncio.run(run())
@@ -0,0 +1,169 @@
+import asyncio
+import email.utils
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+from crypto.coinmarketcap.client import CoinMarketCapClient, CoinMarketCapError, CreditBudget, _retry_after
+
+
+def _quote(symbol):
+    return {'symbol': symbol, 'name': symbol.title(), 'cmc_rank': 1,
+            'quote': {'USD': {'price': 1.0, 'market_cap': 100.0, 'market_cap_dominance': 0.5,
+                              'last_updated': '2024-01-01T00:00:00.000Z'}}}
+
+
+class _FakeCoinMarketCap(BaseHTTPRequestHandler):
+    """
+    Serves quotes/latest for any symbols. The responses to serve first are queued on the server as
+    (status, headers, body) tuples; once they run out every request succeeds.
+    """
+
+    def do_GET(self):
+        symbols = parse_qs(urlparse(self.path).query)['symbol'][0].split(',')
+        with self.server.lock:
+            self.server.requests.append((time.monotonic(), symbols, self.headers.get('X-CMC_PRO_API_KEY')))
+            status, headers, body = self.server.script.pop(0) if self.server.script else (
+                200, {}, {'data': {symbol: _quote(symbol) for symbol in symbols}})
+
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeCoinMarketCap)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.script = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(server, **kwargs):
+    kwargs.setdefault('backoff', 0.01)
+    return CoinMarketCapClient('key', url='http://127.0.0.1:{}/'.format(server.server_port), **kwargs)
+
+
+def _fetch(client, symbols):
+    async def fetch():
+        async with client:
+            return await client.fetch_quotes(symbols)
+
+    return asyncio.run(fetch())
+
+
+def test_batches_and_dedup(server):
+    symbols = ['S{}'.format(i) for i in range(25)]
+    quotes = _fetch(_client(server, batch_size=10), symbols + [' s3', 'S7 ', ''])
+
+    assert sorted(quote['symbol'] for quote in quotes) == sorted(symbols)
+    assert sorted(len(batch) for _, batch, _ in server.requests) == [5, 10, 10]
+    assert sorted(symbol for _, batch, _ in server.requests for symbol in batch) == sorted(symbols)
+    assert {key for _, _, key in server.requests} == {'key'}
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_retries_honour_retry_after(server, status):
+    server.script = [(status, {'Retry-After': '0.3'}, {}), (status, {}, {})]
+    client = _client(server)
+    quotes = _fetch(client, ['BTC'])
+
+    assert [quote['symbol'] for quote in quotes] == ['BTC']
+    assert len(server.requests) == 3
+    # The first retry waits for Retry-After rather than the much shorter backoff
+    assert server.requests[1][0] - server.requests[0][0] >= 0.3
+    assert server.requests[2][0] - server.requests[1][0] < 0.3
+    assert client.budget.spent == 1
+
+
+def test_retry_after_as_an_http_date(server):
+    server.script = [(503, {'Retry-After': email.utils.formatdate(time.time() + 2, usegmt=True)}, {}),
+                     (429, {'Retry-After': 'soon'}, {})]
+    quotes = _fetch(_client(server), ['BTC'])
+
+    assert [quote['symbol'] for quote in quotes] == ['BTC']
+    assert len(server.requests) == 3
+    # The date has a one second resolution
+    assert server.requests[1][0] - server.requests[0][0] >= 0.9
+    # An unreadable header falls back to the backoff
+    assert server.requests[2][0] - server.requests[1][0] < 0.9
+
+
+def test_parse_retry_after():
+    assert _retry_after('1.5') == 1.5
+    assert _retry_after('-3') == 0.0
+    assert _retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+    assert 59 < _retry_after(email.utils.formatdate(time.time() + 60, usegmt=True)) <= 60
+    assert _retry_after('soon') is None
+    assert _retry_after(None) is None
+
+
+def test_one_session_per_thread(server):
+    client = _client(server, batch_size=1, max_concurrency=4)
+    used = set()
+    request = client._request
+
+    def record(url, params):
+        used.add((threading.get_ident(), id(client.session)))
+        return request(url, params)
+
+    client._request = record
+    _fetch(client, ['S{}'.format(i) for i in range(12)])
+
+    # No session is shared between threads, nor does a thread get more than one
+    threads, sessions = zip(*used)
+    assert len(set(threads)) == len(set(sessions)) == len(used)
+    # The sessions are closed and forgotten with the client
+    assert not client._sessions
+
+
+def test_gives_up_after_max_retries(server):
+    server.script = [(503, {}, {})] * 3
+    with pytest.raises(requests.HTTPError):
+        _fetch(_client(server, max_retries=2), ['BTC'])
+
+    assert len(server.requests) == 3
+
+
+@pytest.mark.parametrize('status', [400, 401, 402, 403])
+def test_client_errors_are_not_retried(server, status):
+    server.script = [(status, {}, {'status': {'error_message': 'Invalid value for "symbol"'}})]
+    with pytest.raises(CoinMarketCapError, match='{}: Invalid value'.format(status)):
+        _fetch(_client(server), ['NOPE'])
+
+    assert len(server.requests) == 1
+
+
+def test_credit_budget_throttles_batches(server):
+    client = _client(server, batch_size=1, max_concurrency=8)
+    # 10 credits a second once the burst of 2 is spent
+    client.budget = CreditBudget(600, burst=2)
+    t = time.monotonic()
+    quotes = _fetch(client, ['S{}'.format(i) for i in range(5)])
+
+    assert len(quotes) == 5
+    assert client.budget.spent == 5
+    assert time.monotonic() - t >= 0.25
+
+
+def test_credit_budget_refuses_a_batch_that_can_never_fit():
+    with pytest.raises(ValueError):
+        asyncio.run(CreditBudget(60, burst=2).acquire(3))
@@ -0,0 +1,226 @@
+"""
+Engine, session and schema bootstrap for the crypto_index database.
+
+Nothing here runs at import. The engine is built on first use from CRYPTO_INDEX_DB_URL (sqlite:///crypto_index.db by
+default) and the pending migrations are applied once per engine and process:
+
+    engine = get_engine()             # creates and migrates the database on first call
+    with get_session() as session:
+        session.query(MarketData)...
+
+Tests and tools can point at another database without touching the environment, e.g. get_engine('sqlite://') for a
+private in-memory database.
+"""
+import datetime as dt
+import os
+import threading
+
+import sqlalchemy as db
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from crypto.db.holdings import rebuild_holdings
+from crypto.db.models import Base, CryptoCurrencies, CryptoRunningAverages, IndexRanking, IndicatorState, MarketData, \
+    MarketDataDay, MarketDataHour, MarketDataMinute, PurchaseHistory, SchemaVersion, UserHoldings
+from crypto.db.partition import partitions
+from crypto.db.rollup import rebuild_rollups
+from crypto.db.upsert import ensure_unique_keys
+
+URL_ENV = 'CRYPTO_INDEX_DB_URL'
+DEFAULT_URL = 'sqlite:///crypto_index.db'
+
+_engines = {}
+_sessions = {}
+_lock = threading.Lock()
+
+
+def database_url(url=None):
+    return url or os.environ.get(URL_ENV) or DEFAULT_URL
+
+
+def create_engine(url=None, **kwargs):
+    """
+    A new engine, without creating or migrating the schema
+
+    :param url: the database URL, defaults to $CRYPTO_INDEX_DB_URL or sqlite:///crypto_index.db
+    :param kwargs: passed on to sqlalchemy.create_engine
+    """
+    url = database_url(url)
+    if url in ('sqlite://', 'sqlite:///:memory:'):
+        # Every connection to an in-memory database gets its own empty database, so share a single one
+        kwargs.setdefault('poolclass', StaticPool)
+        kwargs.setdefault('connect_args', {'check_same_thread': False})
+
+    return db.create_engine(url, **kwargs)
+
+
+def get_engine(url=None):
+    """
+    The engine of the URL, created and migrated on the first call and reused afterwards
+
+    :param url: the database URL, defaults to $CRYPTO_INDEX_DB_URL or sqlite:///crypto_index.db
+    """
+    url = database_url(url)
+    with _lock:
+        if url not in _engines:
+            engine = create_engine(url)
+            migrate(engine)
+            _engines[url] = engine
+
+    return _engines[url]
+
+
+def get_session(url=None):
+    """
+    :param url: the database URL, defaults to $CRYPTO_INDEX_DB_URL or sqlite:///crypto_index.db
+    :return: a new Session bound to get_engine(url), usable as a context manager
+    """
+    url = database_url(url)
+    if url not in _sessions:
+        _sessions[url] = sessionmaker(bind=get_engine(url))
+
+    return _sessions[url]()
+
+
+def dispose(url=None):
+    """
+    Closes the pooled connections of the engine of the URL and forgets it, e.g. between tests or after a fork
+    """
+    url = database_url(url)
+    with _lock:
+        _sessions.pop(url, None)
+        engine = _engines.pop(url, None)
+    if engine is not None:
+        engine.dispose()
+
+
+# Migrations -----------------------------------------------------------------------------------------------------------
+def _create_tables(engine):
+    Base.metadata.create_all(engine)
+
+
+def _natural_keys(engine):
+    # Databases created before the (crypto_id, load_date) keys hold duplicates that would block the unique indexes
+    ensure_unique_keys(engine)
+
+
+def _purchase_users(engine):
+    # Purchases belong to a user: add the column and move the unique key from (crypto_id, load_date) to
+    # (user_id, crypto_id, load_date). The rows logged before stay with a NULL user_id
+    table = PurchaseHistory.__table__
+    with engine.begin() as conn:
+        if 'user_id' not in [column['name'] for column in db.inspect(conn).get_columns(table.name)]:
+            conn.exec_driver_sql('ALTER TABLE {} ADD COLUMN user_id INTEGER'.format(table.name))
+        conn.exec_driver_sql('DROP INDEX IF EXISTS ux_purchase_history_crypto_id_load_date')
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _user_holdings(engine):
+    # The materialized holdings start from the purchases logged so far
+    UserHoldings.__table__.create(engine, checkfirst=True)
+    rebuild_holdings(engine)
+
+
+def _bar_percentage_counts(engine):
+    # The bars count their snapshots with a market_cap_percentage. The bars whose snapshots were dropped by retention
+    # can only assume all or none of theirs had one; the bars still backed by snapshots are rebuilt exactly
+    with engine.begin() as conn:
+        for model in (MarketDataMinute, MarketDataHour, MarketDataDay):
+            table = model.__table__
+            if 'n_pct' not in [column['name'] for column in db.inspect(conn).get_columns(table.name)]:
+                conn.exec_driver_sql('ALTER TABLE {} ADD COLUMN n_pct INTEGER'.format(table.name))
+            conn.execute(table.update().where(table.c.n_pct.is_(None)).values(n_pct=db.case(
+                (table.c.market_cap_percentage.is_(None), 0), else_=table.c.n_obs)))
+    rebuild_rollups(engine)
+
+
+def _merge_coin(conn, table, key, duplicate, kept):
+    # Moves the rows of a duplicate coin over to the kept one, dropping those the kept coin already has a row for
+    same = ' AND '.join('(k.{1} = {0}.{1} OR (k.{1} IS NULL AND {0}.{1} IS NULL))'.format(table, column)
+                        for column in key if column != 'crypto_id')
+    params = {'duplicate': duplicate, 'kept': kept}
+    conn.execute(db.text('DELETE FROM {0} WHERE crypto_id = :duplicate AND EXISTS (SELECT 1 FROM {0} k WHERE '
+                         'k.crypto_id = :kept AND {1})'.format(table, same)), params)
+    conn.execute(db.text('UPDATE {} SET crypto_id = :kept WHERE crypto_id = :duplicate'.format(table)), params)
+
+
+def _unique_symbols(engine):
+    # Loaders running side by side could each create the same coin. Its duplicates are merged into its first id: the
+    # snapshots, rankings and purchases move over, the rollups, running averages and holdings derived from them are
+    # rebuilt, and the unique index on symbol keeps it from happening again
+    coins = CryptoCurrencies.__table__
+    with engine.begin() as conn:
+        first = dict(conn.execute(db.select(coins.c.symbol, db.func.min(coins.c.id)).group_by(coins.c.symbol).having(
+            db.func.count() > 1)).all())
+        duplicates = {duplicate: first[symbol] for duplicate, symbol in conn.execute(
+            db.select(coins.c.id, coins.c.symbol).where(coins.c.symbol.in_(list(first)),
+                                                       coins.c.id.notin_(list(first.values())))).all()}
+
+        users = set()
+        if duplicates:
+            purchases = PurchaseHistory.__table__
+            users = set(conn.execute(db.select(purchases.c.user_id).distinct().where(
+                purchases.c.crypto_id.in_(list(duplicates)), purchases.c.user_id.isnot(None))).scalars())
+
+            keyed = [(MarketData.__tablename__, ('crypto_id', 'load_date')),
+                     (IndexRanking.__tablename__, ('crypto_id', 'load_date')),
+                     (PurchaseHistory.__tablename__, ('user_id', 'crypto_id', 'load_date'))]
+            keyed += [(name, ('crypto_id', 'load_date')) for name, _, _ in partitions(conn)]
+            derived = [model.__table__ for model in (MarketDataMinute, MarketDataHour, MarketDataDay,
+                                                     CryptoRunningAverages, IndicatorState, UserHoldings)]
+            for duplicate, kept in duplicates.items():
+                for table, key in keyed:
+                    _merge_coin(conn, table, key, duplicate, kept)
+            for table in derived:
+                conn.execute(table.delete().where(table.c.crypto_id.in_(list(duplicates))))
+            conn.execute(coins.delete().where(coins.c.id.in_(list(duplicates))))
+
+        for index in coins.indexes:
+            index.create(conn, checkfirst=True)
+
+    if duplicates:
+        # Imported here: the analytics package compiles its kernels on import, which the other migrations do not need
+        from crypto.analytics.running_averages import rebuild_running_averages
+
+        rebuild_rollups(engine)
+        rebuild_running_averages(engine, sorted(set(duplicates.values())))
+        if users:
+            rebuild_holdings(engine, users)
+
+
+# (version, description, step), applied in order. A step must be safe to re-run, in case the process died between the
+# step and recording its version
+MIGRATIONS = (
+    (1, 'create the tables', _create_tables),
+    (2, 'unique (crypto_id, load_date) keys on the time-series tables', _natural_keys),
+    (3, 'purchase_history per user, keyed on (user_id, crypto_id, load_date)', _purchase_users),
+    (4, 'user_holdings materialized from purchase_history', _user_holdings),
+    (5, 'count the snapshots with a market_cap_percentage in the rollup bars', _bar_percentage_counts),
+    (6, 'unique currency_information.symbol, merging the coins created twice', _unique_symbols),
+)
+
+
+def migrate(engine):
+    """
+    Applies the migrations the database has not seen yet
+
+    :param engine: the SQLAlchemy engine
+    :return: the versions applied
+    """
+    SchemaVersion.__table__.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        current = conn.execute(db.select(db.func.max(SchemaVersion.version))).scalar() or 0
+
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+
+        step(engine)
+        with engine.begin() as conn:
+            conn.execute(SchemaVersion.__table__.insert(), {'version': version, 'description': description,
+                                                            'applied_at': dt.datetime.utcnow()})
+        applied.append(version)
+
+    return applied
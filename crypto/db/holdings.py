@@ -0,0 +1,221 @@
+"""
+user_holdings: the position, cost basis and valuation of every user in every coin, materialized from purchase_history
+and market_data.
+
+Both sides are folded in as they are written, touching only the rows they affect. record_purchases() runs in the
+transaction logging purchases and extends the positions of the (user, coin) pairs purchased, and revalue() runs in the
+MarketDataLoader's transaction and reprices the holdings of the coins in the snapshot. A purchase logged out of order,
+or replayed over a row already folded in, falls back to recomputing its pair from purchase_history, so the table always
+matches rebuild_holdings(). A dashboard reads a user's portfolio from the (user_id, crypto_id) index, however long
+their history:
+
+    with engine.connect() as conn:
+        portfolio(conn, 42)  # {'crypto_id': array([1, 2]), 'quantity': ..., 'total_market_value': 10250.0, ...}
+
+The cost basis is at average cost: a purchase adds what it cost in USD, a sale takes out the share of the cost basis of
+the quantity sold, so unrealized_pnl = quantity * price - cost_basis.
+"""
+import numpy as np
+import sqlalchemy as db
+
+from crypto.db.models import MarketData, PurchaseHistory, UserHoldings
+from crypto.db.query import _execute, _to_arrays, latest_per_coin
+from crypto.db.upsert import HOLDING_KEY, upsert
+
+PURCHASE_COLUMNS = ('user_id', 'crypto_id', 'load_date', 'purchase_amt_crypto', 'purchase_amt_usd')
+HOLDING_COLUMNS = ('crypto_id', 'quantity', 'cost_basis', 'last_purchase_date', 'price', 'price_date', 'market_value',
+                   'unrealized_pnl')
+
+
+def _sorted(purchases):
+    order = np.lexsort((purchases['load_date'], purchases['crypto_id'], purchases['user_id']))
+    return {column: values[order] for column, values in purchases.items()}
+
+
+def _fold(states, purchases):
+    """
+    Applies the purchases, sorted by user_id, crypto_id and load_date, to the positions in place
+
+    :param states: a dict of {(user_id, crypto_id): (quantity, cost_basis, last_purchase_date)}
+    :param purchases: a dict of arrays of PURCHASE_COLUMNS
+    """
+    amounts = np.nan_to_num(purchases['purchase_amt_crypto']).tolist()
+    costs = np.nan_to_num(purchases['purchase_amt_usd']).tolist()
+    for user_id, crypto_id, load_date, amount, cost in zip(purchases['user_id'].tolist(),
+                                                           purchases['crypto_id'].tolist(),
+                                                           purchases['load_date'].tolist(), amounts, costs):
+        quantity, cost_basis, _ = states.get((user_id, crypto_id), (0.0, 0.0, None))
+        if amount > 0:
+            cost_basis += cost
+        elif quantity > 0:
+            cost_basis *= max(quantity + amount, 0.0) / quantity
+        quantity += amount
+        states[(user_id, crypto_id)] = (quantity, cost_basis if quantity > 0 else 0.0, load_date)
+
+
+def _rows(conn, states):
+    """
+    :return: the user_holdings rows of the positions, valued at the latest trade_price of their coins
+    """
+    crypto_ids = sorted({crypto_id for _, crypto_id in states})
+    prices = {}
+    if crypto_ids:
+        latest = latest_per_coin(conn, MarketData, ['trade_price'], crypto_ids=crypto_ids)
+        prices = {crypto_id: (price, load_date) for crypto_id, price, load_date in zip(
+            latest['crypto_id'].tolist(), latest['trade_price'].tolist(), latest['load_date'].tolist())
+            if not np.isnan(price)}
+
+    rows = []
+    for (user_id, crypto_id), (quantity, cost_basis, last_purchase_date) in states.items():
+        price, price_date = prices.get(crypto_id, (None, None))
+        rows.append({
+            'user_id': user_id,
+            'crypto_id': crypto_id,
+            'quantity': quantity,
+            'cost_basis': cost_basis,
+            'last_purchase_date': last_purchase_date,
+            'price': price,
+            'price_date': price_date,
+            'market_value': None if price is None else quantity * price,
+            'unrealized_pnl': None if price is None else quantity * price - cost_basis,
+        })
+
+    return rows
+
+
+def _purchases(conn, user_ids, crypto_ids=None):
+    """
+    :return: the purchases of the users, in those coins when given, as a dict of arrays sorted for _fold
+    """
+    where = 'user_id IS NOT NULL'
+    if user_ids is not None:
+        where += ' AND user_id IN ({})'.format(', '.join(str(int(_id)) for _id in user_ids) or 'NULL')
+    if crypto_ids is not None:
+        where += ' AND crypto_id IN ({})'.format(', '.join(str(int(_id)) for _id in crypto_ids) or 'NULL')
+    sql = 'SELECT {} FROM {} WHERE {}'.format(', '.join(PURCHASE_COLUMNS), PurchaseHistory.__tablename__, where)
+
+    return _sorted(_execute(conn, sql, {}, list(PURCHASE_COLUMNS)))
+
+
+def record_purchases(conn, rows):
+    """
+    Folds newly logged purchases into user_holdings. The positions of the pairs purchased are extended when the new
+    purchases come after the last one folded in, otherwise recomputed from purchase_history.
+
+    :param conn: an open connection, inside the transaction after purchase_history was written
+    :param rows: the PurchaseHistory rows logged, dicts with the PURCHASE_COLUMNS; rows without a user_id are ignored
+    :return: the number of user_holdings rows written
+    """
+    rows = [row for row in rows if row.get('user_id') is not None and row.get('load_date') is not None]
+    if not rows:
+        return 0
+    purchases = _sorted(_to_arrays([tuple(row.get(column) for column in PURCHASE_COLUMNS) for row in rows],
+                                   PURCHASE_COLUMNS))
+
+    user_ids = np.unique(purchases['user_id']).tolist()
+    crypto_ids = np.unique(purchases['crypto_id']).tolist()
+    sql = 'SELECT user_id, crypto_id, quantity, cost_basis, last_purchase_date FROM {} WHERE {} AND {}'.format(
+        UserHoldings.__tablename__, 'user_id IN ({})'.format(', '.join(str(_id) for _id in user_ids)),
+        'crypto_id IN ({})'.format(', '.join(str(_id) for _id in crypto_ids)))
+    held = _execute(conn, sql, {}, ['user_id', 'crypto_id', 'quantity', 'cost_basis', 'last_purchase_date'])
+    states = {(user_id, crypto_id): (quantity, cost_basis, last_purchase_date)
+              for user_id, crypto_id, quantity, cost_basis, last_purchase_date in zip(
+                  held['user_id'].tolist(), held['crypto_id'].tolist(), np.nan_to_num(held['quantity']).tolist(),
+                  np.nan_to_num(held['cost_basis']).tolist(), held['last_purchase_date'].tolist())}
+
+    # Late or replayed purchases: their pair is recomputed from the history, which already holds them
+    pairs = list(zip(purchases['user_id'].tolist(), purchases['crypto_id'].tolist()))
+    first = {}
+    for pair, load_date in zip(pairs, purchases['load_date'].tolist()):
+        first.setdefault(pair, load_date)
+    stale = {pair for pair, load_date in first.items()
+             if pair in states and states[pair][2] is not None and load_date <= states[pair][2]}
+
+    fresh = np.array([pair not in stale for pair in pairs], dtype=bool)
+    touched = {pair: states[pair] for pair in first if pair in states and pair not in stale}
+    _fold(touched, {column: values[fresh] for column, values in purchases.items()})
+
+    if stale:
+        history = _purchases(conn, {user_id for user_id, _ in stale}, {crypto_id for _, crypto_id in stale})
+        keep = np.array([pair in stale for pair in zip(history['user_id'].tolist(), history['crypto_id'].tolist())],
+                        dtype=bool)
+        recomputed = {}
+        _fold(recomputed, {column: values[keep] for column, values in history.items()})
+        touched.update(recomputed)
+
+    return upsert(conn, UserHoldings.__table__, _rows(conn, touched), key=HOLDING_KEY)
+
+
+def revalue(conn, rows):
+    """
+    Reprices the holdings of the coins of newly loaded snapshots; a holding is never moved back to an older price
+
+    :param conn: an open connection, inside the loader's transaction
+    :param rows: the MarketData rows loaded, dicts with at least crypto_id, load_date and trade_price
+    :return: the number of user_holdings rows updated
+    """
+    latest = {}
+    for row in rows:
+        price, load_date = row.get('trade_price'), row.get('load_date')
+        if price is None or load_date is None or price != price:
+            continue
+        current = latest.get(row['crypto_id'])
+        if current is None or load_date >= current['_load_date']:
+            latest[row['crypto_id']] = {'_crypto_id': row['crypto_id'], '_load_date': load_date, '_price': price}
+    if not latest:
+        return 0
+
+    table = UserHoldings.__table__
+    price = db.bindparam('_price', type_=db.Float)
+    stmt = table.update().where(
+        table.c.crypto_id == db.bindparam('_crypto_id'),
+        db.or_(table.c.price_date.is_(None), table.c.price_date <= db.bindparam('_load_date', type_=db.DateTime)),
+    ).values(price=price, price_date=db.bindparam('_load_date'), market_value=table.c.quantity * price,
+             unrealized_pnl=table.c.quantity * price - table.c.cost_basis)
+
+    return conn.execute(stmt, list(latest.values())).rowcount
+
+
+def rebuild_holdings(engine, user_ids=None):
+    """
+    Recomputes user_holdings from purchase_history and the latest trade_prices, in one transaction
+
+    :param engine: the SQLAlchemy engine
+    :param user_ids: only these users, every user when None
+    :return: a dict with the number of users and user_holdings rows written
+    """
+    table = UserHoldings.__table__
+    with engine.begin() as conn:
+        states = {}
+        _fold(states, _purchases(conn, user_ids))
+
+        stmt = table.delete()
+        if user_ids is not None:
+            stmt = stmt.where(table.c.user_id.in_([int(_id) for _id in user_ids]))
+        conn.execute(stmt)
+        rows = upsert(conn, table, _rows(conn, states), key=HOLDING_KEY)
+
+    return {'users': len({user_id for user_id, _ in states}), 'rows': rows}
+
+
+def portfolio(conn, user_id):
+    """
+    The current portfolio of a user, read from user_holdings alone
+
+    :param conn: an open connection
+    :param user_id: the user
+    :return: a dict of arrays of HOLDING_COLUMNS, one entry per coin held ordered by crypto_id, and the totals of
+        market_value, cost_basis and unrealized_pnl over the coins with a price
+    """
+    sql = 'SELECT {} FROM {} WHERE user_id = :user_id AND quantity != 0 ORDER BY crypto_id'.format(
+        ', '.join(HOLDING_COLUMNS), UserHoldings.__tablename__)
+    positions = _execute(conn, sql, {'user_id': int(user_id)}, list(HOLDING_COLUMNS))
+
+    priced = np.isfinite(positions['market_value'])
+    positions.update(
+        total_market_value=float(positions['market_value'][priced].sum()),
+        total_cost_basis=float(positions['cost_basis'][priced].sum()),
+        total_unrealized_pnl=float(positions['unrealized_pnl'][priced].sum()),
+    )
+
+    return positions
@@ -2,12 +2,15 @@ import sqlalchemy as db
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
-engine = db.create_engine('sqlite:///crypto_index.db')
+# The schema only: engines, sessions and table creation live in crypto.db.database
 Base = declarative_base()
 
 
 class CryptoCurrencies(Base):
     __tablename__ = 'currency_information'
+    __table_args__ = (
+        db.Index('ux_currency_information_symbol', 'symbol', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     symbol = db.Column(db.String)
@@ -21,6 +24,10 @@ class MarketData(Base):
     """
 
     __tablename__ = 'market_data'
+    __table_args__ = (
+        db.Index('ux_market_data_crypto_id_load_date', 'crypto_id', 'load_date', unique=True),
+        db.Index('ix_market_data_load_date', 'load_date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     crypto_id = db.Column('crypto_id', db.Integer, db.ForeignKey('currency_information.id'))
@@ -31,11 +38,73 @@ class MarketData(Base):
     ranking = db.Column(db.Integer)
 
 
+class MarketDataPartition(Base):
+    """
+    Registry of the monthly market_data partitions created by crypto.db.partition, each holding the snapshots with
+    start_date <= load_date < end_date
+    """
+
+    __tablename__ = 'market_data_partition'
+
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String, unique=True)
+    start_date = db.Column(db.DateTime, index=True)
+    end_date = db.Column(db.DateTime)
+
+
+class MarketDataBar:
+    """
+    The columns of the MarketData rollups: OHLC of trade_price, the last market_cap and the average
+    market_cap_percentage of the snapshots in each bucket, keyed on the bucket start in load_date. n_obs counts the
+    snapshots of the bar and n_pct those with a market_cap_percentage, which weights the average when bars are merged.
+    last_date is the load_date of the latest snapshot folded into the bar.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    crypto_id = db.Column('crypto_id', db.Integer, db.ForeignKey('currency_information.id'))
+    load_date = db.Column(db.DateTime)
+
+    open = db.Column(db.Float)
+    high = db.Column(db.Float)
+    low = db.Column(db.Float)
+    close = db.Column(db.Float)
+    market_cap = db.Column(db.Float)
+    market_cap_percentage = db.Column(db.Float)
+    n_obs = db.Column(db.Integer)
+    n_pct = db.Column(db.Integer)
+    last_date = db.Column(db.DateTime)
+
+
+class MarketDataMinute(MarketDataBar, Base):
+    __tablename__ = 'market_data_1m'
+    __table_args__ = (
+        db.Index('ux_market_data_1m_crypto_id_load_date', 'crypto_id', 'load_date', unique=True),
+    )
+
+
+class MarketDataHour(MarketDataBar, Base):
+    __tablename__ = 'market_data_1h'
+    __table_args__ = (
+        db.Index('ux_market_data_1h_crypto_id_load_date', 'crypto_id', 'load_date', unique=True),
+    )
+
+
+class MarketDataDay(MarketDataBar, Base):
+    __tablename__ = 'market_data_1d'
+    __table_args__ = (
+        db.Index('ux_market_data_1d_crypto_id_load_date', 'crypto_id', 'load_date', unique=True),
+    )
+
+
 class CryptoRunningAverages(Base):
     """
     Quantifying the running averages for all the cryptocurrency indices that are being mapped into the ranking
     """
     __tablename__ = 'running_averages'
+    __table_args__ = (
+        db.Index('ux_running_averages_crypto_id_load_date', 'crypto_id', 'load_date', unique=True),
+        db.Index('ix_running_averages_load_date', 'load_date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     crypto_id = db.Column('crypto_id', db.Integer, db.ForeignKey('currency_information.id'))
@@ -56,6 +125,9 @@ class IndexRanking(Base):
     """
 
     __tablename__ = 'index_ranking'
+    __table_args__ = (
+        db.Index('ux_index_ranking_crypto_id_load_date', 'crypto_id', 'load_date', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     crypto_id = db.Column('crypto_id', db.Integer, db.ForeignKey('currency_information.id'))
@@ -66,16 +138,85 @@ class IndexRanking(Base):
 
 class PurchaseHistory(Base):
     """
-    Logs the purchase history of the cryptocurrencies to map them over time
+    Logs the purchase history of the cryptocurrencies to map them over time, per user. Sales are logged with negative
+    amounts, so the holdings of a user are the sums of purchase_amt_crypto. user_id is NULL for the purchases logged
+    before there were users.
     """
 
     __tablename__ = 'purchase_history'
+    __table_args__ = (
+        db.Index('ux_purchase_history_user_id_crypto_id_load_date', 'user_id', 'crypto_id', 'load_date', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer)
     crypto_id = db.Column('crypto_id', db.Integer, db.ForeignKey('currency_information.id'))
     load_date = db.Column(db.DateTime)
     purchase_amt_usd = db.Column(db.Float)
     purchase_amt_crypto = db.Column(db.Float)
 
 
-Base.metadata.create_all(engine)
+class UserHoldings(Base):
+    """
+    The position of every user in every coin they traded, materialized from purchase_history and valued at the latest
+    trade_price, so a user's portfolio is read from one index range instead of summing their whole history. Kept up to
+    date by crypto.db.holdings.
+    """
+
+    __tablename__ = 'user_holdings'
+    __table_args__ = (
+        db.Index('ux_user_holdings_user_id_crypto_id', 'user_id', 'crypto_id', unique=True),
+        db.Index('ix_user_holdings_crypto_id', 'crypto_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer)
+    crypto_id = db.Column('crypto_id', db.Integer, db.ForeignKey('currency_information.id'))
+
+    quantity = db.Column(db.Float)
+    # The USD paid for the quantity held, at average cost: a sale takes out its share of the cost basis
+    cost_basis = db.Column(db.Float)
+    last_purchase_date = db.Column(db.DateTime)
+
+    price = db.Column(db.Float)
+    price_date = db.Column(db.DateTime)
+    market_value = db.Column(db.Float)
+    unrealized_pnl = db.Column(db.Float)
+
+
+class IndicatorState(Base):
+    """
+    Persists the carry state of the incremental EWMA and RSI updaters so a new MarketData row can be folded into
+    the running averages without recomputing over the full history
+    """
+
+    __tablename__ = 'indicator_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    crypto_id = db.Column('crypto_id', db.Integer, db.ForeignKey('currency_information.id'))
+    load_date = db.Column(db.DateTime)
+
+    field = db.Column(db.String)
+    indicator = db.Column(db.String)
+    window_type = db.Column(db.String)
+    window_value = db.Column(db.Float)
+    infinite = db.Column(db.Boolean)
+    min_n = db.Column(db.Integer)
+
+    n_obs = db.Column(db.Integer)
+    last_value = db.Column(db.Float)
+    weight_sum = db.Column(db.Float)
+    up_avg = db.Column(db.Float)
+    down_avg = db.Column(db.Float)
+
+
+class SchemaVersion(Base):
+    """
+    The migrations of crypto.db.database applied to the database
+    """
+
+    __tablename__ = 'schema_version'
+
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String)
+    applied_at = db.Column(db.DateTime)
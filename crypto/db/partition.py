@@ -0,0 +1,247 @@
+"""
+Monthly partitioning of market_data.
+
+The loader writes each snapshot into a table per month (market_data_2021_03, ...) registered in market_data_partition.
+Each partition carries its own (crypto_id, load_date) indexes, so inserts only ever touch the small indexes of the
+current month and stay as fast in year five as in month one. The readers in crypto.db.query and crypto.db.rollup route
+reads of market_data through the partitions overlapping the requested range, with the original market_data table
+still read for rows loaded before partitioning was switched on (move_into_partitions migrates them).
+
+Retention drops whole partitions once the daily rollups account for every snapshot in them, which frees the space
+without a DELETE of millions of rows, and compact() hands the freed pages back to the filesystem in small incremental
+steps that never hold the write lock for long:
+
+    loader = MarketDataLoader(engine, partitioned=True)
+    ...
+    apply_retention(engine, keep_days=90)
+    compact(engine)
+"""
+import datetime as dt
+import time
+
+import sqlalchemy as db
+
+from crypto.db.models import MarketData, MarketDataDay, MarketDataPartition
+from crypto.db.upsert import _dialect_insert, upsert
+
+PARTITIONED_TABLE = MarketData.__tablename__
+
+# The partition tables are created on demand and kept out of Base.metadata so create_all never touches them
+_metadata = db.MetaData()
+
+
+def partition_name(load_date):
+    return '{}_{:04d}_{:02d}'.format(PARTITIONED_TABLE, load_date.year, load_date.month)
+
+
+def partition_bounds(load_date):
+    """
+    :return: the first instant of the month of load_date and of the following month
+    """
+    start = dt.datetime(load_date.year, load_date.month, 1)
+    end = dt.datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+    return start, end
+
+
+def partition_table(name):
+    """
+    :param name: the partition table name
+    :return: a Table with the columns and indexes of market_data
+    """
+    if name in _metadata.tables:
+        return _metadata.tables[name]
+
+    columns = [db.Column(column.name, column.type, *[db.ForeignKey(fk.column) for fk in column.foreign_keys],
+                         primary_key=column.primary_key) for column in MarketData.__table__.columns]
+
+    return db.Table(name, _metadata, *columns,
+                    db.Index('ux_{}_crypto_id_load_date'.format(name), 'crypto_id', 'load_date', unique=True),
+                    db.Index('ix_{}_load_date'.format(name), 'load_date'))
+
+
+def partitions(conn, start=None, end=None):
+    """
+    :param conn: an open connection
+    :param start: only partitions holding rows at or after start
+    :param end: only partitions holding rows at or before end
+    :return: the (table_name, start_date, end_date) of the partitions, oldest first
+    """
+    registry = MarketDataPartition.__table__
+    stmt = db.select(registry.c.table_name, registry.c.start_date, registry.c.end_date)
+    if start is not None:
+        stmt = stmt.where(registry.c.end_date > start)
+    if end is not None:
+        stmt = stmt.where(registry.c.start_date <= end)
+
+    return [tuple(row) for row in conn.execute(stmt.order_by(registry.c.start_date))]
+
+
+def ensure_partition(conn, load_date):
+    """
+    Creates the partition of load_date and registers it, if it does not exist yet
+
+    :return: the partition Table
+    """
+    name = partition_name(load_date)
+    table = partition_table(name)
+    if not conn.execute(db.select(MarketDataPartition.__table__.c.id).where(
+            MarketDataPartition.__table__.c.table_name == name)).first():
+        table.create(conn, checkfirst=True)
+        start, end = partition_bounds(load_date)
+        conn.execute(MarketDataPartition.__table__.insert(), {'table_name': name, 'start_date': start, 'end_date': end})
+
+    return table
+
+
+def write(conn, rows, batch_size=10000):
+    """
+    Upserts MarketData rows into the partitions of their load_date
+
+    :param conn: an open connection, inside the loader's transaction
+    :param rows: a list of dicts keyed by column name
+    :param batch_size: the number of rows per executemany call
+    :return: the number of rows sent
+    """
+    by_partition = {}
+    for row in rows:
+        # Without a load_date there is no partition to route to, such rows stay in market_data itself
+        key = partition_name(row['load_date']) if row.get('load_date') is not None else None
+        by_partition.setdefault(key, []).append(row)
+
+    for key, partition_rows in by_partition.items():
+        if key is None:
+            table = MarketData.__table__
+        else:
+            table = ensure_partition(conn, partition_rows[0]['load_date'])
+        upsert(conn, table, partition_rows, batch_size=batch_size)
+
+    return len(rows)
+
+
+def move_into_partitions(engine):
+    """
+    Moves the rows of the original market_data table into the monthly partitions, one month per transaction
+
+    :return: the number of rows moved
+    """
+    source = MarketData.__table__
+    with engine.connect() as conn:
+        first, last = conn.execute(db.select(db.func.min(source.c.load_date), db.func.max(source.c.load_date))).one()
+    if first is None:
+        return 0
+
+    moved = 0
+    month = partition_bounds(first)[0]
+    while month <= last:
+        start, end = partition_bounds(month)
+        with engine.begin() as conn:
+            table = ensure_partition(conn, start)
+            columns = [column.name for column in source.columns if column.name != 'id']
+            in_month = (source.c.load_date >= start) & (source.c.load_date < end)
+
+            stmt = _dialect_insert(conn)(table).from_select(
+                columns, db.select(*[source.c[column] for column in columns]).where(in_month))
+            conn.execute(stmt.on_conflict_do_nothing(index_elements=['crypto_id', 'load_date']))
+            moved += conn.execute(source.delete().where(in_month)).rowcount
+        month = end
+
+    return moved
+
+
+def _covered(conn, name, start, end):
+    """
+    :return: whether the daily rollups account for every snapshot of the partition, coin by coin: each coin's day bars
+        over the partition's range must count at least as many snapshots as the partition holds of it
+    """
+    table = partition_table(name)
+    rows = db.select(table.c.crypto_id, db.func.count().label('n_rows')).group_by(table.c.crypto_id).subquery()
+    bars = MarketDataDay.__table__
+    obs = db.select(bars.c.crypto_id, db.func.sum(bars.c.n_obs).label('n_obs')).where(
+        (bars.c.load_date >= start) & (bars.c.load_date < end)).group_by(bars.c.crypto_id).subquery()
+
+    uncovered = db.select(rows.c.crypto_id).select_from(
+        rows.outerjoin(obs, obs.c.crypto_id == rows.c.crypto_id)).where(
+        db.func.coalesce(obs.c.n_obs, 0) < rows.c.n_rows).limit(1)
+
+    return conn.execute(uncovered).first() is None
+
+
+def apply_retention(engine, keep_days, now=None):
+    """
+    Drops the partitions that end more than keep_days ago, once their snapshots are covered by the rollups
+
+    :param engine: the SQLAlchemy engine
+    :param keep_days: the number of days of raw snapshots kept
+    :param now: the reference time, defaults to the current UTC time
+    :return: a dict with the dropped partition names and the expired partitions kept because the rollups do not
+        cover them yet
+    """
+    cutoff = (now or dt.datetime.utcnow()) - dt.timedelta(days=keep_days)
+    with engine.connect() as conn:
+        expired = [(name, start, end) for name, start, end in partitions(conn) if end <= cutoff]
+
+    dropped, uncovered = [], []
+    for name, start, end in expired:
+        with engine.begin() as conn:
+            if not _covered(conn, name, start, end):
+                uncovered.append(name)
+                continue
+            conn.execute(MarketDataPartition.__table__.delete().where(
+                MarketDataPartition.__table__.c.table_name == name))
+            partition_table(name).drop(conn, checkfirst=True)
+        dropped.append(name)
+
+    return {'dropped': dropped, 'uncovered': uncovered}
+
+
+def enable_incremental_vacuum(engine):
+    """
+    Switches a SQLite database to auto_vacuum=INCREMENTAL, which compact() relies on. This rewrites the database with
+    a full VACUUM, so run it once in a maintenance window. No-op for other databases.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    # VACUUM cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2:
+            return
+        conn.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.exec_driver_sql('VACUUM')
+
+
+def compact(engine, pages_per_step=1000, pause=0.01, max_steps=None):
+    """
+    Returns the free pages of the database (e.g. after apply_retention) to the filesystem a few at a time, each step in
+    its own short write transaction so the loader is never blocked for more than one step
+
+    :param engine: the SQLAlchemy engine
+    :param pages_per_step: the number of pages released per transaction
+    :param pause: the seconds slept between steps to let writers in
+    :param max_steps: stop after this many steps, run until the free list is empty when None
+    :return: the number of pages released
+    """
+    if engine.dialect.name != 'sqlite':
+        return 0
+
+    with engine.connect() as conn:
+        if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+            raise ValueError('Incremental compaction needs auto_vacuum=INCREMENTAL, see enable_incremental_vacuum.')
+        free = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+
+    released, steps = 0, 0
+    while free > 0 and (max_steps is None or steps < max_steps):
+        with engine.begin() as conn:
+            conn.exec_driver_sql('PRAGMA incremental_vacuum({})'.format(int(pages_per_step)))
+            remaining = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+        released += free - remaining
+        free = remaining
+        steps += 1
+        time.sleep(pause)
+
+    # In WAL mode the file only shrinks once the truncation is checkpointed, PASSIVE never waits on the loader
+    with engine.connect() as conn:
+        conn.exec_driver_sql('PRAGMA wal_checkpoint(PASSIVE)')
+
+    return released
@@ -0,0 +1,245 @@
+"""
+Read helpers for the time-series tables that return NumPy arrays instead of ORM objects, so the results can be handed
+straight to the kernels in crypto.analytics. Each helper returns a dict of {column: array} with crypto_id and user_id
+as int64, load_date (and any other *_date column) as datetime64[us] and every value column as float64 (NULL -> NaN).
+
+The queries are written to be answered from the (crypto_id, load_date) indexes declared on the models. Reads of
+market_data are routed through the monthly partitions of crypto.db.partition overlapping the requested range.
+"""
+import numpy as np
+import sqlalchemy as db
+
+from crypto.db.partition import PARTITIONED_TABLE, partitions
+
+
+def _table_name(table):
+    return table if isinstance(table, str) else getattr(table, '__tablename__', None) or table.name
+
+
+def _tables(conn, name, start=None, end=None):
+    """
+    :return: the tables holding the rows of name between start and end, oldest first: market_data followed by its
+        overlapping partitions, any other table as is
+    """
+    if name != PARTITIONED_TABLE:
+        return [name]
+
+    return [name] + [partition for partition, _, _ in partitions(conn, start, end)]
+
+
+def _concat(parts, columns):
+    """
+    :param parts: the arrays read from each table
+    :return: the arrays of all the tables ordered by load_date, rows of a table keeping their order on ties
+    """
+    if len(parts) == 1:
+        return parts[0]
+
+    arrays = {column: np.concatenate([part[column] for part in parts]) for column in columns}
+    order = np.argsort(arrays['load_date'], kind='stable')
+
+    return {column: values[order] for column, values in arrays.items()}
+
+
+def _to_arrays(rows, columns):
+    """
+    :param rows: the raw result rows
+    :param columns: the selected column names, in order
+    :return: a dict of {column: array}
+    """
+    if rows:
+        values = list(zip(*rows))
+    else:
+        values = [()] * len(columns)
+
+    arrays = {}
+    for column, value in zip(columns, values):
+        if column in ('crypto_id', 'user_id'):
+            arrays[column] = np.array(value, dtype=np.int64)
+        elif column.endswith('_date'):
+            arrays[column] = np.array(value, dtype='datetime64[us]')
+        else:
+            arrays[column] = np.array(value, dtype=np.float64)
+
+    return arrays
+
+
+_DATE_PARAMS = ('as_of', 'start', 'end', 'since')
+
+
+def _execute(conn, sql, params, columns):
+    # Plain text SQL so the driver's raw values are returned without per-row type processing. The date parameters are
+    # still bound as DateTime so they are formatted the same way the ORM stores load_date
+    stmt = db.text(sql).bindparams(*[db.bindparam(key, type_=db.DateTime) for key in params if key in _DATE_PARAMS])
+
+    return _to_arrays(conn.execute(stmt, params).fetchall(), columns)
+
+
+def latest_per_coin(conn, table, columns, as_of=None, crypto_ids=None):
+    """
+    The most recent row of every coin, e.g. the current universe for the ranking job
+
+    :param conn: an open connection
+    :param table: the model (e.g. CryptoRunningAverages) or table name
+    :param columns: the value columns to return
+    :param as_of: only consider rows with load_date <= as_of
+    :param crypto_ids: only return these coins
+    :return: a dict of arrays of crypto_id, load_date and the columns, one entry per coin ordered by crypto_id
+    """
+    name = _table_name(table)
+    columns = ['crypto_id', 'load_date'] + [column for column in columns if column not in ('crypto_id', 'load_date')]
+
+    conditions, params = ['t.crypto_id = coin.id'], {}
+    if as_of is not None:
+        conditions.append('t.load_date <= :as_of')
+        params['as_of'] = as_of
+
+    # Newest partition first: once a coin is found the older tables are not searched for it again. The original
+    # market_data table may hold rows of any date and is always searched
+    tables = _tables(conn, name, end=as_of)
+    found, parts = [], []
+    for source in tables[:0:-1] + tables[:1]:
+        coins = []
+        if crypto_ids is not None:
+            coins.append('coin.id IN ({})'.format(', '.join(str(int(_id)) for _id in crypto_ids)))
+        if found and source != name:
+            coins.append('coin.id NOT IN ({})'.format(', '.join(str(int(_id)) for _id in found)))
+
+        # Driving the lookup from currency_information turns it into one (crypto_id, load_date) index seek per coin
+        # rather than a GROUP BY over the whole index
+        sql = '''
+            SELECT {select}
+            FROM currency_information AS coin
+            JOIN {table} AS latest ON latest.id = (
+                SELECT t.id FROM {table} AS t WHERE {where} ORDER BY t.load_date DESC LIMIT 1
+            )
+            {coins}
+            ORDER BY coin.id
+        '''.format(select=', '.join('latest.' + column for column in columns), table=source,
+                   where=' AND '.join(conditions), coins='WHERE ' + ' AND '.join(coins) if coins else '')
+        parts.append(_execute(conn, sql, params, columns))
+        found.extend(parts[-1]['crypto_id'].tolist())
+
+    if len(parts) == 1:
+        return parts[0]
+
+    # The latest row of each coin across the tables
+    arrays = {column: np.concatenate([part[column] for part in parts]) for column in columns}
+    order = np.lexsort((arrays['load_date'], arrays['crypto_id']))
+    ids = arrays['crypto_id'][order]
+    last = order[np.append(ids[1:] != ids[:-1], True)] if ids.shape[0] else order
+
+    return {column: values[last] for column, values in arrays.items()}
+
+
+def rows_since(conn, table, columns, since=None, crypto_ids=None):
+    """
+    Every row after since, e.g. the rows an incremental job has not folded in yet
+
+    :param conn: an open connection
+    :param table: the model or table name
+    :param columns: the value columns to return
+    :param since: only rows with load_date > since, every row when None
+    :param crypto_ids: only return these coins
+    :return: a dict of arrays of crypto_id, load_date and the columns, ordered by crypto_id and load_date
+    """
+    name = _table_name(table)
+    columns = ['crypto_id', 'load_date'] + [column for column in columns if column not in ('crypto_id', 'load_date')]
+
+    conditions, params = ['1 = 1'], {}
+    if since is not None:
+        conditions.append('load_date > :since')
+        params['since'] = since
+    if crypto_ids is not None:
+        conditions.append('crypto_id IN ({})'.format(', '.join(str(int(_id)) for _id in crypto_ids)))
+
+    parts = []
+    for source in _tables(conn, name, since):
+        sql = 'SELECT {select} FROM {table} WHERE {where}'.format(
+            select=', '.join(columns), table=source, where=' AND '.join(conditions))
+        parts.append(_execute(conn, sql, params, columns))
+
+    arrays = {column: np.concatenate([part[column] for part in parts]) for column in columns}
+    order = np.lexsort((arrays['load_date'], arrays['crypto_id']))
+
+    return {column: values[order] for column, values in arrays.items()}
+
+
+def range_scan(conn, table, crypto_id, columns, start=None, end=None):
+    """
+    The rows of one coin between start and end (inclusive), ordered by load_date
+
+    :param conn: an open connection
+    :param table: the model or table name
+    :param crypto_id: the coin to read
+    :param columns: the value columns to return
+    :param start: the first load_date, unbounded when None
+    :param end: the last load_date, unbounded when None
+    :return: a dict of arrays of load_date and the columns
+    """
+    name = _table_name(table)
+    columns = ['load_date'] + [column for column in columns if column != 'load_date']
+
+    conditions, params = ['crypto_id = :crypto_id'], {'crypto_id': int(crypto_id)}
+    if start is not None:
+        conditions.append('load_date >= :start')
+        params['start'] = start
+    if end is not None:
+        conditions.append('load_date <= :end')
+        params['end'] = end
+
+    parts = []
+    for table in _tables(conn, name, start, end):
+        sql = 'SELECT {select} FROM {table} WHERE {where} ORDER BY load_date'.format(
+            select=', '.join(columns), table=table, where=' AND '.join(conditions))
+        parts.append(_execute(conn, sql, params, columns))
+
+    return _concat(parts, columns)
+
+
+def _row_before(conn, table, crypto_id, columns, start):
+    # The last row strictly before start, so the first left rows of a range have a right-hand match
+    parts = []
+    for name in _tables(conn, _table_name(table), end=start):
+        sql = 'SELECT {select} FROM {table} WHERE crypto_id = :crypto_id AND load_date < :start ' \
+              'ORDER BY load_date DESC LIMIT 1'.format(select=', '.join(columns), table=name)
+        parts.append(_execute(conn, sql, {'crypto_id': int(crypto_id), 'start': start}, columns))
+
+    arrays = _concat(parts, columns)
+    return {column: values[-1:] for column, values in arrays.items()}
+
+
+def as_of_join(conn, left, right, crypto_id, left_columns, right_columns, start=None, end=None):
+    """
+    Pairs every row of left with the latest row of right at or before its load_date, for one coin. E.g. each
+    MarketData snapshot with the running averages in force at that time.
+
+    :param conn: an open connection
+    :param left: the model or table name driving the join
+    :param right: the model or table name matched as of each left load_date
+    :param crypto_id: the coin to read
+    :param left_columns: the value columns of left to return
+    :param right_columns: the value columns of right to return, prefixed with the right table name in the result
+    :param start: the first left load_date, unbounded when None
+    :param end: the last left load_date, unbounded when None
+    :return: a dict of arrays of load_date, the left columns and the right columns; right values with no earlier
+        match are NaN
+    """
+    out = range_scan(conn, left, crypto_id, left_columns, start, end)
+    if out['load_date'].size == 0:
+        for column in right_columns:
+            out['{}.{}'.format(_table_name(right), column)] = np.empty(0, dtype=np.float64)
+        return out
+
+    rhs = range_scan(conn, right, crypto_id, right_columns, start, out['load_date'][-1].item())
+    if start is not None:
+        before = _row_before(conn, right, crypto_id, ['load_date'] + list(right_columns), start)
+        rhs = {column: np.concatenate((before[column], rhs[column])) for column in rhs}
+
+    # Index of the last right row at or before each left row, -1 when there is none
+    idx = np.searchsorted(rhs['load_date'], out['load_date'], side='right') - 1
+    for column in right_columns:
+        values = np.append(rhs[column], np.nan)
+        out['{}.{}'.format(_table_name(right), column)] = values[idx]
+
+    return out
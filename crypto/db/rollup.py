@@ -0,0 +1,368 @@
+"""
+OHLC rollups of market_data at 1 minute, 1 hour and 1 day resolution.
+
+Each level aggregates the one below it (raw snapshots -> 1m -> 1h -> 1d). Loading a snapshot folds it into the open bar
+of every level with roll_forward(), which reads and writes one bar per coin per level. Snapshots that arrive out of
+order, or a replayed load, fall back to recomputing the buckets they touch from the level below, so the rollups always
+match a rebuild from market_data (update_rollups / rebuild_rollups).
+
+The readers pick the coarsest level that answers a request: bars() returns the bars of the coarsest resolution aligned
+with the range, summarize() covers a range with days in the middle and hours, minutes and raw snapshots only at the
+ragged edges, so a year of history is read as ~365 daily rows instead of millions of snapshots.
+"""
+import numpy as np
+import sqlalchemy as db
+
+from crypto.db.models import MarketData, MarketDataDay, MarketDataHour, MarketDataMinute
+from crypto.db.partition import partitions
+from crypto.db.query import _execute, _tables, _to_arrays
+from crypto.db.upsert import upsert
+
+BAR_COLUMNS = ('open', 'high', 'low', 'close', 'market_cap', 'market_cap_percentage', 'n_obs', 'n_pct', 'last_date')
+SNAPSHOT_COLUMNS = ('crypto_id', 'load_date', 'trade_price', 'market_cap', 'market_cap_percentage')
+
+# (name, model, bucket unit) from the finest to the coarsest level
+RESOLUTIONS = (
+    ('1m', MarketDataMinute, 'm'),
+    ('1h', MarketDataHour, 'h'),
+    ('1d', MarketDataDay, 'D'),
+)
+
+
+def _datetime64(value):
+    return np.datetime64(value, 'us')
+
+
+def _floor(dates, unit):
+    return dates.astype('datetime64[{}]'.format(unit)).astype('datetime64[us]')
+
+
+def _step(unit):
+    return np.timedelta64(1, unit).astype('timedelta64[us]')
+
+
+def _sort(arrays):
+    order = np.lexsort((arrays['load_date'], arrays['crypto_id']))
+    return {column: values[order] for column, values in arrays.items()}
+
+
+def _as_bars(snapshots):
+    # A snapshot is a bar of one observation
+    price = snapshots['trade_price']
+    return _sort({
+        'crypto_id': snapshots['crypto_id'],
+        'load_date': snapshots['load_date'],
+        'open': price,
+        'high': price,
+        'low': price,
+        'close': price,
+        'market_cap': snapshots['market_cap'],
+        'market_cap_percentage': snapshots['market_cap_percentage'],
+        'n_obs': np.ones(price.shape[0], dtype=np.int64),
+        'n_pct': np.isfinite(snapshots['market_cap_percentage']).astype(np.int64),
+        'last_date': snapshots['load_date'],
+    })
+
+
+def _read(conn, table, start, end, crypto_ids=None):
+    """
+    :return: the rows of table with start <= load_date < end as bar columns, sorted by crypto_id and load_date
+    """
+    raw = table is MarketData
+    columns = list(SNAPSHOT_COLUMNS) if raw else ['crypto_id', 'load_date'] + list(BAR_COLUMNS)
+
+    where = 'load_date >= :start AND load_date < :end'
+    if crypto_ids is not None:
+        where += ' AND crypto_id IN ({})'.format(', '.join(str(int(_id)) for _id in crypto_ids))
+    params = {'start': start.item(), 'end': end.item()}
+    parts = [_execute(conn, 'SELECT {} FROM {} WHERE {}'.format(', '.join(columns), name, where), params, columns)
+             for name in _tables(conn, table.__tablename__, params['start'], params['end'])]
+    arrays = {column: np.concatenate([part[column] for part in parts]) for column in columns}
+
+    return _as_bars(arrays) if raw else _sort(arrays)
+
+
+def _pct_weight(bars):
+    # The number of snapshots behind each bar's market_cap_percentage, none when it is missing
+    return np.where(np.isnan(bars['market_cap_percentage']), 0., np.nan_to_num(bars['n_pct']))
+
+
+def _reduce(arrays, first):
+    """
+    :param arrays: bar columns sorted by crypto_id and load_date
+    :param first: the index of the first row of each output bar
+    :return: one bar per group of rows, load_date being that of the first row
+    """
+    last = np.append(first[1:], arrays['crypto_id'].shape[0]) - 1
+
+    # The average market_cap_percentage is weighted by the snapshots that had one
+    pct = arrays['market_cap_percentage']
+    weight = _pct_weight(arrays)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average_pct = np.add.reduceat(np.nan_to_num(pct) * weight, first) / np.add.reduceat(weight, first)
+
+    return {
+        'crypto_id': arrays['crypto_id'][first],
+        'load_date': arrays['load_date'][first],
+        'open': arrays['open'][first],
+        'high': np.fmax.reduceat(arrays['high'], first),
+        'low': np.fmin.reduceat(arrays['low'], first),
+        'close': arrays['close'][last],
+        'market_cap': arrays['market_cap'][last],
+        'market_cap_percentage': average_pct,
+        'n_obs': np.add.reduceat(arrays['n_obs'], first).astype(np.int64),
+        'n_pct': np.add.reduceat(weight, first).astype(np.int64),
+        'last_date': arrays['last_date'][last],
+    }
+
+
+def _aggregate(arrays, unit):
+    """
+    :param arrays: bar columns sorted by crypto_id and load_date
+    :param unit: the numpy datetime unit of the buckets
+    :return: one bar per (crypto_id, bucket), keyed on the bucket start, and the load_date of the first row of each
+    """
+    n = arrays['crypto_id'].shape[0]
+    if n == 0:
+        return {column: values[:0] for column, values in arrays.items()}, arrays['load_date'][:0]
+
+    bucket = _floor(arrays['load_date'], unit)
+    new_bar = np.empty(n, dtype=np.bool_)
+    new_bar[0] = True
+    new_bar[1:] = (np.diff(arrays['crypto_id']) != 0) | (bucket[1:] != bucket[:-1])
+
+    bars = _reduce(arrays, np.flatnonzero(new_bar))
+    first_date = bars['load_date']
+    bars['load_date'] = _floor(first_date, unit)
+
+    return bars, first_date
+
+
+def _merge(old, new):
+    """
+    Appends bars that start after old ends (row for row) onto old
+    """
+    old_weight, new_weight = _pct_weight(old), _pct_weight(new)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pct = (np.nan_to_num(old['market_cap_percentage']) * old_weight +
+               np.nan_to_num(new['market_cap_percentage']) * new_weight) / (old_weight + new_weight)
+
+    return dict(new, **{
+        'open': old['open'],
+        'high': np.fmax(old['high'], new['high']),
+        'low': np.fmin(old['low'], new['low']),
+        'market_cap_percentage': pct,
+        'n_obs': (old['n_obs'] + new['n_obs']).astype(np.int64),
+        'n_pct': (old_weight + new_weight).astype(np.int64),
+    })
+
+
+def _keys(bars, unit):
+    # One int64 per (crypto_id, bucket), ordered the same way as the bars
+    return (bars['crypto_id'] << 32) + bars['load_date'].astype('datetime64[{}]'.format(unit)).astype(np.int64)
+
+
+def _rows(bars):
+    columns = list(bars)
+    values = [bars[column].tolist() for column in columns]
+    # NaN is written as NULL, the same as a missing value in market_data
+    return [{column: None if value != value else value for column, value in zip(columns, row)} for row in zip(*values)]
+
+
+def _recompute(conn, source, model, unit, start, end, crypto_ids=None):
+    lo, hi = _floor(start, unit), _floor(end, unit) + _step(unit)
+    bars, _ = _aggregate(_read(conn, source, lo, hi, crypto_ids), unit)
+
+    return upsert(conn, model.__table__, _rows(bars))
+
+
+def update_rollups(conn, start, end, crypto_ids=None):
+    """
+    Recomputes every rollup bucket containing a load_date between start and end (inclusive) from market_data
+
+    :param conn: an open connection
+    :param start: the earliest load_date to cover
+    :param end: the latest load_date to cover
+    :param crypto_ids: only recompute these coins, all coins when None
+    :return: a dict of {resolution: bars written}
+    """
+    start, end = _datetime64(start), _datetime64(end)
+
+    written = {}
+    source = MarketData
+    for name, model, unit in RESOLUTIONS:
+        written[name] = _recompute(conn, source, model, unit, start, end, crypto_ids)
+        source = model
+
+    return written
+
+
+def roll_forward(conn, rows):
+    """
+    Folds newly loaded snapshots into the rollups. A bar is extended in place when the new snapshots come after the
+    last snapshot already in it, otherwise its bucket is recomputed from the level below.
+
+    :param conn: an open connection, inside the loader's transaction after market_data was written
+    :param rows: the MarketData rows loaded, dicts with at least crypto_id, load_date and the snapshot values
+    :return: a dict of {resolution: bars written}
+    """
+    snapshots = _to_arrays([tuple(row.get(column) for column in SNAPSHOT_COLUMNS) for row in rows], SNAPSHOT_COLUMNS)
+    loaded = ~np.isnat(snapshots['load_date'])
+    snapshots = _as_bars({column: values[loaded] for column, values in snapshots.items()})
+
+    written = {}
+    source = MarketData
+    for name, model, unit in RESOLUTIONS:
+        new, first_date = _aggregate(snapshots, unit)
+        if new['crypto_id'].shape[0] == 0:
+            written[name] = 0
+            continue
+
+        old = _read(conn, model, new['load_date'].min(), new['load_date'].max() + _step(unit),
+                    np.unique(new['crypto_id']))
+        old_keys, new_keys = _keys(old, unit), _keys(new, unit)
+        idx = np.searchsorted(old_keys, new_keys)
+        found = np.append(old_keys, -1)[idx] == new_keys
+        # NaT compares False, so a bar missing its last_date is recomputed
+        extend = found.copy()
+        extend[found] = old['last_date'][idx[found]] < first_date[found]
+        stale = found & ~extend
+
+        bars = {column: values.copy() for column, values in new.items()}
+        if extend.any():
+            merged = _merge({column: values[idx[extend]] for column, values in old.items()},
+                            {column: values[extend] for column, values in new.items()})
+            for column, values in merged.items():
+                bars[column][extend] = values
+        keep = ~stale
+        written[name] = upsert(conn, model.__table__, _rows({column: values[keep] for column, values in bars.items()}))
+
+        if stale.any():
+            # Late or replayed snapshots, the level below is already up to date
+            written[name] += _recompute(conn, source, model, unit, new['load_date'][stale].min(),
+                                        new['load_date'][stale].max(), np.unique(new['crypto_id'][stale]))
+        source = model
+
+    return written
+
+
+def rebuild_rollups(engine, start=None, end=None, days_per_batch=7):
+    """
+    Backfills the rollups over existing market_data a few days at a time, one transaction per batch
+
+    :param engine: the SQLAlchemy engine
+    :param start: the first day to rebuild, the first load_date in market_data when None
+    :param end: the last day to rebuild, the last load_date in market_data when None
+    :param days_per_batch: the number of days of snapshots held in memory at once
+    :return: a dict of {resolution: bars written}
+    """
+    if start is None or end is None:
+        with engine.connect() as conn:
+            first, last = conn.execute(db.select(db.func.min(MarketData.load_date),
+                                                 db.func.max(MarketData.load_date))).one()
+            # The partitions are bounded by their months, which is close enough to size the batches
+            for _, partition_start, partition_end in partitions(conn):
+                first = partition_start if first is None else min(first, partition_start)
+                last = partition_end if last is None else max(last, partition_end)
+        if first is None:
+            return {name: 0 for name, _, _ in RESOLUTIONS}
+        start = start if start is not None else first
+        end = end if end is not None else last
+
+    day = _floor(_datetime64(start), 'D')
+    end = _datetime64(end)
+    step = _step('D') * days_per_batch
+
+    written = {name: 0 for name, _, _ in RESOLUTIONS}
+    while day <= end:
+        # Each batch ends on a day boundary so no bucket straddles two batches
+        batch_end = min(day + step - _step('us'), end)
+        with engine.begin() as conn:
+            for name, n in update_rollups(conn, day, batch_end).items():
+                written[name] += n
+        day += step
+
+    return written
+
+
+def resolution_for(start, end):
+    """
+    :param start: the first load_date of the range
+    :param end: the end of the range, exclusive
+    :return: the coarsest (name, model, unit) whose buckets start at start and end at end, None when the range is not
+        minute-aligned and only the raw snapshots can answer it
+    """
+    start, end = _datetime64(start), _datetime64(end)
+    for resolution in reversed(RESOLUTIONS):
+        unit = resolution[2]
+        if _floor(start, unit) == start and _floor(end, unit) == end:
+            return resolution
+
+    return None
+
+
+def bars(conn, crypto_id, start, end, resolution=None):
+    """
+    The bars of one coin over [start, end)
+
+    :param conn: an open connection
+    :param crypto_id: the coin to read
+    :param start: the first load_date of the range
+    :param end: the end of the range, exclusive
+    :param resolution: '1m', '1h' or '1d', the coarsest resolution aligned with the range when None
+    :return: a dict of arrays of load_date (the bucket start) and the bar columns; single-observation bars built from
+        the raw snapshots when the range is not minute-aligned
+    """
+    if resolution is None:
+        resolution = resolution_for(start, end)
+    elif isinstance(resolution, str):
+        resolution = next(level for level in RESOLUTIONS if level[0] == resolution)
+
+    model = MarketData if resolution is None else resolution[1]
+    arrays = _read(conn, model, _datetime64(start), _datetime64(end), [crypto_id])
+    del arrays['crypto_id']
+
+    return arrays
+
+
+def _cover(start, end, levels):
+    """
+    Splits [start, end) into pieces answered by the coarsest level possible
+
+    :return: a list of (model, start, end)
+    """
+    if start >= end:
+        return []
+    if not levels:
+        return [(MarketData, start, end)]
+
+    _, model, unit = levels[-1]
+    inner_start = _floor(start - _step('us'), unit) + _step(unit)
+    inner_end = _floor(end, unit)
+    if inner_start >= inner_end:
+        return _cover(start, end, levels[:-1])
+
+    return _cover(start, inner_start, levels[:-1]) + [(model, inner_start, inner_end)] + \
+        _cover(inner_end, end, levels[:-1])
+
+
+def summarize(conn, crypto_id, start, end):
+    """
+    One bar over [start, end) for a coin, read from the coarsest rollups covering the range
+
+    :param conn: an open connection
+    :param crypto_id: the coin to read
+    :param start: the first load_date of the range
+    :param end: the end of the range, exclusive
+    :return: a dict of the bar columns, NaN/0 observations when the range is empty
+    """
+    pieces = [_read(conn, model, lo, hi, [crypto_id]) for model, lo, hi in
+              _cover(_datetime64(start), _datetime64(end), RESOLUTIONS)]
+    arrays = {column: np.concatenate([piece[column] for piece in pieces]) for column in pieces[0]} if pieces else None
+    if arrays is None or arrays['crypto_id'].shape[0] == 0:
+        return dict({column: np.nan for column in BAR_COLUMNS}, n_obs=0, n_pct=0, last_date=None)
+
+    order = np.argsort(arrays['load_date'], kind='stable')
+    bar = _reduce({column: values[order] for column, values in arrays.items()}, np.array([0]))
+
+    return {column: bar[column][0].item() for column in BAR_COLUMNS}
@@ -0,0 +1,282 @@
+"""
+Memory-mapped columnar copy of the time-series tables, laid out for the kernels in crypto.analytics.indicators.
+
+Every coin gets one contiguous, append-only file per field under <root>/<table>/<crypto_id>/, and a manifest per table
+records how many rows of each coin are committed. Reads are np.memmap views sized from the manifest, so handing a
+column to a numba kernel maps the file instead of materializing rows:
+
+    store = ColumnarStore('/data/store', 'market_data')
+    store.sync(conn)  # appends whatever landed in SQL since the last sync
+    ewma = _ewma(store.read(crypto_id, 'trade_price'), ('span', 30))
+
+    store.resync(conn, [1, 2])  # after a backfill of coins 1 and 2, rewrites their files from SQL
+
+The SQL tables stay the system of record; the store can be deleted and rebuilt with sync() at any time. sync() only
+appends, so rows written behind a coin's last synced load_date, by crypto.backfill or a late snapshot, and rewrites of
+rows already synced need a resync() of the coins, which writes a new generation of their files and switches the
+manifest over to it in one commit.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import sqlalchemy as db
+
+from crypto.db.models import CryptoCurrencies
+from crypto.db.query import _concat, _tables, _to_arrays
+
+# The columns mirrored for each table; load_date is always stored alongside them
+STORE_FIELDS = {
+    'market_data': ('market_cap', 'market_cap_percentage', 'trade_price', 'ranking'),
+    'running_averages': ('ewma_market_cap', 'ewma_market_cap_percentage', 'ewma_trade_price', 'ewma_volatility',
+                         'ewma_ranking'),
+}
+
+DATE_DTYPE = np.dtype('datetime64[us]')
+VALUE_DTYPE = np.dtype(np.float64)
+
+
+class ColumnarStore:
+    """
+    Append-only, memory-mapped column files for one table
+    """
+
+    def __init__(self, root, table, fields=None):
+        """
+        :param root: the directory holding the store
+        :param table: the table mirrored, e.g. 'market_data'
+        :param fields: the value columns stored, defaults to STORE_FIELDS[table]
+        """
+        self.table = table
+        self.fields = tuple(fields or STORE_FIELDS[table])
+        self.path = os.path.join(root, table)
+        os.makedirs(self.path, exist_ok=True)
+
+        self.manifest_path = os.path.join(self.path, 'manifest.json')
+        self.manifest = self._load_manifest()
+
+    # Manifest ---------------------------------------------------------------------------------------------------------
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {'table': self.table, 'fields': list(self.fields), 'coins': {}}
+
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['fields'] != list(self.fields):
+            raise ValueError('The store at {} holds fields {}, not {}.'.format(self.path, manifest['fields'],
+                                                                               list(self.fields)))
+
+        return manifest
+
+    def _save_manifest(self):
+        # Written to a temporary file and renamed so a crash never leaves a torn manifest behind
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+
+    def coins(self):
+        return sorted(int(crypto_id) for crypto_id in self.manifest['coins'])
+
+    def rows(self, crypto_id):
+        return self.manifest['coins'].get(str(crypto_id), {}).get('rows', 0)
+
+    def last_load_date(self, crypto_id):
+        """
+        :return: the load_date of the last committed row of the coin as a datetime64, None when it has no rows
+        """
+        last = self.manifest['coins'].get(str(crypto_id), {}).get('last_load_date')
+        return None if last is None else np.datetime64(last, 'us')
+
+    # Files ------------------------------------------------------------------------------------------------------------
+    def _directory(self, crypto_id, generation=None):
+        # Each resync() writes the coin's files into the directory of a new generation, the first one being plain
+        if generation is None:
+            generation = self.manifest['coins'].get(str(crypto_id), {}).get('generation', 0)
+
+        return os.path.join(self.path, str(crypto_id) if not generation else '{}.{}'.format(crypto_id, generation))
+
+    def _file(self, crypto_id, field):
+        return os.path.join(self._directory(crypto_id), field + '.bin')
+
+    def read(self, crypto_id, field):
+        """
+        :param crypto_id: the coin to read
+        :param field: a value column, or 'load_date'
+        :return: a read-only array mapped onto the column file; nothing is copied until it is touched
+        """
+        n = self.rows(crypto_id)
+        dtype = DATE_DTYPE if field == 'load_date' else VALUE_DTYPE
+        if n == 0:
+            return np.empty(0, dtype=dtype)
+
+        # Rows past the manifest count belong to an append that never committed and are ignored
+        return np.memmap(self._file(crypto_id, field), dtype=dtype, mode='r', shape=(n,)).view(np.ndarray)
+
+    def append(self, crypto_id, load_date, columns, commit=True):
+        """
+        :param crypto_id: the coin the rows belong to
+        :param load_date: the load_dates of the new rows, increasing and after the last committed row
+        :param columns: a dict of {field: values} for every stored field
+        :param commit: write the manifest, set False to batch several coins into one commit()
+        :return: the number of rows appended
+        """
+        load_date = np.asarray(load_date, dtype=DATE_DTYPE)
+        n = load_date.shape[0]
+        if n == 0:
+            return 0
+
+        last = self.last_load_date(crypto_id)
+        if last is not None and load_date[0] <= last:
+            raise ValueError('Rows for coin {} must come after {}.'.format(crypto_id, last))
+
+        os.makedirs(self._directory(crypto_id), exist_ok=True)
+        committed = self.rows(crypto_id)
+        for field in ('load_date',) + self.fields:
+            values = load_date if field == 'load_date' else np.asarray(columns[field], dtype=VALUE_DTYPE)
+            dtype = DATE_DTYPE if field == 'load_date' else VALUE_DTYPE
+
+            with open(self._file(crypto_id, field), 'r+b' if os.path.exists(self._file(crypto_id, field)) else 'wb') \
+                    as f:
+                # Overwriting any tail left by an append that crashed before its manifest commit
+                f.seek(committed * dtype.itemsize)
+                f.write(np.ascontiguousarray(values).tobytes())
+                f.truncate()
+
+        self.manifest['coins'][str(crypto_id)] = dict(self.manifest['coins'].get(str(crypto_id), {}),
+                                                      rows=committed + n, last_load_date=str(load_date[-1]))
+        if commit:
+            self.commit()
+
+        return n
+
+    def commit(self):
+        self._save_manifest()
+
+    # Sync -------------------------------------------------------------------------------------------------------------
+    def sync(self, conn, batch_rows=1000000):
+        """
+        Appends the rows of the SQL table that are newer than each coin's last committed load_date. Coins the store
+        has no rows of yet are read in full, however old their rows are. A coin with rows read back that are behind
+        its last load_date and missing from its files is resynced; rows older than every coin's last load_date are not
+        read at all, see resync().
+
+        :param conn: an open connection
+        :param batch_rows: the number of rows fetched from the database at a time
+        :return: the number of rows appended, or rewritten by a resync
+        """
+        synced = [crypto_id for crypto_id in self.coins() if self.last_load_date(crypto_id) is not None]
+        since = min(self.last_load_date(crypto_id) for crypto_id in synced).item() if synced else None
+        # The coins without a watermark are looked up one index seek each, rather than scanned for with a NOT IN
+        table = CryptoCurrencies.__table__
+        new = sorted(set(conn.execute(db.select(table.c.id)).scalars()) - set(synced))
+
+        columns = ['crypto_id', 'load_date'] + list(self.fields)
+        passes = []
+        if synced:
+            passes.append(('load_date > :since AND crypto_id IN ({})'.format(', '.join(map(str, synced))),
+                           {'since': since}))
+        if new:
+            passes.append(('crypto_id IN ({})'.format(', '.join(map(str, new))), {}))
+
+        appended = 0
+        behind = set()
+        for where, params in passes:
+            for source in _tables(conn, self.table, params.get('since')):
+                appended += self._append_result(self._select(conn, source, where, params), columns, batch_rows,
+                                                behind)
+
+        self.commit()
+        if behind:
+            appended += self.resync(conn, behind)
+
+        return appended
+
+    def resync(self, conn, crypto_ids):
+        """
+        Rewrites the files of the coins from the SQL table, for rows sync() cannot append: backfilled behind the last
+        synced load_date, or rewritten in place. Readers keep the previous files until the manifest is committed.
+
+        :param conn: an open connection
+        :param crypto_ids: the coins rewritten
+        :return: the number of rows written
+        """
+        crypto_ids = sorted({int(crypto_id) for crypto_id in crypto_ids})
+        if not crypto_ids:
+            return 0
+
+        previous = {}
+        for crypto_id in crypto_ids:
+            entry = self.manifest['coins'].get(str(crypto_id))
+            if entry is not None:
+                previous[crypto_id] = self._directory(crypto_id)
+            generation = entry.get('generation', 0) + 1 if entry is not None else 0
+            # The leftovers of a resync that crashed before its commit
+            shutil.rmtree(self._directory(crypto_id, generation), ignore_errors=True)
+            self.manifest['coins'][str(crypto_id)] = {'rows': 0, 'last_load_date': None, 'generation': generation}
+
+        columns = ['crypto_id', 'load_date'] + list(self.fields)
+        try:
+            written = 0
+            # One coin at a time, its rows from every table merged in load_date order
+            for crypto_id in crypto_ids:
+                where = 'crypto_id = {}'.format(crypto_id)
+                arrays = _concat([_to_arrays(self._select(conn, source, where, {}).all(), columns)
+                                  for source in _tables(conn, self.table)], columns)
+                written += self.append(crypto_id, arrays['load_date'],
+                                       {field: arrays[field] for field in self.fields}, commit=False)
+        except BaseException:
+            # Back to the manifest on disk, which still points at the previous files
+            self.manifest = self._load_manifest()
+            raise
+
+        for crypto_id in crypto_ids:
+            if self.rows(crypto_id) == 0:
+                self.manifest['coins'].pop(str(crypto_id))
+        self.commit()
+        for directory in previous.values():
+            shutil.rmtree(directory, ignore_errors=True)
+
+        return written
+
+    def _select(self, conn, source, where, params):
+        sql = 'SELECT {} FROM {} WHERE {} ORDER BY crypto_id, load_date'.format(
+            ', '.join(['crypto_id', 'load_date'] + list(self.fields)), source, where)
+        stmt = db.text(sql).bindparams(*[db.bindparam('since', type_=db.DateTime)] if params else [])
+
+        return conn.execute(stmt, params)
+
+    def _append_result(self, result, columns, batch_rows, behind=None):
+        """
+        :param behind: a set the coins with rows behind their last load_date that are missing from the store are
+            added to, those rows being skipped
+        """
+        appended = 0
+        while True:
+            rows = result.fetchmany(batch_rows)
+            if not rows:
+                break
+
+            arrays = _to_arrays(rows, columns)
+            ids = arrays['crypto_id']
+            bounds = np.flatnonzero(np.diff(ids)) + 1
+            for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, ids.shape[0]]):
+                crypto_id = int(ids[lo])
+                dates = arrays['load_date'][lo:hi]
+
+                # The shared lower bound may reach behind this coin's own watermark
+                last = self.last_load_date(crypto_id)
+                start = np.searchsorted(dates, last, side='right') if last is not None else 0
+                if start and behind is not None and crypto_id not in behind:
+                    stored = self.read(crypto_id, 'load_date')
+                    # Only the stored tail from the first row read back is touched
+                    if not np.isin(dates[:start], stored[np.searchsorted(stored, dates[0]):]).all():
+                        behind.add(crypto_id)
+                keep = slice(start, None)
+                appended += self.append(crypto_id, dates[keep],
+                                        {field: arrays[field][lo:hi][keep] for field in self.fields}, commit=False)
+
+        return appended
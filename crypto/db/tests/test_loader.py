@@ -0,0 +1,67 @@
+import datetime as dt
+
+import pytest
+import sqlalchemy as db
+
+from crypto.db.database import dispose, get_engine, migrate
+from crypto.db.loader import MarketDataLoader
+
+START = dt.datetime(2024, 1, 1)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    url = 'sqlite:///{}'.format(tmp_path / 'crypto_index.db')
+    yield get_engine(url)
+    dispose(url)
+
+
+def _quotes(symbol, hours):
+    return [{'symbol': symbol, 'name': symbol, 'load_date': START + dt.timedelta(hours=hour), 'trade_price': 1.0 + hour,
+             'market_cap': 1000 + hour, 'market_cap_percentage': None, 'ranking': 1} for hour in hours]
+
+
+def _scalars(engine, sql):
+    with engine.connect() as conn:
+        return conn.execute(db.text(sql)).scalars().all()
+
+
+def test_loaders_side_by_side_share_a_new_coin(engine):
+    first, second = MarketDataLoader(engine), MarketDataLoader(engine)
+    # Both loaders have read currency_information before either created ETH
+    first.load(_quotes('BTC', [0]))
+    second.load(_quotes('BTC', [1]))
+
+    first.load(_quotes('ETH', [0]))
+    second.load(_quotes('ETH', [1]))
+
+    assert _scalars(engine, "SELECT id FROM currency_information WHERE symbol = 'ETH'") == [2]
+    assert _scalars(engine, 'SELECT crypto_id FROM market_data ORDER BY crypto_id, load_date') == [1, 1, 2, 2]
+
+
+def test_migration_merges_duplicate_coins(engine):
+    MarketDataLoader(engine).load(_quotes('BTC', range(3)) + _quotes('ETH', range(3)))
+    # A database from before the unique index, where a second loader created ETH again
+    with engine.begin() as conn:
+        conn.execute(db.text('DROP INDEX ux_currency_information_symbol'))
+        conn.execute(db.text("INSERT INTO currency_information (id, symbol, name) VALUES (3, 'ETH', 'ETH')"))
+        conn.execute(db.text('INSERT INTO market_data (crypto_id, load_date, trade_price) '
+                             'SELECT 3, load_date, trade_price FROM market_data WHERE crypto_id = 2'))
+        conn.execute(db.text("INSERT INTO market_data (crypto_id, load_date, trade_price) "
+                             "VALUES (3, '2024-01-01 03:00:00.000000', 4.0)"))
+        conn.execute(db.text("INSERT INTO purchase_history (user_id, crypto_id, load_date, purchase_amt_usd, "
+                             "purchase_amt_crypto) VALUES (7, 3, '2024-01-01 03:00:00.000000', 8.0, 2.0)"))
+        conn.execute(db.text('DELETE FROM schema_version WHERE version = 6'))
+
+    assert migrate(engine) == [6]
+
+    assert _scalars(engine, 'SELECT id FROM currency_information ORDER BY id') == [1, 2]
+    assert _scalars(engine, 'SELECT load_date FROM market_data WHERE crypto_id = 2 ORDER BY load_date') == [
+        '2024-01-01 00:00:00.000000', '2024-01-01 01:00:00.000000', '2024-01-01 02:00:00.000000',
+        '2024-01-01 03:00:00.000000']
+    assert _scalars(engine, 'SELECT DISTINCT crypto_id FROM market_data_1m ORDER BY crypto_id') == [1, 2]
+    assert _scalars(engine, 'SELECT COUNT(*) FROM running_averages WHERE crypto_id = 2') == [4]
+    assert _scalars(engine, 'SELECT quantity FROM user_holdings WHERE user_id = 7 AND crypto_id = 2') == [2.0]
+
+    with pytest.raises(db.exc.IntegrityError), engine.begin() as conn:
+        conn.execute(db.text("INSERT INTO currency_information (symbol) VALUES ('ETH')"))
@@ -0,0 +1,48 @@
+import datetime as dt
+
+import pytest
+import sqlalchemy as db
+
+from crypto.db.database import dispose, get_engine
+from crypto.db.loader import MarketDataLoader
+from crypto.db.partition import apply_retention, partitions
+from crypto.db.rollup import rebuild_rollups
+
+START = dt.datetime(2024, 1, 1)
+NOW = dt.datetime(2024, 3, 15)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    url = 'sqlite:///{}'.format(tmp_path / 'crypto_index.db')
+    yield get_engine(url)
+    dispose(url)
+
+
+def _quotes(symbol, days):
+    return [{'symbol': symbol, 'name': symbol, 'load_date': START + dt.timedelta(hours=6 * i), 'trade_price': 1.0 + i,
+             'market_cap': 1000 + i, 'market_cap_percentage': None, 'ranking': 1} for i in range(4 * days)]
+
+
+def _partitions(engine):
+    with engine.connect() as conn:
+        return [name for name, _, _ in partitions(conn)]
+
+
+def test_retention_keeps_a_partition_with_a_coin_missing_its_bars(engine):
+    MarketDataLoader(engine, partitioned=True).load(_quotes('BTC', 10) + _quotes('ETH', 10))
+    assert _partitions(engine) == ['market_data_2024_01']
+
+    with engine.begin() as conn:
+        eth = conn.execute(db.text("SELECT id FROM currency_information WHERE symbol = 'ETH'")).scalar()
+        # ETH has no bars, while BTC's count more than the month holds of both coins
+        conn.execute(db.text('DELETE FROM market_data_1d WHERE crypto_id = :eth'), {'eth': eth})
+        conn.execute(db.text('UPDATE market_data_1d SET n_obs = n_obs * 3'))
+
+    result = apply_retention(engine, keep_days=30, now=NOW)
+    assert result == {'dropped': [], 'uncovered': ['market_data_2024_01']}
+    assert _partitions(engine) == ['market_data_2024_01']
+
+    rebuild_rollups(engine)
+    assert apply_retention(engine, keep_days=30, now=NOW) == {'dropped': ['market_data_2024_01'], 'uncovered': []}
+    assert _partitions(engine) == []
@@ -0,0 +1,80 @@
+import asyncio
+import datetime as dt
+
+import numpy as np
+import pytest
+import sqlalchemy as db
+
+from crypto.backfill import Backfill, SyntheticQuotes
+from crypto.db.database import dispose, get_engine
+from crypto.db.loader import MarketDataLoader
+from crypto.db.store import STORE_FIELDS, ColumnarStore
+
+START = dt.datetime(2024, 1, 1)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    url = 'sqlite:///{}'.format(tmp_path / 'crypto_index.db')
+    yield get_engine(url)
+    dispose(url)
+
+
+def _quotes(symbol, hours, price=100.0):
+    return [{'symbol': symbol, 'name': symbol, 'load_date': START + dt.timedelta(hours=hour), 'trade_price': price + hour,
+             'market_cap': 1000 + hour, 'market_cap_percentage': None, 'ranking': 1} for hour in hours]
+
+
+def _assert_matches(store, engine):
+    columns = ', '.join(('load_date',) + STORE_FIELDS['market_data'])
+    with engine.connect() as conn:
+        crypto_ids = conn.execute(db.text('SELECT DISTINCT crypto_id FROM market_data')).scalars().all()
+        assert sorted(crypto_ids) == store.coins()
+        for crypto_id in crypto_ids:
+            rows = conn.execute(db.text('SELECT {} FROM market_data WHERE crypto_id = :crypto_id ORDER BY load_date'
+                                        .format(columns)), {'crypto_id': crypto_id}).all()
+            dates, *values = zip(*rows)
+            np.testing.assert_array_equal(store.read(crypto_id, 'load_date'),
+                                          np.array([np.datetime64(date, 'us') for date in dates]))
+            for field, expected in zip(STORE_FIELDS['market_data'], values):
+                np.testing.assert_array_equal(store.read(crypto_id, field), np.array(expected, dtype=np.float64))
+
+
+def test_backfill_behind_the_watermark_reaches_the_store(engine, tmp_path):
+    loader = MarketDataLoader(engine)
+    loader.load(_quotes('BTC', range(48, 72)) + _quotes('ETH', range(48, 72)))
+    store = ColumnarStore(str(tmp_path / 'store'), 'market_data')
+    with engine.connect() as conn:
+        store.sync(conn)
+    _assert_matches(store, engine)
+
+    # The two days before what the store holds
+    backfill = Backfill(SyntheticQuotes(interval=dt.timedelta(hours=1)), ['BTC', 'ETH'], START,
+                        START + dt.timedelta(days=2), str(tmp_path / 'backfill.jsonl'), engine=engine, store=store)
+    stats = asyncio.run(backfill.run())
+    assert stats['store'] == 2 * 72
+
+    _assert_matches(store, engine)
+    # And from a fresh look at the manifest, as another process would
+    _assert_matches(ColumnarStore(str(tmp_path / 'store'), 'market_data'), engine)
+    assert sorted(path.name for path in (tmp_path / 'store' / 'market_data').iterdir()) == ['1.1', '2.1',
+                                                                                            'manifest.json']
+
+
+def test_sync_resyncs_late_rows_it_reads_back(engine, tmp_path):
+    loader = MarketDataLoader(engine)
+    loader.load(_quotes('BTC', range(0, 10, 2)) + _quotes('ETH', range(0, 4)))
+    store = ColumnarStore(str(tmp_path / 'store'), 'market_data')
+    with engine.connect() as conn:
+        store.sync(conn)
+
+        # Late BTC snapshots behind its watermark, but after ETH's, so sync reads them back
+        loader.load(_quotes('BTC', [5, 7]) + _quotes('ETH', [4]))
+        store.sync(conn)
+        _assert_matches(store, engine)
+
+        # A rewrite of rows already synced needs an explicit resync
+        loader.load(_quotes('ETH', [1, 2], price=50.0))
+        assert store.sync(conn) == 0
+        assert store.resync(conn, [2]) == 5
+    _assert_matches(store, engine)
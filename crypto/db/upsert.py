@@ -0,0 +1,87 @@
+import sqlalchemy as db
+
+from crypto.db.models import Base, CryptoRunningAverages, IndexRanking, MarketData
+
+NATURAL_KEY = ('crypto_id', 'load_date')
+# purchase_history is keyed per user
+PURCHASE_KEY = ('user_id', 'crypto_id', 'load_date')
+# user_holdings holds one row per user and coin
+HOLDING_KEY = ('user_id', 'crypto_id')
+
+# The time-series tables keyed on (crypto_id, load_date)
+TIME_SERIES_TABLES = (MarketData.__table__, CryptoRunningAverages.__table__, IndexRanking.__table__)
+
+
+def _dialect_insert(conn):
+    if conn.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise NotImplementedError('INSERT ... ON CONFLICT is not supported on {}.'.format(conn.dialect.name))
+
+    return insert
+
+
+def upsert(conn, table, rows, key=NATURAL_KEY, update=True, batch_size=10000):
+    """
+    Bulk INSERT ... ON CONFLICT on the natural key of a table, so replaying a load over a time range overwrites the
+    rows it already wrote instead of duplicating them. The conflict resolution happens in the database.
+
+    :param conn: an open connection
+    :param table: the Table (e.g. MarketData.__table__) to write to
+    :param rows: a list of dicts keyed by column name
+    :param key: the columns of the unique index to resolve conflicts on
+    :param update: True to overwrite the existing row with the new values, False to keep the existing row
+    :param batch_size: the number of rows per executemany call
+    :return: the number of rows sent
+    """
+    if not rows:
+        return 0
+
+    stmt = _dialect_insert(conn)(table)
+    if update:
+        columns = [column for column in rows[0] if column not in key and column != 'id']
+        stmt = stmt.on_conflict_do_update(index_elements=list(key),
+                                          set_={column: stmt.excluded[column] for column in columns})
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=list(key))
+
+    for i in range(0, len(rows), batch_size):
+        conn.execute(stmt, rows[i:i + batch_size])
+
+    return len(rows)
+
+
+def deduplicate(conn, table, key=NATURAL_KEY):
+    """
+    Deletes the duplicate rows of a table in the database, keeping the most recently inserted row of each key
+
+    :return: the number of rows deleted
+    """
+    key_columns = ', '.join(key)
+    result = conn.execute(db.text(
+        'DELETE FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY {key})'.format(
+            table=table.name, key=key_columns)))
+
+    return result.rowcount
+
+
+def ensure_unique_keys(engine):
+    """
+    Brings a database created before the natural keys existed up to date: removes the duplicates already in the
+    time-series tables and creates their unique (crypto_id, load_date) indexes, along with the other indexes declared
+    on the models
+
+    :return: a dict of {table name: duplicate rows deleted}
+    """
+    Base.metadata.create_all(engine)
+
+    deleted = {}
+    with engine.begin() as conn:
+        for table in TIME_SERIES_TABLES:
+            deleted[table.name] = deduplicate(conn, table)
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+    return deleted
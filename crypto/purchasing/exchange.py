@@ -0,0 +1,74 @@
+"""
+Exchange adapters the purchasing layer submits its orders through.
+
+An adapter turns one aggregated order per asset into a fill. Implementations wrap a venue's API; MockExchange fills
+in memory at given prices, for tests and dry runs:
+
+    exchange = MockExchange({'BTC': 30000.0, 'ETH': 2000.0}, fee_rate=0.001)
+    await exchange.submit_order('BTC', 0.5)  # {'filled': 0.5, 'price': 30000.0, 'fee': 15.0}
+"""
+import asyncio
+
+
+class ExchangeAdapter:
+    """
+    The interface of an exchange: one async call per order
+    """
+
+    async def submit_order(self, symbol, quantity):
+        """
+        :param symbol: the coin traded
+        :param quantity: the quantity to buy (> 0) or sell (< 0), as a market order
+        :return: a dict with the signed quantity filled, the average fill price and the fee paid in USD
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class MockExchange(ExchangeAdapter):
+    """
+    In-memory exchange filling market orders at fixed prices, recording every order it receives
+    """
+
+    def __init__(self, prices, fee_rate=0.0, slippage=0.0, max_fill=None, latency=0.0):
+        """
+        :param prices: a dict of {symbol: price}; orders for other symbols are rejected with a KeyError
+        :param fee_rate: the fee as a share of the traded notional
+        :param slippage: the share of the price paid above it on buys and received below it on sells
+        :param max_fill: a dict of {symbol: the largest quantity filled per order}, for partial fills
+        :param latency: the seconds each order takes
+        """
+        self.prices = dict(prices)
+        self.fee_rate = fee_rate
+        self.slippage = slippage
+        self.max_fill = dict(max_fill or {})
+        self.latency = latency
+
+        self.orders = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def submit_order(self, symbol, quantity):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+
+            price = self.prices[symbol] * (1 + self.slippage if quantity > 0 else 1 - self.slippage)
+            limit = self.max_fill.get(symbol)
+            filled = quantity if limit is None else max(-limit, min(limit, quantity))
+            fill = {'filled': filled, 'price': price, 'fee': abs(filled) * price * self.fee_rate}
+            self.orders.append(dict(fill, symbol=symbol, quantity=quantity))
+
+            return fill
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,162 @@
+"""
+Batched execution of the rebalancing orders of many users.
+
+The orders of every user are netted per asset: buys and sells of the same coin cross internally, and only the
+difference goes to the exchange as one order per asset, submitted concurrently up to max_concurrency at a time. The
+fills are allocated back to the users pro rata with array operations and logged to purchase_history in one bulk
+write, folded into the user_holdings of crypto.db.holdings in the same transaction, so the exchange round trips grow
+with the number of assets and not with users x assets:
+
+    orders = rebalance(engine)
+    async with MockExchange(prices) as exchange:
+        stats = await execute(engine, orders, exchange)  # {'orders': 5000, 'exchange_orders': 40, ...}
+
+Every user trading an asset gets the same price: the average fill price of the asset's exchange order, or the
+reference price of the orders when they cross entirely. The exchange fee is borne by the users on the side of the
+asset that went to the exchange, in proportion to what they got filled.
+"""
+import asyncio
+import datetime as dt
+import logging
+import time
+
+import numpy as np
+import sqlalchemy as db
+
+from crypto.db.holdings import record_purchases
+from crypto.db.models import CryptoCurrencies, PurchaseHistory
+from crypto.db.upsert import PURCHASE_KEY, upsert
+
+logger = logging.getLogger(__name__)
+
+
+def net_orders(orders):
+    """
+    :param orders: a dict of arrays of crypto_id, quantity (> 0 to buy, < 0 to sell) and price, e.g. from rebalance()
+    :return: the crypto_ids traded, the index of each order's asset among them, and the bought and sold quantities
+        of each asset
+    """
+    assets, asset_index = np.unique(orders['crypto_id'], return_inverse=True)
+    quantity = np.asarray(orders['quantity'], dtype=np.float64)
+    bought = np.bincount(asset_index, np.clip(quantity, 0, None), minlength=assets.shape[0])
+    sold = np.bincount(asset_index, np.clip(-quantity, 0, None), minlength=assets.shape[0])
+
+    return assets, asset_index, bought, sold
+
+
+def allocate(quantity, asset_index, bought, sold, filled, fill_price, fee, reference_price):
+    """
+    Shares the internal crossing and the exchange fill of each asset among its orders
+
+    :param quantity: the signed quantity of each order
+    :param asset_index: the asset of each order, see net_orders
+    :param bought: the quantity bought of each asset
+    :param sold: the quantity sold of each asset
+    :param filled: the signed quantity the exchange filled for each asset, NaN where its order failed
+    :param fill_price: the average fill price of each asset, NaN where nothing went to the exchange
+    :param fee: the exchange fee of each asset
+    :param reference_price: the price of each asset used when its orders cross entirely
+    :return: the signed quantity filled, the price and the fee share of each order
+    """
+    failed = np.isnan(filled)
+    filled = np.where(failed, 0, filled)
+
+    # The buyers get what the sellers sold plus what the exchange bought, and the other way around
+    buy_ratio = np.where(bought > 0, np.minimum(1, (sold + np.clip(filled, 0, None)) / np.where(bought > 0, bought, 1)),
+                         0)
+    sell_ratio = np.where(sold > 0, np.minimum(1, (bought + np.clip(-filled, 0, None)) / np.where(sold > 0, sold, 1)),
+                          0)
+    buy_ratio[failed] = 0
+    sell_ratio[failed] = 0
+
+    ratio = np.where(quantity > 0, buy_ratio[asset_index], sell_ratio[asset_index])
+    order_filled = quantity * ratio
+
+    price = np.where((filled != 0) & np.isfinite(fill_price), fill_price, reference_price)
+
+    # The fee goes to the orders on the side the exchange order was placed for
+    exchange_side = np.sign(bought - sold)[asset_index]
+    on_side = np.where(np.sign(quantity) == exchange_side, np.abs(order_filled), 0)
+    side_total = np.bincount(asset_index, on_side, minlength=bought.shape[0])
+    fee_share = fee[asset_index] * on_side / np.where(side_total > 0, side_total, 1)[asset_index]
+
+    return order_filled, price[asset_index], fee_share
+
+
+async def _submit(exchange, symbols, net, max_concurrency):
+    """
+    :return: the signed filled quantity, the average price and the fee of each asset, NaN filled where it failed
+    """
+    n = net.shape[0]
+    filled = np.zeros(n)
+    price = np.full(n, np.nan)
+    fee = np.zeros(n)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def submit(i):
+        async with semaphore:
+            try:
+                fill = await exchange.submit_order(symbols[i], float(net[i]))
+            except Exception:
+                logger.exception('The order for %s %s failed', net[i], symbols[i])
+                filled[i] = np.nan
+                return
+        filled[i], price[i], fee[i] = fill['filled'], fill['price'], fill['fee']
+
+    await asyncio.gather(*[submit(i) for i in np.flatnonzero(net != 0)])
+
+    return filled, price, fee
+
+
+async def execute(engine, orders, exchange, max_concurrency=8, load_date=None):
+    """
+    Nets the orders across users, sends one order per asset to the exchange and logs the fills to purchase_history
+
+    :param engine: the SQLAlchemy engine
+    :param orders: a dict of arrays of user_id, crypto_id, quantity and price, see rebalance()
+    :param exchange: an ExchangeAdapter
+    :param max_concurrency: the number of exchange orders in flight at once
+    :param load_date: the load_date of the purchase_history rows, defaults to the current UTC time
+    :return: a dict with the number of user orders, assets, exchange orders and failed assets, the quantity crossed
+        internally in USD, the fees, the purchase_history rows written and the user_holdings rows updated
+    """
+    start = time.perf_counter()
+    load_date = load_date or dt.datetime.utcnow()
+    quantity = np.asarray(orders['quantity'], dtype=np.float64)
+    assets, asset_index, bought, sold = net_orders(orders)
+    reference_price = np.zeros(assets.shape[0])
+    reference_price[asset_index] = orders['price']
+
+    table = CryptoCurrencies.__table__
+    with engine.connect() as conn:
+        symbols = dict(conn.execute(db.select(table.c.id, table.c.symbol).where(table.c.id.in_(assets.tolist()))).all())
+
+    net = bought - sold
+    filled, fill_price, fee = await _submit(exchange, [symbols.get(_id) for _id in assets.tolist()], net,
+                                            max_concurrency)
+    order_filled, price, fee_share = allocate(quantity, asset_index, bought, sold, filled, fill_price, fee,
+                                              reference_price)
+
+    done = np.flatnonzero(order_filled != 0)
+    rows = [{'user_id': user_id, 'crypto_id': crypto_id, 'load_date': load_date, 'purchase_amt_crypto': amount,
+             'purchase_amt_usd': amount * order_price + order_fee}
+            for user_id, crypto_id, amount, order_price, order_fee in zip(
+                np.asarray(orders['user_id'])[done].tolist(), assets[asset_index[done]].tolist(),
+                order_filled[done].tolist(), price[done].tolist(), fee_share[done].tolist())]
+    with engine.begin() as conn:
+        upsert(conn, PurchaseHistory.__table__, rows, key=PURCHASE_KEY)
+        holdings = record_purchases(conn, rows)
+
+    failed = np.isnan(filled)
+    crossed = np.minimum(bought, sold)
+    return {
+        'orders': quantity.shape[0],
+        'assets': assets.shape[0],
+        'exchange_orders': int(np.count_nonzero(net)),
+        'failed': int(failed.sum()),
+        'crossed_usd': float((crossed * reference_price)[~failed].sum()),
+        'fees': float(fee[~failed].sum()),
+        'rows': len(rows),
+        'holdings': holdings,
+        'seconds': time.perf_counter() - start,
+    }
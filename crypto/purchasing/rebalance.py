@@ -0,0 +1,164 @@
+"""
+Rebalancing of every user's holdings towards the index weights, for all users in one batch.
+
+The holdings are pivoted out of purchase_history into a (users x assets) quantity matrix, valued at the latest
+trade_price and diffed against the latest index_ranking weights. The order deltas come out of whole-matrix operations,
+so the cost grows with the size of the matrix rather than with a Python loop per account:
+
+    orders = rebalance(engine, drift_threshold=0.02, min_trade_usd=10, cash={42: 500.0})
+    orders  # {'user_id': array([...]), 'crypto_id': ..., 'quantity': ..., 'amount_usd': ..., 'price': ...}
+
+An asset is only traded when its weight in the user's portfolio drifted more than drift_threshold from its target
+and the trade is worth at least min_trade_usd. Buys are funded by the sells and cash of the same user and scaled down
+when those fall short, so no order ever spends money the user does not have.
+"""
+import numpy as np
+
+from crypto.db.models import IndexRanking, MarketData, PurchaseHistory
+from crypto.db.query import _execute, latest_per_coin
+
+
+def holdings(conn, user_ids=None, as_of=None):
+    """
+    :param conn: an open connection
+    :param user_ids: only these users, every user when None
+    :param as_of: only purchases with load_date <= as_of
+    :return: the user_ids, the crypto_ids and the (users x assets) matrix of quantities held
+    """
+    conditions, params = ['user_id IS NOT NULL'], {}
+    if user_ids is not None:
+        conditions.append('user_id IN ({})'.format(', '.join(str(int(_id)) for _id in user_ids) or 'NULL'))
+    if as_of is not None:
+        conditions.append('load_date <= :as_of')
+        params['as_of'] = as_of
+
+    sql = 'SELECT user_id, crypto_id, SUM(purchase_amt_crypto) FROM {} WHERE {} GROUP BY user_id, crypto_id'.format(
+        PurchaseHistory.__tablename__, ' AND '.join(conditions))
+    rows = _execute(conn, sql, params, ['user_id', 'crypto_id', 'quantity'])
+
+    users, user_index = np.unique(rows['user_id'], return_inverse=True)
+    assets, asset_index = np.unique(rows['crypto_id'], return_inverse=True)
+    quantities = np.zeros((users.shape[0], assets.shape[0]), dtype=np.float64)
+    quantities[user_index, asset_index] = np.nan_to_num(rows['quantity'])
+
+    return users, assets, quantities
+
+
+def targets(conn, as_of=None):
+    """
+    :param conn: an open connection
+    :param as_of: the latest ranking at or before as_of, the latest ranking when None
+    :return: the crypto_ids of the index and their index_percentage weights
+    """
+    params, where = {}, ''
+    if as_of is not None:
+        where = ' WHERE load_date <= :as_of'
+        params['as_of'] = as_of
+
+    sql = '''
+        SELECT crypto_id, index_percentage FROM {table}
+        WHERE load_date = (SELECT MAX(load_date) FROM {table}{where})
+        ORDER BY crypto_id
+    '''.format(table=IndexRanking.__tablename__, where=where)
+    rows = _execute(conn, sql, params, ['crypto_id', 'index_percentage'])
+
+    return rows['crypto_id'], np.nan_to_num(rows['index_percentage'])
+
+
+def _align(ids, values, universe, fill):
+    # The values of ids laid out along the sorted universe, fill where an id of the universe has none
+    out = np.full(universe.shape[0], fill, dtype=np.float64)
+    out[np.searchsorted(universe, ids)] = values
+
+    return out
+
+
+def order_deltas(quantities, prices, weights, cash=None, drift_threshold=0.0, min_trade_usd=0.0):
+    """
+    :param quantities: the (users x assets) matrix of quantities held
+    :param prices: the price of each asset, NaN for assets without one, which are neither valued nor traded
+    :param weights: the target weight of each asset, 0 for assets out of the index
+    :param cash: the cash of each user available to buy with, none when None
+    :param drift_threshold: only trade an asset whose weight is further than this from its target
+    :param min_trade_usd: only trade an asset when the trade is worth at least this
+    :return: the (users x assets) matrices of the quantities to buy (> 0) or sell (< 0) and of their USD amounts
+    """
+    quantities = np.asarray(quantities, dtype=np.float64)
+    prices = np.asarray(prices, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    cash = np.zeros(quantities.shape[0]) if cash is None else np.asarray(cash, dtype=np.float64)
+
+    priced = np.isfinite(prices) & (prices > 0)
+    values = np.where(priced, quantities * np.where(priced, prices, 0), 0)
+    total = values.sum(axis=1) + cash
+    safe_total = np.where(total > 0, total, 1)[:, None]
+
+    amounts = total[:, None] * weights - values
+    drift = np.abs(values / safe_total - weights)
+    trade = priced & (total[:, None] > 0) & (drift > drift_threshold) & (np.abs(amounts) >= min_trade_usd)
+    amounts = np.where(trade, amounts, 0)
+
+    # Buys are paid for by the user's sells and cash, all scaled down by the same factor when those fall short
+    buys = np.clip(amounts, 0, None).sum(axis=1)
+    funds = cash - np.clip(amounts, None, 0).sum(axis=1)
+    scale = np.where(buys > funds, funds / np.where(buys > 0, buys, 1), 1)
+    amounts = np.where(amounts > 0, amounts * scale[:, None], amounts)
+    # A buy scaled below the minimum is left for the next rebalance
+    amounts = np.where((amounts > 0) & (amounts < min_trade_usd), 0, amounts)
+
+    deltas = np.where(amounts != 0, amounts / np.where(priced, prices, 1), 0)
+    # Leaving an asset sells the exact quantity held, without float dust
+    deltas = np.where((amounts < 0) & (weights == 0), -quantities, deltas)
+
+    return deltas, amounts
+
+
+def rebalance(engine, user_ids=None, cash=None, drift_threshold=0.02, min_trade_usd=10.0, as_of=None):
+    """
+    The orders bringing every user's holdings back to the index weights
+
+    :param engine: the SQLAlchemy engine
+    :param user_ids: only these users, every user with holdings when None
+    :param cash: a dict of {user_id: USD available to buy with}; users with cash and no holdings are included
+    :param drift_threshold: see order_deltas
+    :param min_trade_usd: see order_deltas
+    :param as_of: rebalance against the holdings, ranking and prices as of this time, the latest when None
+    :return: a dict of arrays of user_id, crypto_id, quantity (> 0 to buy, < 0 to sell), amount_usd and price, one
+        entry per order ordered by user_id and crypto_id
+    """
+    cash = cash or {}
+    cash_users = np.fromiter(cash, dtype=np.int64, count=len(cash))
+    cash_amounts = np.fromiter(cash.values(), dtype=np.float64, count=len(cash))
+    if user_ids is not None:
+        keep = np.isin(cash_users, np.asarray(list(user_ids), dtype=np.int64))
+        cash_users, cash_amounts = cash_users[keep], cash_amounts[keep]
+
+    with engine.connect() as conn:
+        held_users, held_assets, held = holdings(conn, user_ids, as_of)
+        index_assets, index_weights = targets(conn, as_of)
+
+        # Users and assets on both sides: the index may hold assets nobody owns yet, users may only have cash
+        users = np.union1d(held_users, cash_users)
+        assets = np.union1d(held_assets, index_assets)
+        if users.shape[0] == 0 or assets.shape[0] == 0:
+            return {'user_id': np.empty(0, dtype=np.int64), 'crypto_id': np.empty(0, dtype=np.int64),
+                    'quantity': np.empty(0), 'amount_usd': np.empty(0), 'price': np.empty(0)}
+
+        latest = latest_per_coin(conn, MarketData, ['trade_price'], as_of=as_of, crypto_ids=assets.tolist())
+
+    quantities = np.zeros((users.shape[0], assets.shape[0]), dtype=np.float64)
+    quantities[np.ix_(np.searchsorted(users, held_users), np.searchsorted(assets, held_assets))] = held
+    prices = _align(latest['crypto_id'], latest['trade_price'], assets, np.nan)
+    weights = _align(index_assets, index_weights, assets, 0.0)
+    user_cash = _align(cash_users, cash_amounts, users, 0.0)
+
+    deltas, amounts = order_deltas(quantities, prices, weights, user_cash, drift_threshold, min_trade_usd)
+
+    rows, columns = np.nonzero(deltas)
+    return {
+        'user_id': users[rows],
+        'crypto_id': assets[columns],
+        'quantity': deltas[rows, columns],
+        'amount_usd': amounts[rows, columns],
+        'price': prices[columns],
+    }
@@ -0,0 +1,133 @@
+import asyncio
+import datetime as dt
+
+import numpy as np
+import pytest
+import sqlalchemy as db
+
+from crypto.db.database import dispose, get_engine
+from crypto.db.models import CryptoCurrencies
+from crypto.purchasing.exchange import MockExchange
+from crypto.purchasing.execution import execute
+
+LOAD_DATE = dt.datetime(2024, 1, 1)
+SYMBOLS = {1: 'BTC', 2: 'ETH', 3: 'SOL', 4: 'DOGE'}
+PRICES = {'BTC': 30000.0, 'ETH': 2000.0, 'SOL': 100.0, 'DOGE': 0.1}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    url = 'sqlite:///{}'.format(tmp_path / 'crypto_index.db')
+    engine = get_engine(url)
+    with engine.begin() as conn:
+        conn.execute(CryptoCurrencies.__table__.insert(), [{'id': _id, 'symbol': symbol, 'name': symbol}
+                                                           for _id, symbol in SYMBOLS.items()])
+    yield engine
+    dispose(url)
+
+
+def _orders(rows):
+    user_id, crypto_id, quantity = map(np.array, zip(*rows))
+    return {'user_id': user_id, 'crypto_id': crypto_id, 'quantity': quantity.astype(np.float64),
+            'price': np.array([PRICES[SYMBOLS[_id]] for _id in crypto_id.tolist()])}
+
+
+def _execute(engine, orders, exchange, **kwargs):
+    return asyncio.run(execute(engine, orders, exchange, load_date=LOAD_DATE, **kwargs))
+
+
+def _purchases(engine):
+    with engine.connect() as conn:
+        rows = conn.execute(db.text('SELECT user_id, crypto_id, purchase_amt_crypto, purchase_amt_usd '
+                                    'FROM purchase_history ORDER BY user_id, crypto_id')).all()
+    return {(user_id, crypto_id): (amount, usd) for user_id, crypto_id, amount, usd in rows}
+
+
+def _random_orders(users, crypto_ids, seed=0):
+    rng = np.random.default_rng(seed)
+    return _orders([(user_id, crypto_id, rng.normal(0, 1)) for user_id in range(1, users + 1)
+                    for crypto_id in crypto_ids])
+
+
+def test_one_exchange_order_per_asset(engine):
+    orders = _random_orders(50, [1, 2, 3])
+    exchange = MockExchange(PRICES)
+    stats = _execute(engine, orders, exchange)
+
+    assert sorted(order['symbol'] for order in exchange.orders) == ['BTC', 'ETH', 'SOL']
+    for crypto_id in (1, 2, 3):
+        net = orders['quantity'][orders['crypto_id'] == crypto_id].sum()
+        order = next(order for order in exchange.orders if order['symbol'] == SYMBOLS[crypto_id])
+        assert order['quantity'] == pytest.approx(net)
+    assert (stats['orders'], stats['assets'], stats['exchange_orders'], stats['rows']) == (150, 3, 3, 150)
+
+
+def test_concurrency_cap(engine):
+    symbols = {_id: 'C{}'.format(_id) for _id in range(10, 20)}
+    with engine.begin() as conn:
+        conn.execute(CryptoCurrencies.__table__.insert(), [{'id': _id, 'symbol': symbol, 'name': symbol}
+                                                           for _id, symbol in symbols.items()])
+    orders = {'user_id': np.ones(10, dtype=np.int64), 'crypto_id': np.array(list(symbols)), 'quantity': np.ones(10),
+              'price': np.ones(10)}
+    exchange = MockExchange({symbol: 1.0 for symbol in symbols.values()}, latency=0.05)
+    _execute(engine, orders, exchange, max_concurrency=3)
+
+    assert len(exchange.orders) == 10
+    assert exchange.max_in_flight == 3
+
+
+def test_partial_fill_is_shared_pro_rata(engine):
+    # 6 BTC bought and 1 sold: the net 5 goes to the exchange, which fills 2.5 of it
+    orders = _orders([(1, 1, 1.0), (2, 1, 2.0), (3, 1, 3.0), (4, 1, -1.0)])
+    exchange = MockExchange(PRICES, max_fill={'BTC': 2.5})
+    _execute(engine, orders, exchange)
+
+    purchases = _purchases(engine)
+    ratio = (1.0 + 2.5) / 6.0
+    for user_id, quantity in ((1, 1.0), (2, 2.0), (3, 3.0)):
+        assert purchases[(user_id, 1)][0] == pytest.approx(quantity * ratio)
+    # The seller crosses with the buyers in full
+    assert purchases[(4, 1)][0] == pytest.approx(-1.0)
+
+
+def test_fee_goes_to_the_exchange_side(engine):
+    orders = _orders([(1, 2, 1.0), (2, 2, 3.0), (3, 2, -2.0)])
+    exchange = MockExchange(PRICES, fee_rate=0.01)
+    stats = _execute(engine, orders, exchange)
+
+    fee = exchange.orders[0]['fee']
+    assert fee == pytest.approx(2.0 * PRICES['ETH'] * 0.01)
+    assert stats['fees'] == pytest.approx(fee)
+    shares = {user_id: usd - amount * PRICES['ETH'] for (user_id, _), (amount, usd) in _purchases(engine).items()}
+    # The buyers bear the fee in proportion to their fills, the seller none of it
+    assert shares[1] == pytest.approx(fee / 4)
+    assert shares[2] == pytest.approx(fee * 3 / 4)
+    assert shares[3] == pytest.approx(0.0)
+
+
+def test_failed_asset_logs_nothing(engine):
+    orders = _orders([(1, 1, 0.5), (1, 4, 100.0), (2, 4, -10.0), (2, 1, 0.5)])
+    # DOGE has no price, so its order is rejected
+    exchange = MockExchange({symbol: price for symbol, price in PRICES.items() if symbol != 'DOGE'})
+    stats = _execute(engine, orders, exchange)
+
+    assert stats['failed'] == 1
+    assert sorted(_purchases(engine)) == [(1, 1), (2, 1)]
+    with engine.connect() as conn:
+        held = conn.execute(db.text('SELECT user_id, crypto_id FROM user_holdings ORDER BY user_id')).all()
+    assert held == [(1, 1), (2, 1)]
+
+
+def test_purchase_history_reconciles_with_the_fills(engine):
+    orders = _random_orders(40, [1, 2, 3], seed=1)
+    exchange = MockExchange(PRICES, fee_rate=0.002, slippage=0.001, max_fill={'ETH': 0.5})
+    _execute(engine, orders, exchange)
+
+    purchases = _purchases(engine)
+    for order in exchange.orders:
+        crypto_id = next(_id for _id, symbol in SYMBOLS.items() if symbol == order['symbol'])
+        logged = [value for (_, _id), value in purchases.items() if _id == crypto_id]
+        # The crossed legs cancel out: what the users got in total is what the exchange filled, at its cost
+        assert sum(amount for amount, _ in logged) == pytest.approx(order['filled'], abs=1e-9)
+        assert sum(usd for _, usd in logged) == pytest.approx(order['filled'] * order['price'] + order['fee'],
+                                                              abs=1e-6)
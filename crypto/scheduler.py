@@ -0,0 +1,365 @@
+"""
+Long-running scheduler of the ingest pipeline: CoinMarketCap fetch -> MarketData load -> running_averages update ->
+IndexRanking, at a fixed cadence.
+
+Stages declare the stages they depend on and run as soon as those have succeeded, so independent stages (e.g. the
+columnar store sync and the running averages) overlap. A tick that comes due while the previous run is still going is
+either skipped or queued behind it, so slow ticks never pile up. Every stage reports its wall time and row count:
+
+    stages = ingest_stages(client, CRYPTO_SYMBOLS, MarketDataLoader(), ranking=functools.partial(rank_index, top_n=20))
+    scheduler = Scheduler(stages, interval=60, overlap='skip')
+    await scheduler.run()
+    scheduler.stage_stats()  # {'fetch': {'runs': 10, 'failures': 0, 'mean_seconds': 0.8, ...}, ...}
+
+Nothing is kept in memory between ticks that the database does not also hold: the load stage drops the quotes at or
+before each coin's last committed load_date and the running averages resume from their persisted states, so a
+restarted scheduler picks up where the last committed tick left off.
+
+    python -m crypto.scheduler --interval 60 --overlap queue
+"""
+import argparse
+import asyncio
+import collections
+import datetime as dt
+import functools
+import inspect
+import logging
+import signal
+import time
+
+import numpy as np
+import sqlalchemy as db
+
+from crypto.analytics.ranking import rank_index
+from crypto.analytics.running_averages import update_running_averages
+from crypto.db.models import CryptoCurrencies, MarketData
+from crypto.db.partition import apply_retention, compact
+from crypto.db.query import latest_per_coin
+
+logger = logging.getLogger(__name__)
+
+OVERLAP_POLICIES = ('skip', 'queue')
+
+
+class Stage:
+    """
+    One step of a tick. func receives the tick's context dict, holding the result of every stage that already ran
+    under its name, and may be a coroutine function; plain functions run in a worker thread.
+    """
+
+    def __init__(self, name, func, after=(), every=1):
+        """
+        :param name: the stage name, also the key of its result in the context
+        :param func: the callable run on each tick
+        :param after: the names of the stages that must succeed first
+        :param every: only run every n-th tick, e.g. for maintenance
+        """
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+        self.every = every
+
+    async def __call__(self, context):
+        if inspect.iscoroutinefunction(self.func):
+            return await self.func(context)
+
+        return await asyncio.to_thread(self.func, context)
+
+
+def _rows(result):
+    # The row count a stage reports: a stats dict's 'rows', the length of a list or a plain count
+    if isinstance(result, dict):
+        return result.get('rows')
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, (int, np.integer)) and not isinstance(result, bool):
+        return int(result)
+
+    return None
+
+
+class Scheduler:
+    """
+    Runs a DAG of stages at a fixed interval, with overlap protection and per-stage metrics
+    """
+
+    def __init__(self, stages, interval=60.0, overlap='skip', history=1000):
+        """
+        :param stages: the Stages, each declared after the stages it depends on
+        :param interval: the seconds between ticks
+        :param overlap: what to do with a tick that comes due while the previous run is going: 'skip' drops it,
+            'queue' starts it as soon as the run finishes, with any further missed ticks coalesced into it
+        :param history: the number of tick records kept
+        """
+        if overlap not in OVERLAP_POLICIES:
+            raise ValueError('overlap must be one of {}, not {!r}.'.format(OVERLAP_POLICIES, overlap))
+
+        seen = set()
+        for stage in stages:
+            if stage.name in seen:
+                raise ValueError('Stage {!r} is declared twice.'.format(stage.name))
+            missing = [name for name in stage.after if name not in seen]
+            if missing:
+                raise ValueError('Stage {!r} depends on {} which must be declared before it.'.format(stage.name,
+                                                                                                     missing))
+            seen.add(stage.name)
+
+        self.stages = list(stages)
+        self.interval = interval
+        self.overlap = overlap
+        self.history = collections.deque(maxlen=history)
+
+        self.ticks = 0
+        self.skipped = 0
+        self.queued = 0
+        self._stop = None
+
+    # One tick ---------------------------------------------------------------------------------------------------------
+    async def run_once(self):
+        """
+        Runs every stage once, each as soon as its dependencies have succeeded. A failing stage is logged and its
+        dependents are skipped; the other stages still run.
+
+        :return: the tick record: {'tick', 'started', 'seconds', 'stages': {name: {'status', 'seconds', 'rows'}}}
+        """
+        self.ticks += 1
+        tick = self.ticks
+        context = {'tick': tick, 'started': dt.datetime.utcnow()}
+        record = {'tick': tick, 'started': context['started'], 'stages': {}}
+        start = time.perf_counter()
+
+        async def run(stage, dependencies):
+            statuses = await asyncio.gather(*dependencies)
+            if (tick - 1) % stage.every or any(status != 'ok' for status in statuses):
+                record['stages'][stage.name] = {'status': 'skipped', 'seconds': 0.0, 'rows': None}
+                return 'skipped'
+
+            stage_start = time.perf_counter()
+            try:
+                result = await stage(context)
+            except Exception:
+                logger.exception('Stage %s failed on tick %d', stage.name, tick)
+                status, result = 'failed', None
+            else:
+                status = 'ok'
+                context[stage.name] = result
+
+            record['stages'][stage.name] = {'status': status, 'seconds': time.perf_counter() - stage_start,
+                                            'rows': _rows(result)}
+            return status
+
+        tasks = {}
+        for stage in self.stages:
+            tasks[stage.name] = asyncio.ensure_future(run(stage, [tasks[name] for name in stage.after]))
+        await asyncio.gather(*tasks.values())
+
+        record['seconds'] = time.perf_counter() - start
+        record['stages'] = {stage.name: record['stages'][stage.name] for stage in self.stages}
+        self.history.append(record)
+        logger.info('Tick %d took %.3fs: %s', tick, record['seconds'], ', '.join(
+            '{} {} {:.3f}s'.format(name, stats['status'], stats['seconds'])
+            for name, stats in record['stages'].items()))
+
+        return record
+
+    # The loop ---------------------------------------------------------------------------------------------------------
+    async def run(self, max_ticks=None):
+        """
+        Runs a tick every interval seconds until stop() is called
+
+        :param max_ticks: stop after starting this many ticks, run until stop() when None
+        """
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        stopping = asyncio.ensure_future(self._stop.wait())
+
+        started, current, pending = 0, None, False
+        due = loop.time()
+        try:
+            while not self._stop.is_set():
+                if current is not None and current.done():
+                    current.result()
+                    current = None
+                    if pending:
+                        pending = False
+                        current, started = asyncio.ensure_future(self.run_once()), started + 1
+
+                if max_ticks is not None and started >= max_ticks:
+                    break
+
+                now = loop.time()
+                if now >= due:
+                    # Ticks missed while the loop was busy are folded into this one rather than fired back to back
+                    missed = int((now - due) // self.interval)
+                    due += (missed + 1) * self.interval
+
+                    if current is None:
+                        current, started = asyncio.ensure_future(self.run_once()), started + 1
+                    elif self.overlap == 'skip':
+                        self.skipped += 1 + missed
+                        logger.warning('Tick skipped: tick %d is still running', self.ticks)
+                    else:
+                        self.queued += 0 if pending else 1
+                        pending = True
+                    continue
+
+                waiters = [stopping] + ([current] if current is not None else [])
+                await asyncio.wait(waiters, timeout=due - now, return_when=asyncio.FIRST_COMPLETED)
+
+            if current is not None:
+                await current
+        finally:
+            stopping.cancel()
+
+    def stop(self):
+        """
+        Stops run() once the tick in progress has finished
+        """
+        if self._stop is not None:
+            self._stop.set()
+
+    # Metrics ----------------------------------------------------------------------------------------------------------
+    def stage_stats(self):
+        """
+        :return: a dict of {stage name: {'runs', 'failures', 'skipped', 'last_seconds', 'mean_seconds', 'max_seconds',
+            'rows'}} over the ticks in history, rows being the total reported by the stage
+        """
+        stats = {}
+        for stage in self.stages:
+            records = [record['stages'][stage.name] for record in self.history]
+            ran = [stage_stats for stage_stats in records if stage_stats['status'] != 'skipped']
+            seconds = [stage_stats['seconds'] for stage_stats in ran]
+            stats[stage.name] = {
+                'runs': len(ran),
+                'failures': sum(stage_stats['status'] == 'failed' for stage_stats in ran),
+                'skipped': len(records) - len(ran),
+                'last_seconds': seconds[-1] if seconds else None,
+                'mean_seconds': sum(seconds) / len(seconds) if seconds else None,
+                'max_seconds': max(seconds) if seconds else None,
+                'rows': sum(stage_stats['rows'] or 0 for stage_stats in ran),
+            }
+
+        return stats
+
+
+# The ingest pipeline --------------------------------------------------------------------------------------------------
+def _committed(conn):
+    """
+    :return: a dict of {symbol: load_date of the coin's latest committed market_data row}
+    """
+    table = CryptoCurrencies.__table__
+    symbols = {_id: symbol for _id, symbol in conn.execute(db.select(table.c.id, table.c.symbol))}
+    latest = latest_per_coin(conn, MarketData, [])
+
+    return {symbols[_id]: load_date.item() for _id, load_date in zip(latest['crypto_id'].tolist(), latest['load_date'])
+            if _id in symbols}
+
+
+def _fresh(quotes, committed):
+    # The quotes that are not in the database yet, so a restarted or repeated tick never replays a snapshot
+    return [quote for quote in quotes if quote.get('load_date') is None or quote['symbol'] not in committed or
+            quote['load_date'] > committed[quote['symbol']]]
+
+
+def ingest_stages(client, symbols, loader, store=None, ranking=None, retention_days=None, maintenance_every=60):
+    """
+    The stages of one ingest tick:
+
+        fetch -> load -> running_averages -> ranking
+                      -> store_sync
+        retention (every maintenance_every ticks, independent)
+
+    :param client: a CoinMarketCapClient, or anything with an async fetch_quotes(symbols)
+    :param symbols: the symbols fetched
+    :param loader: the MarketDataLoader writing the snapshots
+    :param store: a ColumnarStore of market_data kept in sync after each load, none when None
+    :param ranking: a callable(engine) computing IndexRanking from the running averages, e.g. a partial of
+        crypto.analytics.ranking.rank_index; no ranking stage when None
+    :param retention_days: drop the partitions older than this many days and compact the database, never when None
+    :param maintenance_every: the number of ticks between retention runs
+    :return: a list of Stages for Scheduler
+    """
+    engine = loader.engine
+
+    async def fetch(context):
+        return await client.fetch_quotes(symbols)
+
+    def load(context):
+        with engine.connect() as conn:
+            committed = _committed(conn)
+        quotes = _fresh(context['fetch'], committed)
+
+        return dict(loader.load(quotes), replayed=len(context['fetch']) - len(quotes))
+
+    def running_averages(context):
+        return update_running_averages(engine)
+
+    stages = [
+        Stage('fetch', fetch),
+        Stage('load', load, after=['fetch']),
+        Stage('running_averages', running_averages, after=['load']),
+    ]
+
+    if store is not None:
+        def store_sync(context):
+            with engine.connect() as conn:
+                return store.sync(conn)
+
+        stages.append(Stage('store_sync', store_sync, after=['load']))
+
+    if ranking is not None:
+        stages.append(Stage('ranking', lambda context: ranking(engine), after=['running_averages']))
+
+    if retention_days is not None:
+        def retention(context):
+            result = apply_retention(engine, retention_days)
+            result['pages'] = compact(engine) if result['dropped'] else 0
+            return result
+
+        stages.append(Stage('retention', retention, every=maintenance_every))
+
+    return stages
+
+
+def main(argv=None):
+    from crypto.coinmarketcap.client import CoinMarketCapClient
+    from crypto.config import COINMARKETCAP_PRIVATE_KEY, CRYPTO_SYMBOLS
+    from crypto.db.loader import MarketDataLoader
+    from crypto.db.store import ColumnarStore
+
+    parser = argparse.ArgumentParser(description='Runs the ingest pipeline at a fixed cadence.')
+    parser.add_argument('--interval', type=float, default=60.0, help='seconds between ticks')
+    parser.add_argument('--overlap', choices=OVERLAP_POLICIES, default='skip',
+                        help='what to do with a tick that comes due while the previous one is running')
+    parser.add_argument('--partitioned', action='store_true', help='load into the monthly market_data partitions')
+    parser.add_argument('--retention-days', type=int, help='days of raw snapshots kept, with --partitioned')
+    parser.add_argument('--store', help='the directory of a columnar store kept in sync')
+    parser.add_argument('--top-n', type=int, default=10, help='the number of coins in the index')
+    parser.add_argument('--cap', type=float, default=1.0, help='the maximum weight of a coin in the index')
+    parser.add_argument('--floor', type=float, default=0.0, help='the minimum weight of a coin in the index')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    async def run():
+        loader = MarketDataLoader(partitioned=args.partitioned)
+        store = ColumnarStore(args.store, 'market_data') if args.store else None
+        ranking = functools.partial(rank_index, top_n=args.top_n, cap=args.cap, floor=args.floor)
+        async with CoinMarketCapClient(COINMARKETCAP_PRIVATE_KEY) as client:
+            scheduler = Scheduler(ingest_stages(client, CRYPTO_SYMBOLS, loader, store=store, ranking=ranking,
+                                                retention_days=args.retention_days),
+                                  interval=args.interval, overlap=args.overlap)
+
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, scheduler.stop)
+            await scheduler.run()
+
+        for name, stats in scheduler.stage_stats().items():
+            logger.info('%s: %s', name, stats)
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import asyncio
+import datetime as dt
+
+import pytest
+import sqlalchemy as db
+
+from crypto.backfill import Backfill, SyntheticQuotes
+from crypto.db.database import dispose, get_engine
+
+SYMBOLS = ['BTC', 'ETH', 'SOL']
+START = dt.datetime(2024, 1, 1)
+END = dt.datetime(2024, 1, 5)
+# 4 days of 2 chunks of symbols
+UNITS = 8
+
+TABLES = {
+    'market_data': ('load_date', 'market_cap', 'market_cap_percentage', 'trade_price', 'ranking'),
+    'market_data_1m': ('load_date', 'open', 'high', 'low', 'close', 'market_cap', 'n_obs', 'last_date'),
+    'market_data_1h': ('load_date', 'open', 'high', 'low', 'close', 'market_cap', 'n_obs', 'last_date'),
+    'market_data_1d': ('load_date', 'open', 'high', 'low', 'close', 'market_cap', 'n_obs', 'last_date'),
+    'running_averages': ('load_date', 'ewma_market_cap', 'ewma_trade_price', 'ewma_volatility'),
+}
+
+
+class _Interrupted(BaseException):
+    """
+    Stands in for the process being stopped, which the backfill does not catch
+    """
+
+
+class _Source(SyntheticQuotes):
+    """
+    SyntheticQuotes that interrupts the run at the units starting at interrupt_at, once the units before them are
+    committed to the checkpoint, and fails the unit of SOL starting at fail_at
+    """
+
+    def __init__(self, interrupt_at=None, checkpoint=None, fail_at=None):
+        super().__init__(interval=dt.timedelta(hours=1))
+        self.interrupt_at = interrupt_at
+        self.checkpoint = checkpoint
+        self.fail_at = fail_at
+
+    async def fetch_history(self, symbols, start, end):
+        if start == self.interrupt_at:
+            committed = 2 * (start - START).days
+            while len(self.checkpoint.read_text().splitlines()) < committed:
+                await asyncio.sleep(0.01)
+            raise _Interrupted()
+        if start == self.fail_at and 'SOL' in symbols:
+            self.calls += 1
+            raise ConnectionError('unit failed')
+        return await super().fetch_history(symbols, start, end)
+
+
+@pytest.fixture
+def engines(tmp_path):
+    urls = ['sqlite:///{}'.format(tmp_path / name) for name in ('uninterrupted.db', 'resumed.db')]
+    yield [get_engine(url) for url in urls]
+    for url in urls:
+        dispose(url)
+
+
+def _backfill(source, engine, checkpoint):
+    return Backfill(source, SYMBOLS, START, END, str(checkpoint), engine=engine, days_per_unit=1, symbols_per_unit=2,
+                    workers=2)
+
+
+def _dump(engine, table):
+    # Keyed on the symbol, the crypto_ids depend on the order the coins were first written in
+    sql = 'SELECT c.symbol, {} FROM {} t JOIN currency_information c ON c.id = t.crypto_id ORDER BY c.symbol, ' \
+          't.load_date'.format(', '.join('t.' + column for column in TABLES[table]), table)
+    with engine.connect() as conn:
+        return conn.execute(db.text(sql)).all()
+
+
+def test_resumed_backfill_matches_uninterrupted(engines, tmp_path):
+    uninterrupted, resumed = engines
+    stats = asyncio.run(_backfill(_Source(), uninterrupted, tmp_path / 'uninterrupted.jsonl').run())
+    assert (stats['units'], stats['skipped'], stats['failed']) == (UNITS, 0, 0)
+    assert stats['rows'] == len(SYMBOLS) * 4 * 24
+
+    checkpoint = tmp_path / 'resumed.jsonl'
+    checkpoint.touch()
+    with pytest.raises(_Interrupted):
+        asyncio.run(_backfill(_Source(START + dt.timedelta(days=2), checkpoint), resumed, checkpoint).run())
+    assert len(checkpoint.read_text().splitlines()) == UNITS // 2
+
+    # The first resume loses a unit, so it leaves the rebuild to the next run
+    source = _Source(fail_at=START + dt.timedelta(days=3))
+    stats = asyncio.run(_backfill(source, resumed, checkpoint).run())
+    assert (stats['units'], stats['skipped'], stats['failed']) == (UNITS // 2 - 1, UNITS // 2, 1)
+    assert source.calls == UNITS // 2
+    assert 'rollups' not in stats
+
+    source = _Source()
+    stats = asyncio.run(_backfill(source, resumed, checkpoint).run())
+    assert (stats['units'], stats['skipped'], stats['failed']) == (1, UNITS - 1, 0)
+    assert source.calls == 1
+    assert stats['running_averages']['coins'] == len(SYMBOLS)
+
+    for table in TABLES:
+        expected = _dump(uninterrupted, table)
+        assert expected, table
+        assert _dump(resumed, table) == expected, table
@@ -1,31 +1,22 @@
-import requests_html as rh
+import asyncio
 from pprint import pprint
+from crypto.coinmarketcap.client import CoinMarketCapClient
 from crypto.config import COINMARKETCAP_PRIVATE_KEY, CRYPTO_SYMBOLS
-import os
-
-url = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest'
+from crypto.db.database import get_engine
 
 
 # %%
 def extract_crypto_data(private_key: str):
-    session = rh.HTMLSession()
-
-    headers = {
-        'Accepts': 'application/json',
-        'X-CMC_PRO_API_KEY': private_key,
-    }
-    parameters = {
-        'symbol': CRYPTO_SYMBOLS,
-    }
-    session.headers.update(headers)
+    async def fetch():
+        async with CoinMarketCapClient(private_key) as client:
+            return await client.fetch_quotes(CRYPTO_SYMBOLS)
 
-    response = session.get(url, params=parameters)
-    return response.json()
+    return asyncio.run(fetch())
 
 
 # %%
-if '__main__':
-    if not os.path.exists('crypto_index.db'):
-        os.system('python crypto/db/models.py')
+if __name__ == '__main__':
+    # Creates the database on the first run and applies any pending migrations
+    get_engine()
 
 # data = extract_crypto_data(COINMARKETCAP_PRIVATE_KEY)